@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# bench_process_cartons.py
+
+"""
+End-to-end benchmark of process_cartons on a synthetic targetdb.
+
+A SQLite stand-in of targetdb with the tables of the sdssdb targetdb models (version, category,
+mapper, cadence, instrument, carton, carton_to_target, and magnitude, see
+cartons_inventory.testing) is generated with
+``--cartons`` cartons of ``--targets`` targets each, where a fraction ``--placeholder-rate``
+of the magnitudes are placeholders. Then process_cartons runs on all the cartons with each of
+the ``--modes``, each in a new process, recording the wall time, the number of queries, and
+the peak RSS. The modes are the ``mode`` parameters of process_cartons and ``batch``
+(batch=True). array_agg, used by ``sql`` and ``batch``, is the SQLite stand-in of
+cartons_inventory.testing.
+
+The results are written to ``--output`` as JSON. With ``--compare`` the results are compared
+with a previous output with the same parameters, and the script exits with status 1 if the
+wall time or peak RSS of a mode are more than ``--threshold`` (a fraction) above those of the
+baseline, or if the number of queries increased. For example::
+
+    python benchmarks/bench_process_cartons.py --output results.json \\
+        --compare benchmarks/baselines/process_cartons.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+from peewee import SqliteDatabase
+
+from cartons_inventory.testing import (TARGETDB_MODELS, create_targetdb,
+                                       decode_arrays, insert_rows,
+                                       register_array_agg)
+
+
+TARGETDB_INDEXES = ['carton_to_target (carton_pk)', 'magnitude (carton_to_target_pk)']
+
+PLACEHOLDERS = [None, 0.0, 999.9, -9999.0]
+
+# Parameters of process_cartons of each mode
+MODES = {'dataframe': {'mode': 'dataframe'}, 'stream': {'mode': 'stream'},
+         'shared': {'mode': 'shared'}, 'sql': {'mode': 'sql'}, 'batch': {'batch': True}}
+
+# Statements that are not counted as queries
+NOT_QUERIES = ('ATTACH', 'BEGIN', 'COMMIT', 'PRAGMA', 'RELEASE', 'ROLLBACK', 'SAVEPOINT')
+
+
+class CountingSqliteDatabase(SqliteDatabase):
+    """SqliteDatabase that counts the queries executed in all its connections.
+
+    The statements are counted with the trace callback of the sqlite3 connections, so queries
+    executed with cursors of the connection (e.g. by iter_query_chunks) are also counted.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.n_queries = 0
+        self._count_lock = threading.Lock()
+
+    def _add_conn_hooks(self, conn):
+        super()._add_conn_hooks(conn)
+        conn.set_trace_callback(self._count_query)
+
+    def _count_query(self, sql):
+        if not sql.lstrip().upper().startswith(NOT_QUERIES):
+            with self._count_lock:
+                self.n_queries += 1
+
+
+def bind_targetdb(directory):
+    """Returns a database with the synthetic targetdb of directory bound to the models."""
+
+    database = CountingSqliteDatabase(os.path.join(directory, 'main.db'))
+    database.attach(os.path.join(directory, 'targetdb.db'), 'targetdb')
+    register_array_agg(database)
+    database.bind(TARGETDB_MODELS)
+    return database
+
+
+def generate_targetdb(directory, n_cartons, n_targets, placeholder_rate, seed=0):
+    """Creates the synthetic targetdb in directory and a carton list of all its cartons.
+
+    The carton list is written to files/custom/bench.txt in directory.
+
+    """
+
+    rng = np.random.default_rng(seed)
+    database = bind_targetdb(directory)
+    create_targetdb(database)
+
+    cartons = [(pk, f'mwm_bench_{pk:05d}', 'mwm', 1, 0, pk % 2) for pk in range(1, n_cartons + 1)]
+    rows = {'version': [(1, '0.5.0', '0.3.5')], 'category': [(0, 'science')],
+            'mapper': [(0, 'MWM'), (1, 'BHM')],
+            'cadence': [(pk, f'bright_{pk}x1') for pk in range(1, 21)],
+            'instrument': [(0, 'BOSS'), (1, 'APOGEE')], 'carton': cartons}
+
+    n_rows = n_cartons * n_targets
+    pks = np.arange(1, n_rows + 1)
+    instrument_pk = rng.integers(0, 2, n_rows)
+    rows['carton_to_target'] = zip(
+        pks.tolist(), ((pks - 1) // n_targets + 1).tolist(), pks.tolist(),
+        rng.integers(1, 21, n_rows).tolist(), instrument_pk.tolist(),
+        np.where(instrument_pk == 0, 5400.0, 16000.0).tolist(),
+        (rng.integers(0, 60, n_rows) * 100).tolist(), rng.choice([1.0, 1.5, 2.0], n_rows).tolist())
+
+    mags = rng.normal(17, 2, (n_rows, 10)).astype(object)
+    placeholder = rng.random(mags.shape) < placeholder_rate
+    mags[placeholder] = rng.choice(np.array(PLACEHOLDERS, dtype=object), placeholder.sum())
+    rows['magnitude'] = (((pk, pk) + tuple(row)) for pk, row in zip(pks.tolist(), mags.tolist()))
+
+    with database.atomic():
+        for table, table_rows in rows.items():
+            insert_rows(database, table, table_rows)
+    for index in TARGETDB_INDEXES:
+        name = index.split()[0] + '_idx'
+        database.execute_sql(f'CREATE INDEX targetdb.{name} ON {index}')
+    database.close()
+
+    os.makedirs(os.path.join(directory, 'files', 'custom'))
+    with open(os.path.join(directory, 'files', 'custom', 'bench.txt'), 'w') as output:
+        output.write('| carton | plan | category | stage | active |\n')
+        for carton in cartons:
+            output.write(f'| {carton[1]} | 0.5.0 | science | srd | y |\n')
+
+
+def run_mode(directory, mode, max_workers=1):
+    """Runs process_cartons on the synthetic targetdb and returns its measurements.
+
+    This runs in a new process (see main), so the peak RSS is that of process_cartons only.
+
+    """
+
+    from cartons_inventory.cartons import CartonInfo, process_cartons
+
+    database = bind_targetdb(directory)
+    CartonInfo.assign_aggregated_info = decode_arrays(CartonInfo.assign_aggregated_info)
+    os.chdir(directory)
+
+    start = time.perf_counter()
+    process_cartons(origin='custom', inputname='bench.txt', write_output=True,
+                    assign_sets=True, assign_placeholders=True, overwrite=True,
+                    max_workers=max_workers, **MODES[mode])
+    wall_time = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes in Linux and in bytes in macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    return {'wall_time': wall_time, 'n_queries': database.n_queries,
+            'peak_rss_mb': peak_rss / 1024 ** 2}
+
+
+def compare(results, baseline, threshold):
+    """Returns the list of regressions of results with respect to baseline."""
+
+    assert results['parameters'] == baseline['parameters'], 'the baseline was obtained with'\
+        f' different parameters: {baseline["parameters"]}'
+
+    regressions = []
+    for mode, values in results['results'].items():
+        if mode not in baseline['results']:
+            continue
+        reference = baseline['results'][mode]
+        for name in ['wall_time', 'peak_rss_mb']:
+            if values[name] > reference[name] * (1 + threshold):
+                regressions.append(f'{mode}: {name} {values[name]:.3f} > {reference[name]:.3f}'
+                                   f' (+{threshold:.0%})')
+        if values['n_queries'] > reference['n_queries']:
+            regressions.append(f'{mode}: n_queries {values["n_queries"]} > '
+                               f'{reference["n_queries"]}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--cartons', type=int, default=20, help='number of cartons')
+    parser.add_argument('--targets', type=int, default=5000, help='targets per carton')
+    parser.add_argument('--placeholder-rate', type=float, default=0.02,
+                        help='fraction of magnitudes that are placeholders')
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=MODES,
+                        help='modes of process_cartons to run')
+    parser.add_argument('--max-workers', type=int, default=1,
+                        help='max_workers parameter of process_cartons')
+    parser.add_argument('--output', help='JSON file where the results are written')
+    parser.add_argument('--compare', help='JSON file with baseline results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed fractional increase of wall time and peak RSS')
+    # Used internally to run each mode in a new python process
+    parser.add_argument('--run-mode', help=argparse.SUPPRESS)
+    parser.add_argument('--directory', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_mode:
+        print(json.dumps(run_mode(args.directory, args.run_mode, args.max_workers)))
+        return 0
+
+    parameters = {'cartons': args.cartons, 'targets': args.targets,
+                  'placeholder_rate': args.placeholder_rate, 'max_workers': args.max_workers}
+    results = {'parameters': parameters,
+               'machine': {'python': platform.python_version(), 'system': platform.system(),
+                           'machine': platform.machine(), 'cpus': os.cpu_count()},
+               'results': {}}
+
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        generate_targetdb(directory, args.cartons, args.targets, args.placeholder_rate)
+        print(f'Generated synthetic targetdb in {time.perf_counter() - start:.1f} s')
+
+        for mode in args.modes:
+            command = [sys.executable, os.path.abspath(__file__), '--run-mode', mode,
+                       '--directory', directory, '--max-workers', str(args.max_workers)]
+            output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True)
+            values = json.loads(output.stdout.splitlines()[-1])
+            results['results'][mode] = values
+            print(f'{mode}: {values["wall_time"]:.3f} s, {values["n_queries"]} queries, '
+                  f'{values["peak_rss_mb"]:.1f} MB peak RSS')
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=4)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline), args.threshold)
+        for regression in regressions:
+            print('Regression in ' + regression)
+        return 1 if len(regressions) > 0 else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
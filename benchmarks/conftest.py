@@ -0,0 +1,103 @@
+# encoding: utf-8
+#
+# conftest.py
+
+"""
+Fixtures with synthetic data for the benchmarks of the inventory functions. Each benchmark
+using the ``n_rows`` parameter runs for the sizes in SIZES up to ``--max-rows`` (1e5 by
+default, use --max-rows=1e7 for the whole range).
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from pytest_benchmark.logger import PytestBenchmarkWarning
+
+
+SIZES = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+
+BANDS = ['g', 'r', 'i', 'z', 'j', 'h', 'k', 'bp', 'rp', 'gaia_g']
+SYSTEMS = ['SDSS'] * 4 + ['TMASS'] * 3 + ['GAIA'] * 3
+
+# Fraction of the magnitudes replaced by each placeholder
+PLACEHOLDERS = {None: 0.01, np.nan: 0.005, 0.0: 0.005, 999.9: 0.01, -9999.0: 0.005}
+
+
+def pytest_addoption(parser):
+    parser.addoption('--max-rows', type=float, default=1e5,
+                     help='Maximum number of rows of the synthetic data of the benchmarks')
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_configure(config):
+    session = getattr(config, '_benchmarksession', None)
+    # Without a baseline for this machine type there is nothing to compare with, so the
+    # comparison of addopts is turned off (with a warning) instead of failing the run
+    if session is not None and session.compare and \
+            len(session.storage.query('[0-9][0-9][0-9][0-9]_*')) == 0:
+        config.issue_config_time_warning(PytestBenchmarkWarning(
+            f'No baseline in {session.storage} for this machine type, the benchmarks are not '
+            'compared (save one with --benchmark-save=baseline)'), stacklevel=2)
+        session.compare, session.compare_fail = None, None
+
+
+def pytest_generate_tests(metafunc):
+    if 'n_rows' in metafunc.fixturenames:
+        max_rows = metafunc.config.getoption('max_rows')
+        metafunc.parametrize('n_rows', [size for size in SIZES if size <= max_rows])
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
+
+
+@pytest.fixture
+def magnitudes(n_rows, rng):
+    """Magnitudes of n_rows targets with the placeholder rates in PLACEHOLDERS.
+
+    As in the DataFrames from records_to_dataframe, bands with None values are object columns.
+
+    """
+
+    data = {}
+    for band in BANDS:
+        column = rng.normal(17, 2, n_rows).astype(object)
+        kinds = rng.random(n_rows)
+        threshold = 0
+        for placeholder, rate in PLACEHOLDERS.items():
+            column[(kinds >= threshold) & (kinds < threshold + rate)] = placeholder
+            threshold += rate
+        data[band] = column if (column == None).any() else column.astype(float)  # noqa: E711
+    return pd.DataFrame(data)
+
+
+@pytest.fixture
+def priorities(n_rows, rng):
+    """List of n_rows priorities with a few hundred distinct values and some None."""
+
+    values = rng.integers(0, 300, n_rows).tolist()
+    values[::97] = [None] * len(values[::97])
+    return values
+
+
+@pytest.fixture
+def carton_list(n_rows, tmp_path):
+    """Input carton list file with n_rows cartons in the format of files/custom."""
+
+    filename = tmp_path / 'cartons.txt'
+    with open(filename, 'w') as output:
+        output.write('| carton | plan | category | stage | active |\n')
+        for index in range(n_rows):
+            output.write(f'| mwm_carton_{index} | 0.5.0 | science | srd | y |\n')
+    return str(filename)
+
+
+@pytest.fixture
+def output_rows(n_rows, rng):
+    """n_rows rows of an output file of process_cartons with sets and ranges."""
+
+    return [[f'mwm_carton_{index}', '0.5.0', 'science', 'srd', 'y', 'mwm', 83, '0.3.5', 1,
+             'MWM', 0, {1, 2}, {'bright_1x1', 'dark_1x4'}, {5400.0, 16000.0}, {0, 1},
+             {'BOSS', 'APOGEE'}, 1.0, 2.0, int(priority), int(priority) + 10]
+            for index, priority in enumerate(rng.integers(0, 6000, n_rows))]
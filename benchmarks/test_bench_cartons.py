@@ -0,0 +1,36 @@
+# encoding: utf-8
+#
+# test_bench_cartons.py
+
+from conftest import BANDS, SYSTEMS
+
+from cartons_inventory.cartons import check_mag_outliers, gets_carton_info
+from cartons_inventory.output import OutputWriter
+
+
+COLUMNS = ['carton', 'plan', 'category_label', 'stage', 'active', 'program', 'version_pk',
+           'tag', 'mapper_pk', 'mapper_label', 'category_pk', 'cadence_pk', 'cadence_label',
+           'lambda_eff', 'instrument_pk', 'instrument_label', 'value_min', 'value_max',
+           'priority_min', 'priority_max']
+
+
+class TestBenchCartons(object):
+    """Benchmarks of the per carton and per target functions of cartons.py."""
+
+    def test_check_mag_outliers(self, benchmark, magnitudes):
+        placeholders = benchmark(check_mag_outliers, magnitudes, BANDS, SYSTEMS)
+        assert 'SDSS_None' in placeholders and 'GAIA_999.9' in placeholders
+
+    def test_gets_carton_info(self, benchmark, carton_list, n_rows):
+        cartons = benchmark(gets_carton_info, carton_list)[0]
+        assert len(cartons) == n_rows
+
+    def test_csv_writer(self, benchmark, output_rows, tmp_path):
+        def write():
+            writer = OutputWriter(str(tmp_path / 'output.csv'), COLUMNS, sets=['cadence_pk'])
+            for row in output_rows:
+                writer.writerow(row)
+            writer.close()
+
+        benchmark(write)
+        assert (tmp_path / 'output.csv').stat().st_size > 0
@@ -0,0 +1,46 @@
+# encoding: utf-8
+#
+# test_bench_import.py
+
+import subprocess
+import sys
+import time
+
+import pytest
+
+
+# Each module is imported in a new python process, so the time includes the interpreter
+# startup (measured by the ``sys`` case) and all the imports that are not deferred
+MODULES = ['sys', 'cartons_inventory', 'cartons_inventory.cartons']
+
+# Maximum time (in seconds) of the import of each module beyond the interpreter startup. This
+# is checked in every run, also without a baseline. The limits are several times the import
+# times of the baseline, so they are only exceeded if e.g. sdsstools is imported again by
+# ``import cartons_inventory`` (about 0.3 s) or a large dependency is no longer deferred
+MAX_IMPORT_TIME = {'cartons_inventory': 0.2, 'cartons_inventory.cartons': 3.0}
+
+
+def run_python(code, rounds=5):
+    """Returns the minimum time of running code in a new python process."""
+
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@pytest.mark.parametrize('module', MODULES)
+def test_import_time(benchmark, module):
+    command = [sys.executable, '-c', f'import {module}']
+    result = benchmark.pedantic(subprocess.run, args=(command,), kwargs={'check': True},
+                                rounds=5, warmup_rounds=1)
+    assert result.returncode == 0
+
+    if module in MAX_IMPORT_TIME:
+        # The stats are None with --benchmark-disable, then the import is timed here
+        stats = benchmark.stats
+        import_time = stats.stats.min if stats is not None else run_python(f'import {module}')
+        assert import_time - run_python('pass') < MAX_IMPORT_TIME[module], \
+            f'import {module} took {import_time:.3f} s'
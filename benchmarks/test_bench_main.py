@@ -0,0 +1,16 @@
+# encoding: utf-8
+#
+# test_bench_main.py
+
+from cartons_inventory.main import get_range, set_or_none
+
+
+class TestBenchMain(object):
+    """Benchmarks of the set helpers in main.py."""
+
+    def test_set_or_none(self, benchmark, priorities):
+        assert benchmark(set_or_none, priorities) is not None
+
+    def test_get_range(self, benchmark, priorities):
+        values = set_or_none(priorities) - {None}
+        assert benchmark(get_range, values) == (min(values), max(values))
@@ -1,19 +1,36 @@
 # encoding: utf-8
 
-from sdsstools import get_config, get_logger, get_package_version
-
 
 # pip package name
 NAME = 'sdss-cartons_inventory'
 
-# Loads config. config name is the package name.
-config = get_config('cartons_inventory')
 
-# Inits the logging system as NAME. Only shell logging, and exception and warning catching.
-# File logging can be started by calling log.start_file_logger(path).  Filename can be different
-# than NAME.
-log = get_logger(NAME)
+def __getattr__(name):
+    """Creates the config, log, and __version__ attributes when they are first used.
+
+    This keeps ``import cartons_inventory`` (and the modules that do not need them) from
+    importing sdsstools.
+
+    """
+
+    # The submodules are looked up here by ``from cartons_inventory import <module>`` before
+    # they are imported, so sdsstools is only imported for the attributes it creates
+    if name not in ['config', 'log', '__version__']:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+    from sdsstools import get_config, get_logger, get_package_version
 
+    if name == 'config':
+        # Loads config. config name is the package name.
+        value = get_config('cartons_inventory')
+    elif name == 'log':
+        # Inits the logging system as NAME. Only shell logging, and exception and warning
+        # catching. File logging can be started by calling log.start_file_logger(path).
+        # Filename can be different than NAME.
+        value = get_logger(NAME)
+    else:
+        # package name should be pip package name
+        value = get_package_version(path=__file__, package_name=NAME)
 
-# package name should be pip package name
-__version__ = get_package_version(path=__file__, package_name=NAME)
+    globals()[name] = value
+    return value
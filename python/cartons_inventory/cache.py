@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import cartons_inventory
+from cartons_inventory import sketches as sketches_module
+
+
+class ResultCache(object):
+    """Persistent cache of the target dependent information of the cartons.
+
+    The targets of a carton version in targetdb don't change once it is loaded, so the result
+    of CartonInfo.assign_target_info for a carton/plan/tag/version_pk combination can be saved
+    and reused in later runs of process_cartons. The cache is a SQLite file with one entry per
+    combination, keyed also by a hash of the ``db_fields`` and ``bands`` sections of the
+    configuration, so entries calculated with a different configuration are not used. The
+    sets/ranges, the magnitude placeholders, and the sketches of an entry are stored
+    independently, as JSON (the sketches with a hash of the ``sketches`` section of the
+    configuration, so they are only used if it did not change).
+    When the cache has more than max_entries entries the least recently used are removed,
+    and entries can be removed explicitly with invalidate.
+
+    Parameters
+    ----------
+
+    path : str or None
+        Path of the SQLite file. If None, ``cache['path']`` from the configuration.
+    max_entries : int or None
+        Maximum number of entries. If None, ``cache['max_entries']`` from the configuration.
+
+    """
+
+    def __init__(self, path=None, max_entries=None):
+        cfg = cartons_inventory.config
+        self.path = os.path.expanduser(path or cfg['cache']['path'])
+        self.max_entries = max_entries or cfg['cache']['max_entries']
+        self.config_hash = hash_config()
+
+        if os.path.dirname(self.path) != '':
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, carton TEXT, '
+                'plan TEXT, tag TEXT, version_pk INTEGER, sets TEXT, placeholders TEXT, '
+                'last_used INTEGER)')
+            # Cache files created before the sketches were added don't have their column
+            columns = [row[1] for row in self._connection.execute('PRAGMA table_info(results)')]
+            if 'sketches' not in columns:
+                self._connection.execute('ALTER TABLE results ADD COLUMN sketches TEXT')
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def key(self, obj):
+        """Returns the key of the entry of a CartonInfo object."""
+
+        fields = [obj.carton, obj.plan, obj.tag, obj.version_pk, self.config_hash]
+        return hashlib.sha256(json.dumps(fields).encode()).hexdigest()
+
+    def get(self, obj, calculate_sets=True, calculate_mag_placeholders=False,
+            calculate_sketches=False):
+        """Assigns the cached target dependent information to a CartonInfo object.
+
+        The information is only assigned if the entry of the object has all the information
+        requested with ``calculate_sets``, ``calculate_mag_placeholders``, and
+        ``calculate_sketches``.
+
+        Returns
+        -------
+
+        found : bool
+            True if the information was found in the cache and assigned to the object.
+
+        """
+
+        if not obj.in_targetdb:
+            return False
+
+        key = self.key(obj)
+        with self._lock, self._connection:
+            row = self._connection.execute('SELECT sets, placeholders, sketches FROM results '
+                                           'WHERE key = ?', (key,)).fetchone()
+            if row is None or (calculate_sets and row[0] is None) or\
+                    (calculate_mag_placeholders and row[1] is None):
+                return False
+            if calculate_sketches:
+                sketches = None if row[2] is None else json.loads(row[2])
+                if sketches is None or\
+                        sketches['config_hash'] != sketches_module.hash_sketches_config():
+                    return False
+            self._connection.execute('UPDATE results SET last_used = ? WHERE key = ?',
+                                     (time.time_ns(), key))
+
+        target_parameters = cartons_inventory.config['db_fields']
+        if calculate_sets and not obj.sets_calculated:
+            sets = json.loads(row[0])
+            for set_name in target_parameters['sets']:
+                setattr(obj, set_name, to_set(sets[set_name]))
+            for set_name in target_parameters['set_ranges']:
+                setattr(obj, set_name + '_min', sets[set_name + '_min'])
+                setattr(obj, set_name + '_max', sets[set_name + '_max'])
+            obj.sets_calculated = True
+        if calculate_mag_placeholders and not obj.mag_placeholders_calculated:
+            placeholders = json.loads(row[1])
+            obj.magnitude_placeholders = to_set(placeholders['magnitude_placeholders'])
+            obj.magnitude_placeholder_counts = placeholders['magnitude_placeholder_counts']
+            obj.mag_placeholders_calculated = True
+        if calculate_sketches and not obj.sketches_calculated:
+            obj.sketches = sketches_module.loads(sketches['sketches'])
+            obj.sketches_calculated = True
+
+        return True
+
+    def put(self, obj):
+        """Saves the target dependent information calculated for a CartonInfo object.
+
+        The information already cached for the object and not calculated in it is kept.
+        Approximate results (from a sample of the targets) are not saved.
+
+        """
+
+        calculated = [obj.sets_calculated, obj.mag_placeholders_calculated,
+                      getattr(obj, 'sketches_calculated', False)]
+        if not obj.in_targetdb or not any(calculated):
+            return
+        if getattr(obj, 'approximate', False):
+            return
+
+        target_parameters = cartons_inventory.config['db_fields']
+        sets, placeholders, sketches = None, None, None
+        if obj.sets_calculated:
+            sets = {set_name: getattr(obj, set_name) for set_name in target_parameters['sets']}
+            for set_name in target_parameters['set_ranges']:
+                sets[set_name + '_min'] = getattr(obj, set_name + '_min')
+                sets[set_name + '_max'] = getattr(obj, set_name + '_max')
+            sets = to_json(sets)
+        if obj.mag_placeholders_calculated:
+            placeholders = to_json({
+                'magnitude_placeholders': obj.magnitude_placeholders,
+                'magnitude_placeholder_counts': obj.magnitude_placeholder_counts})
+        if calculated[2]:
+            sketches = json.dumps({'config_hash': sketches_module.hash_sketches_config(),
+                                   'sketches': sketches_module.dumps(obj.sketches)})
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT INTO results (key, carton, plan, tag, version_pk, sets, placeholders, '
+                'sketches, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (key) '
+                'DO UPDATE SET sets = coalesce(excluded.sets, sets), '
+                'placeholders = coalesce(excluded.placeholders, placeholders), '
+                'sketches = coalesce(excluded.sketches, sketches), '
+                'last_used = excluded.last_used',
+                (self.key(obj), obj.carton, obj.plan, obj.tag, obj.version_pk, sets,
+                 placeholders, sketches, time.time_ns()))
+            self._connection.execute(
+                'DELETE FROM results WHERE key NOT IN '
+                '(SELECT key FROM results ORDER BY last_used DESC LIMIT ?)',
+                (self.max_entries,))
+
+    def invalidate(self, carton=None, plan=None, tag=None, version_pk=None):
+        """Removes the entries matching all the parameters given, or all if none is given.
+
+        Returns
+        -------
+
+        n_removed : int
+            Number of entries removed.
+
+        """
+
+        conditions = {'carton': carton, 'plan': plan, 'tag': tag, 'version_pk': version_pk}
+        conditions = {name: value for name, value in conditions.items() if value is not None}
+        where = ' AND '.join([name + ' = ?' for name in conditions]) or '1'
+        with self._lock, self._connection:
+            cursor = self._connection.execute('DELETE FROM results WHERE ' + where,
+                                              list(conditions.values()))
+        return cursor.rowcount
+
+    def close(self):
+        """Closes the connection to the cache file."""
+        self._connection.close()
+
+
+def hash_config():
+    """Returns a hash of the configuration sections that determine the cached results."""
+
+    cfg = cartons_inventory.config
+    data = {'db_fields': cfg['db_fields'], 'bands': cfg['bands']}
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def to_json(data):
+    """Serializes target information to JSON, with python sets and numpy scalars as lists."""
+
+    def default(value):
+        if isinstance(value, (set, frozenset)):
+            return list(value)
+        if hasattr(value, 'item'):
+            return value.item()
+        return float(value)
+
+    return json.dumps(data, default=default)
+
+
+def to_set(values):
+    """Converts a list from to_json back to the set (or None) assigned by assign_target_info."""
+    return None if values is None else set(values)
@@ -1,26 +1,55 @@
-import csv
+import asyncio
+import contextvars
+import gzip
 import inspect
 import os
+import queue
+import uuid
+from collections import Counter
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 
 import numpy as np
-import pandas as pd
-from astropy.io import ascii
-from sdssdb.peewee.sdss5db.targetdb import (Cadence, Carton, CartonToTarget,
-                                            Category, Instrument, Magnitude,
-                                            Mapper, Version)
+from peewee import OP, SQL, Case, Expression, PostgresqlDatabase, fn
 
 import cartons_inventory
-from cartons_inventory import log, main
-
+from cartons_inventory import main, metrics, profiling, runlog
+from cartons_inventory.cache import ResultCache
+from cartons_inventory.catalog import CartonCatalog, DimensionTables
+from cartons_inventory.imports import import_targetdb, lazy_import
+from cartons_inventory.output import OUTPUT_FORMATS, OutputWriter, read_rows
+from cartons_inventory.sketches import merge_sketches, new_sketches
+
+
+# pandas and astropy are imported when they are first used, and the database connection of
+# the targetdb models is opened with the first query
+pd = lazy_import('pandas')
+ascii = lazy_import('astropy.io.ascii')
+targetdb = import_targetdb()
+Carton, CartonToTarget, Category = targetdb.Carton, targetdb.CartonToTarget, targetdb.Category
+Magnitude, Mapper, Version = targetdb.Magnitude, targetdb.Mapper, targetdb.Version
 
 Car = Carton.alias()
 CarTar = CartonToTarget.alias()
-Cad = Cadence.alias()
-Inst = Instrument.alias()
 Categ = Category.alias()
 Map = Mapper.alias()
 Mag = Magnitude.alias()
 
+# Query expression of each target dependent parameter listed in db_fields['sets'] that is
+# a column of targetdb.carton_to_target
+TARGET_FIELDS = {'value': CarTar.value, 'priority': CarTar.priority,
+                 'cadence_pk': CarTar.cadence_pk, 'lambda_eff': CarTar.lambda_eff,
+                 'instrument_pk': CarTar.instrument_pk}
+
+# Target dependent parameters that are labels of a dimension table, with the column of
+# TARGET_FIELDS with the pk and the table of DimensionTables with the label of each pk
+LABEL_FIELDS = {'cadence_label': ('cadence_pk', 'cadence'),
+                'instrument_label': ('instrument_pk', 'instrument')}
+
+# Multiplier and modulus of the hash of carton_to_target pks used to sample the targets. The
+# product of the multiplier and (pk mod modulus) is below 2**63, so it fits in a bigint
+SAMPLE_HASH = (2654435761, 2 ** 31)
+
 
 class CartonInfo(object):
     """Saves targetdb info for cartons.
@@ -71,6 +100,22 @@ class CartonInfo(object):
         Mapper_pk in targetdb.carton table. 0 for MWM and 1 for BHM
     category_pk: int
         category_pk in targetdb.carton table (e.g. 0 for science)
+    carton_pk: int
+        pk in targetdb.carton table, None if the carton is not in targetdb
+    n_targets: int or None
+        Number of targets of the carton, set by assign_target_info (except in mode ``sql``).
+        If approximate is True it is estimated from the sample.
+    approximate: bool
+        True if the target dependent information was calculated with a sample of the targets
+        (assign_target_info with sample_fraction), in which case the sets and ranges may miss
+        some values and n_targets and magnitude_placeholder_counts are estimates.
+    fingerprint: str or None
+        Number of targets, maximum targetdb.carton_to_target pk, and tag of the carton
+        separated by ``:`` as assigned by assign_fingerprints, used to detect changes in the
+        targets of the carton between runs of process_cartons.
+    catalog: CartonCatalog or None
+        If present, carton dependent information and alternatives in check_existence are taken
+        from this in-memory snapshot of targetdb instead of querying the database.
     in_targetdb: bool
         True is carton/plan/category_label combination is found in targetdb, false if not.
     sets_calculated: bool
@@ -81,25 +126,61 @@ class CartonInfo(object):
     mag_placeholders_calculated: bool
         True when magnitude placholdes used for SDSS, TMASS, and GAIA photometric systems
         have been calculated. These are calculated using check_magnitude_outliers function
+        along with magnitude_placeholder_counts, the number of targets with each placeholder
+    sketches: dict or None
+        DistributionSketch (quantile sketch and histogram) of each target column in
+        ``sketches['columns']`` and each band in the configuration, assigned by
+        assign_target_info(calculate_sketches=True). The sketches of the bands only include
+        valid magnitudes (not the placeholders counted in magnitude_placeholder_counts).
+    sketches_calculated: bool
+        True when sketches have been calculated.
 
     """
-    cfg = cartons_inventory.config
 
-    def __init__(self, carton, plan, category_label, stage='N/A', active='N/A'):
+    def __init__(self, carton, plan, category_label, stage='N/A', active='N/A', catalog=None):
         self.carton = carton
         self.plan = plan
         self.category_label = category_label
         self.stage = stage
         self.active = active
+        self.catalog = catalog
 
         self.mapper_label, self.program, self.version_pk = [], [], []
         self.tag, self.mapper_pk, self.category_pk = [], [], []
+        self.carton_pk = None
+        self.fingerprint = None
+        self.n_targets = None
+        self.approximate = False
         self.in_targetdb = False
         self.sets_calculated = False
         self.mag_placeholders_calculated = False
+        self.sketches = None
+        self.sketches_calculated = False
 
         self.assign_carton_info()
 
+    @classmethod
+    async def afetch(cls, carton, plan, category_label, stage='N/A', active='N/A', catalog=None,
+                     limiter=None, **kwargs):
+        """Asynchronous version of the instantiation of a CartonInfo object.
+
+        The object is instantiated (which queries targetdb if ``catalog`` is None) and, if any
+        ``kwargs`` are given, CartonInfo.assign_target_info is run with them, in a thread of the
+        default executor of the running event loop, so the event loop is not blocked by the
+        database queries. Several calls can be awaited concurrently (e.g. with asyncio.gather),
+        in which case the optional ``limiter`` (e.g. an asyncio.Semaphore shared by all the
+        calls) limits the number of them querying the database at the same time.
+
+        """
+
+        def fetch():
+            obj = cls(carton, plan, category_label, stage, active, catalog=catalog)
+            if len(kwargs) > 0:
+                obj.assign_target_info(**kwargs)
+            return obj
+
+        return await run_blocking(fetch, limiter=limiter)
+
     def assign_carton_info(self):
         """Assigns carton dependent information for cartons in targetdb.
 
@@ -108,16 +189,32 @@ class CartonInfo(object):
         parameters (parameters shared for all targets in the carton). These paraemters
         are mapper_label, program, version_pk, tag, mapper_pk, and category_pk.
         Finally it set in_targetdb attribute as True when found in the database.
+        If the object has a catalog the information is taken from it without querying
+        targetdb.
 
         """
 
         cfg = cartons_inventory.config
 
+        if self.catalog is not None:
+            res = self.catalog.lookup(self.carton, self.plan, self.category_label)
+            if res is not None:
+                for parameter in cfg['db_fields']['carton_dependent']:
+                    setattr(self, parameter, res[parameter])
+                self.carton_pk = res['carton_pk']
+                self.in_targetdb = True
+            else:
+                ver_info = self.catalog.version(self.plan)
+                if ver_info is not None:
+                    self.tag = ver_info['tag']
+                    self.version_pk = ver_info['pk']
+            return
+
         basic_info = (
             Car
             .select(Map.label.alias('mapper_label'), Car.version_pk.alias('version_pk'),
                     Car.category_pk.alias('category_pk'), Car.mapper_pk.alias('mapper_pk'),
-                    Version.tag, Car.program)
+                    Version.tag, Car.program, Car.pk.alias('carton_pk'))
             .join(Version, on=(Version.pk == Car.version_pk))
             .join(Categ, 'LEFT JOIN', Car.category_pk == Categ.pk)
             .join(Map, 'LEFT JOIN', Car.mapper_pk == Map.pk)
@@ -131,6 +228,7 @@ class CartonInfo(object):
             carton_parameter_names = cfg['db_fields']['carton_dependent']
             for parameter in carton_parameter_names:
                 setattr(self, parameter, res[parameter])
+            self.carton_pk = res['carton_pk']
             self.in_targetdb = True
 
         if self.in_targetdb is False:  # If not in targetdb still tries to get the Version info
@@ -144,37 +242,138 @@ class CartonInfo(object):
                 self.tag = ver_info['tag']
                 self.version_pk = ver_info['pk']
 
-    def build_query_target(self):
-        """Creates the query with the target dependet information of the carton."""
+    def build_query_target(self, sets=True, magnitudes=True, sample_fraction=None):
+        """Creates the query with the target dependet information of the carton.
+
+        The query only selects columns from targetdb.carton_to_target and targetdb.magnitude,
+        the labels in LABEL_FIELDS are attached afterwards from DimensionTables. Only the
+        columns needed for the requested information are selected, the target_columns of
+        db_fields['sets'] if ``sets`` is True and the magnitudes of the ``bands`` in the
+        configuration if ``magnitudes`` is True (otherwise targetdb.magnitude is not joined).
+        If ``sample_fraction`` is given only that fraction of the targets is selected (see
+        select_targets).
+
+        """
+
+        assert sets or magnitudes, 'at least one of sets or magnitudes has to be True'
+        columns = []
+        if sets:
+            sets_fields = cartons_inventory.config['db_fields']['sets']
+            columns += [TARGET_FIELDS[column].alias(column)
+                        for column in target_columns(sets_fields)]
+        if magnitudes:
+            bands = cartons_inventory.config['bands']
+            columns += [getattr(Mag, band) for key in bands.keys() for band in bands[key]]
+        query_target = self.select_targets(*columns, magnitudes=magnitudes,
+                                           sample_fraction=sample_fraction)
+
+        return query_target
+
+    def build_query_aggregate(self):
+        """Creates a query that aggregates the target dependent information in the database.
+
+        For each parameter in db_fields['sets'] the query returns an array with its distinct
+        values, and for each parameter in db_fields['set_ranges'] its minimum and maximum
+        (as <<parameter>>_min and <<parameter>>_max). The query returns a single row, so the
+        targets of the carton are never transferred from the database.
+
+        """
+
+        query_aggregate = self.select_targets(*aggregate_columns(), magnitudes=False)
+
+        return query_aggregate
+
+    def select_targets(self, *columns, magnitudes=True, sample_fraction=None):
+        """Creates a query selecting columns from the targets of the carton.
+
+        The targets are selected from targetdb.carton_to_target using the carton_pk of the
+        carton, or by carton name, plan and tag if carton_pk is None. The Magnitude table
+        is only joined if ``magnitudes`` is True. If ``sample_fraction`` is given, only the
+        targets whose pk hash (see SAMPLE_HASH) falls in that fraction of the hash range are
+        selected, a deterministic sample that works in any database and, unlike TABLESAMPLE
+        (which samples the pages of the whole carton_to_target table), still uses the
+        carton_pk index.
+
+        """
+
+        if self.carton_pk is not None:
+            query = CarTar.select(*columns).where(CarTar.carton_pk == self.carton_pk)
+            if sample_fraction is not None:
+                query = query.where(sample_condition(sample_fraction))
+            if magnitudes:
+                query = query.join(Mag, 'LEFT JOIN', CarTar.pk == Mag.carton_to_target_pk)
+            return query
 
-        query_target = (
+        query = (
             Car
-            .select(Inst.label.alias('instrument_label'), CarTar.cadence_pk.alias('cadence_pk'),
-                    CarTar.lambda_eff, CarTar.instrument_pk.alias('instrument_pk'),
-                    CarTar.priority, CarTar.value, Cad.label.alias('cadence_label'), Mag.g, Mag.r,
-                    Mag.i, Mag.z, Mag.h, Mag.j, Mag.k, Mag.bp, Mag.rp, Mag.gaia_g)
+            .select(*columns)
             .join(Version, on=(Version.pk == Car.version_pk))
             .join(CarTar, on=(CarTar.carton_pk == Car.pk))
-            .join(Cad, 'LEFT JOIN', on=(Cad.pk == CarTar.cadence_pk))
-            .join(Inst, 'LEFT JOIN', CarTar.instrument_pk == Inst.pk)
-            .join(Mag, 'LEFT JOIN', CarTar.pk == Mag.carton_to_target_pk)
+        )
+        if magnitudes:
+            query = query.join(Mag, 'LEFT JOIN', CarTar.pk == Mag.carton_to_target_pk)
+        if sample_fraction is not None:
+            query = query.where(sample_condition(sample_fraction))
+
+        return (
+            query
             .where(Car.carton == self.carton)
             .where((Version.plan == self.plan) & (Version.tag == self.tag))
         )
 
-        return query_target
+    def return_target_dataframe(self, labels=True, sets=True, magnitudes=True,
+                                sample_fraction=None):
+        """Executes query from build_query_target and returns it in a Pandas DataFrame.
+
+        ``sets``, ``magnitudes``, and ``sample_fraction`` are passed to build_query_target.
+        If ``labels`` is True the columns in LABEL_FIELDS are added with attach_labels.
 
-    def return_target_dataframe(self):
-        """Executes query from build_query_target and returns it in a Pandas DataFrame."""
+        """
 
         if not self.in_targetdb:
             print(self.carton, 'not in targetdb so we cant return the target dataframe')
             return
-        target_query = self.build_query_target()
-        df = pd.DataFrame(list(target_query.dicts()))
+        target_query = self.build_query_target(sets=sets, magnitudes=magnitudes,
+                                               sample_fraction=sample_fraction)
+        with metrics.stage('target_query'):
+            cursor = target_query._database.execute(target_query)
+            rows = cursor.fetchall()
+        metrics.add_rows(len(rows))
+        with metrics.stage('dataframe'):
+            df = records_to_dataframe(rows, [col[0] for col in cursor.description])
+            if labels:
+                attach_labels(df)
         return df
 
-    def assign_target_info(self, calculate_sets=True, calculate_mag_placeholders=False):
+    async def areturn_target_dataframe(self, limiter=None):
+        """Asynchronous version of return_target_dataframe that runs it with run_blocking."""
+        return await run_blocking(self.return_target_dataframe, limiter=limiter)
+
+    def iter_target_chunks(self, chunk_size=100000, labels=True, sets=True, magnitudes=True,
+                           sample_fraction=None):
+        """Executes query from build_query_target and yields it in Pandas DataFrame chunks.
+
+        The rows are fetched with iter_query_chunks, so at most chunk_size targets are held
+        in memory at a time. ``sets``, ``magnitudes``, and ``sample_fraction`` are passed to
+        build_query_target. If ``labels`` is True the columns in LABEL_FIELDS are added to each
+        chunk with attach_labels.
+
+        """
+
+        if not self.in_targetdb:
+            print(self.carton, 'not in targetdb so we cant return the target chunks')
+            return
+        query_target = self.build_query_target(sets=sets, magnitudes=magnitudes,
+                                               sample_fraction=sample_fraction)
+        for chunk in iter_query_chunks(query_target, chunk_size=chunk_size):
+            if labels:
+                with metrics.stage('dataframe'):
+                    attach_labels(chunk)
+            yield chunk
+
+    def assign_target_info(self, calculate_sets=True, calculate_mag_placeholders=False,
+                           mode='dataframe', chunk_size=100000, n_processes=None,
+                           sample_fraction=None, calculate_sketches=False):
         """Assignt target dependent information for cartons in targetdb.
 
         This function calls return_target_dataframe to get a Pandas DataFrame
@@ -195,48 +394,113 @@ class CartonInfo(object):
             check_mag_outliers function, and sets mag_placeholers_calculated=True to keep record.
             magnitude_placeholres is a set with all the combination of photometric system
             (SDSS, TMASS, GAIA) and mag placeholder used for that photometric system in that
-            carton (None, Invalid, 0.0, -9999.0, 999, 99.9).
-
+            carton (None, Invalid, 0.0, -9999.0, 999, 99.9). It also assigns the attribute
+            magnitude_placeholder_counts, a dictionary with the number of targets of the carton
+            with each of those placeholders.
+        mode : str
+            ``dataframe`` (default) to retrieve all the targets of the carton in a DataFrame and
+            calculate the sets and ranges in python, ``sql`` to calculate the sets and ranges
+            in the database with the query from build_query_aggregate and to classify the
+            magnitudes in the database with build_query_placeholders, so only a few rows are
+            transferred, or ``stream`` to retrieve the targets in chunks of chunk_size rows
+            with iter_target_chunks and accumulate the results with a TargetAccumulator, so
+            memory usage does not depend on the size of the carton, or ``shared`` to retrieve
+            all the targets and calculate the sets and placeholders in a pool of processes
+            with TargetAccumulator.update_shared, to use several cores on a big carton.
+        chunk_size : int
+            Number of targets per chunk when mode=``stream``.
+        n_processes : int or None
+            Number of processes used when mode=``shared``. If None, the number of CPUs.
+        sample_fraction : float or None
+            If present (between 0 and 1) only this fraction of the targets is retrieved (see
+            select_targets) to get a quick approximate result. In this case the attribute
+            approximate is set to True, and n_targets and magnitude_placeholder_counts are
+            estimated dividing by sample_fraction. Not available for mode=``sql``.
+        calculate_sketches : bool
+            If true this function assigns the attribute sketches, with a mergeable
+            DistributionSketch of the values of each target column in ``sketches['columns']``
+            and of the valid magnitudes of each band, calculated in the same pass over the
+            targets as the sets. Not available for mode=``sql``. With sample_fraction the
+            sketches describe the sample.
 
         """
-        dataframe_created = False
+        assert mode in ['dataframe', 'sql', 'stream', 'shared'], f'{mode!r} is not a valid'\
+            ' option for mode parameter'
+        assert sample_fraction is None or (0 < sample_fraction <= 1 and mode != 'sql'), \
+            'sample_fraction has to be between 0 and 1 and mode can not be sql'
+        assert calculate_sketches is False or mode != 'sql', 'calculate_sketches=True is not'\
+            ' available for mode=\'sql\''
+
         if not self.in_targetdb:
             print('carton', self.carton, 'version_pk', self.version_pk,
                   'category_label', self.category_label, 'not found in database',
                   'so we cant assign target info')
             return
 
-        if calculate_sets:
-            if self.sets_calculated:
-                print('Sets already calculated for this carton')
-            else:
-                dataframe = self.return_target_dataframe()
-                dataframe_created = True
-                target_parameters = self.cfg['db_fields']
-                set_names = target_parameters['sets']
-                set_range_names = target_parameters['set_ranges']
-
-                for set_name in set_names:
-                    setattr(self, set_name, main.set_or_none(dataframe[set_name]))
-                for set_name in set_range_names:
-                    set_range = main.get_range(getattr(self, set_name))
-                    setattr(self, set_name + '_min', set_range[0])
-                    setattr(self, set_name + '_max', set_range[1])
-                self.sets_calculated = True
+        if calculate_sets and self.sets_calculated:
+            print('Sets already calculated for this carton')
+            calculate_sets = False
+        if calculate_mag_placeholders and self.mag_placeholders_calculated:
+            print('Magnitude placeholders already caclulated for this carton')
+            calculate_mag_placeholders = False
+        if calculate_sketches and self.sketches_calculated:
+            print('Sketches already calculated for this carton')
+            calculate_sketches = False
+
+        if mode == 'sql':
+            with metrics.stage('aggregate_query'):
+                if calculate_sets:
+                    self.assign_aggregated_info(self.build_query_aggregate().dicts().get())
+                if calculate_mag_placeholders:
+                    assign_target_info_batch([self], calculate_sets=False,
+                                             calculate_mag_placeholders=True)
+            return
 
-        if calculate_mag_placeholders:
-            if self.mag_placeholders_calculated:
-                print('Magnitude placeholders already caclulated for this carton')
+        if calculate_sets or calculate_mag_placeholders or calculate_sketches:
+            accumulator = TargetAccumulator(calculate_sets=calculate_sets,
+                                            calculate_mag_placeholders=calculate_mag_placeholders,
+                                            calculate_sketches=calculate_sketches)
+            # Only the columns needed for the requested information are retrieved
+            columns = {'labels': False, 'sets': calculate_sets or calculate_sketches,
+                       'magnitudes': calculate_mag_placeholders or calculate_sketches,
+                       'sample_fraction': sample_fraction}
+            if mode == 'stream':
+                for chunk in self.iter_target_chunks(chunk_size=chunk_size, **columns):
+                    accumulator.update(chunk)
+            elif mode == 'shared':
+                accumulator.update_shared(self.return_target_dataframe(**columns),
+                                          n_processes=n_processes)
             else:
-                if not dataframe_created:
-                    dataframe = self.return_target_dataframe()
-                    dataframe_created = True
-                bands = self.cfg['bands']
-                mags_names = [el for key in bands.keys() for el in bands[key]]
-                systems_names = [key for key in bands.keys() for el in bands[key]]
-                self.magnitude_placeholders = check_mag_outliers(dataframe, mags_names,
-                                                                 systems_names)
-                self.mag_placeholders_calculated = True
+                accumulator.update(self.return_target_dataframe(**columns))
+            accumulator.assign(self)
+            self.n_targets = accumulator.n_rows
+
+            if sample_fraction is not None:
+                self.approximate = True
+                self.n_targets = int(round(self.n_targets / sample_fraction))
+                if calculate_mag_placeholders:
+                    self.magnitude_placeholder_counts = {
+                        key: int(round(count / sample_fraction))
+                        for key, count in self.magnitude_placeholder_counts.items()}
+
+    def assign_aggregated_info(self, res):
+        """Assigns the sets and ranges from a row returned by build_query_aggregate.
+
+        If ``res`` is None (i.e. the carton has no targets) all the sets and ranges are None.
+
+        """
+
+        target_parameters = cartons_inventory.config['db_fields']
+        res = res or {}
+        values = {column: res.get(column) or [] for column in
+                  target_columns(target_parameters['sets'])}
+        values = add_label_values(values, target_parameters['sets'])
+        for set_name in target_parameters['sets']:
+            setattr(self, set_name, main.set_or_none(values[set_name]))
+        for set_name in target_parameters['set_ranges']:
+            setattr(self, set_name + '_min', res.get(set_name + '_min'))
+            setattr(self, set_name + '_max', res.get(set_name + '_max'))
+        self.sets_calculated = True
 
     def check_existence(self, log, verbose=True):
         """Checks if the carton/plan/category_label from object is found in targetdb.
@@ -280,14 +544,17 @@ class CartonInfo(object):
                 locals()[colname] = []
                 locals()[colname].append(getattr(self, colname))
 
-            alternatives_info = (
-                Car
-                .select(Car.carton, Version.plan, Car.version_pk.alias('version_pk'),
-                        Categ.label.alias('category_label'), Version.tag, Car.program)
-                .join(Version, on=(Version.pk == Car.version_pk))
-                .join(Categ, 'LEFT JOIN', Car.category_pk == Categ.pk)
-                .where(Car.carton == self.carton).dicts()
-            )
+            if self.catalog is not None:
+                alternatives_info = self.catalog.alternatives(self.carton)
+            else:
+                alternatives_info = (
+                    Car
+                    .select(Car.carton, Version.plan, Car.version_pk.alias('version_pk'),
+                            Categ.label.alias('category_label'), Version.tag, Car.program)
+                    .join(Version, on=(Version.pk == Car.version_pk))
+                    .join(Categ, 'LEFT JOIN', Car.category_pk == Categ.pk)
+                    .where(Car.carton == self.carton).dicts()
+                )
             if len(alternatives_info) == 0:
                 msg = 'Wargning: Carton' + self.carton + ' not in targetdb'\
                     'not in targetdb and there is no carton with that name'
@@ -300,7 +567,7 @@ class CartonInfo(object):
                        + self.stage.rjust(6) + ' | ' + self.active.rjust(6) + ' | '\
                        + '--> Replace this line\n'
                 for ind in range(len(alternatives_info)):
-                    res = alternatives_info[ind]
+                    res = dict(alternatives_info[ind])
                     res['stage'], res['active'] = 'N/A', 'N/A'
                     for colname in colnames[:-1]:
                         locals()[colname].append(res[colname])
@@ -315,6 +582,10 @@ class CartonInfo(object):
         df = pd.DataFrame(data=df_data)
         return df
 
+    async def acheck_existence(self, log, verbose=True, limiter=None):
+        """Asynchronous version of check_existence that runs it with run_blocking."""
+        return await run_blocking(self.check_existence, log, verbose=verbose, limiter=limiter)
+
     def visualize_content(self, log, width=140):
         """Logs and prints information from targetdb for a given carton."""
 
@@ -362,39 +633,772 @@ class CartonInfo(object):
             print_centered_msg('MAGNITUDE PLACEHOLDERS PER PHOTOMETRIC SYSTEM', width, log)
             print_centered_msg(' ', width, log)
             self.print_param('magnitude_placeholders', width, log)
+            self.print_param('magnitude_placeholder_counts', width, log)
             log.info('#' * width)
 
     def print_param(self, par, width, log):
         """logs a message with width=width containing a parameter from carton object."""
-        log.info('### ' + par + ': ' + str(getattr(self, par)).ljust(width - len(par) - 10) +
-                 ' ###')
+        # The value is only converted to str when the message is formatted by the handlers
+        log.info('### %s: %-*s ###', par, max(width - len(par) - 10, 0), getattr(self, par))
 
     def print_range(self, par, width, log):
         """logs a message with width=width containing the range of a parameter from the carton."""
-        left_msg = str(getattr(self, par + '_min'))
-        right_msg = str(getattr(self, par + '_max'))
-        log.info('### ' + par + ' range: ' + left_msg + ' to ' + right_msg +
-                 ' ' * (width - len(left_msg) - len(right_msg) - len(par) - 20) + ' ###')
+        # Only the padding is computed here, the message is formatted by the handlers
+        left = getattr(self, par + '_min')
+        log.info('### %s range: %s to %-*s ###', par, left,
+                 max(width - len(str(left)) - len(par) - 20, 0), getattr(self, par + '_max'))
 
 
 def print_centered_msg(st, width, log):
     """Logs and prints string st with width=width in the log"""
     left = round((width - len(st) - 7) / 2.0)
     right = width - len(st) - 7 - left
-    log.info('###' + ' ' * left + st + ' ' * right + ' ###')
+    log.info('###%*s%s%*s ###', max(left, 0), '', st, max(right, 0), '')
+
+
+class TargetAccumulator(object):
+    """Accumulates the target dependent information of a carton from chunks of targets.
+
+    Each chunk is a Pandas DataFrame with the columns of build_query_target. The accumulator
+    only keeps the distinct values of the target_columns of db_fields['sets'] (the labels in
+    LABEL_FIELDS are attached to the distinct pks in assign) and the number of
+    targets with each magnitude placeholder found by count_mag_outliers, and optionally the
+    sketches from new_sketches, so its size does not depend on the number of targets.
+    Accumulators of different chunks of the same carton can be combined with merge.
+
+    Parameters
+    ----------
+
+    calculate_sets : bool
+        If True the distinct values of the parameters in db_fields['sets'] are accumulated.
+    calculate_mag_placeholders : bool
+        If True the magnitude placeholders of the bands in the configuration are accumulated.
+    calculate_sketches : bool
+        If True the sketches of the target columns in ``sketches['columns']`` and of the
+        valid magnitudes of the bands are accumulated.
+    dimensions : DimensionTables or None
+        Tables used to get the labels in LABEL_FIELDS. If None, DimensionTables.get().
+
+    """
+
+    def __init__(self, calculate_sets=True, calculate_mag_placeholders=False,
+                 calculate_sketches=False, dimensions=None):
+        cfg = cartons_inventory.config
+        self.calculate_sets = calculate_sets
+        self.calculate_mag_placeholders = calculate_mag_placeholders
+        self.calculate_sketches = calculate_sketches
+
+        self.dimensions = dimensions
+        self.set_names = target_columns(cfg['db_fields']['sets']) if calculate_sets else []
+        self.values = {set_name: set() for set_name in self.set_names}
+
+        bands = cfg['bands']
+        self.bands = [el for key in bands.keys() for el in bands[key]]
+        self.systems = [key for key in bands.keys() for el in bands[key]]
+        self.placeholder_counts = Counter()
+        self.sketches = new_sketches() if calculate_sketches else {}
+        self.n_rows = 0
+
+    def update(self, chunk):
+        """Adds the targets in a DataFrame chunk to the accumulated information."""
+
+        if chunk is None or len(chunk) == 0:
+            return
+        self.n_rows += len(chunk)
+        with metrics.stage('sets'):
+            for set_name in self.set_names:
+                self.values[set_name].update(pd.unique(chunk[set_name]).tolist())
+        with metrics.stage('mag_placeholders'):
+            if self.calculate_mag_placeholders or self.calculate_sketches:
+                mags, null = magnitude_arrays(chunk, self.bands)
+            if self.calculate_mag_placeholders:
+                self.placeholder_counts.update(count_outliers(mags, null, self.systems))
+        if self.calculate_sketches:
+            with metrics.stage('sketches'):
+                self.update_sketches(chunk, mags)
+
+    def update_sketches(self, chunk, mags):
+        """Adds the target columns of a chunk and its magnitude array to the sketches.
+
+        Only the valid magnitudes are added, i.e. not the placeholders of count_outliers.
+
+        """
+
+        for name in cartons_inventory.config['sketches']['columns']:
+            self.sketches[name].update(pd.to_numeric(chunk[name]).to_numpy(dtype=float))
+        valid = np.isfinite(mags) & (mags >= -9) & (mags <= 50) & (mags != 0)
+        for ind_band, band in enumerate(self.bands):
+            self.sketches[band].update(mags[valid[:, ind_band], ind_band])
+
+    def update_shared(self, chunk, n_processes=None):
+        """Adds the targets in a DataFrame chunk using a pool of processes.
+
+        The columns needed are copied once to shared memory with SharedTargets, and each of
+        the n_processes processes (by default the number of CPUs) reads a slice of rows from
+        the shared memory blocks without copying them, returning the distinct values and
+        placeholder counts of its slice with accumulate_shared_slice. The results of all
+        the slices are added to the accumulator, so the result is the same of update. The
+        sketches are updated in this process.
+
+        """
+
+        if chunk is None or len(chunk) == 0:
+            return
+        n_processes = n_processes or os.cpu_count()
+        n_slices = min(n_processes, len(chunk))
+        bounds = np.linspace(0, len(chunk), n_slices + 1).astype(int)
+        bands = self.bands if self.calculate_mag_placeholders else []
+
+        with metrics.stage('shared_accumulate'):
+            with SharedTargets(chunk, self.set_names, bands) as shared:
+                with ProcessPoolExecutor(max_workers=n_slices) as executor:
+                    results = executor.map(accumulate_shared_slice, [shared.spec] * n_slices,
+                                           bounds[:-1], bounds[1:], [self.systems] * n_slices)
+                    for uniques, counts in results:
+                        for set_name in self.set_names:
+                            self.values[set_name].update(shared.decode(set_name,
+                                                                       uniques[set_name]))
+                        self.placeholder_counts.update(counts)
+        if self.calculate_sketches:
+            with metrics.stage('sketches'):
+                self.update_sketches(chunk, magnitude_arrays(chunk, self.bands)[0])
+        self.n_rows += len(chunk)
+
+    def merge(self, other):
+        """Adds the information accumulated by other TargetAccumulator to this one."""
+
+        self.n_rows += other.n_rows
+        for set_name in self.set_names:
+            self.values[set_name] |= other.values[set_name]
+        self.placeholder_counts.update(other.placeholder_counts)
+        merge_sketches(self.sketches, other.sketches)
+
+    def assign(self, obj):
+        """Assigns the accumulated information to a CartonInfo object.
+
+        The attributes are the same set by CartonInfo.assign_target_info.
+
+        """
+
+        if self.calculate_sets:
+            sets = cartons_inventory.config['db_fields']['sets']
+            values = add_label_values(self.values, sets, dimensions=self.dimensions)
+            for set_name in sets:
+                setattr(obj, set_name, main.set_or_none(values[set_name]))
+            for set_name in cartons_inventory.config['db_fields']['set_ranges']:
+                set_range = main.get_range(getattr(obj, set_name))
+                setattr(obj, set_name + '_min', set_range[0])
+                setattr(obj, set_name + '_max', set_range[1])
+            obj.sets_calculated = True
+        if self.calculate_mag_placeholders:
+            obj.magnitude_placeholders = main.set_or_none(self.placeholder_counts)
+            obj.magnitude_placeholder_counts = sort_placeholder_counts(self.placeholder_counts)
+            obj.mag_placeholders_calculated = True
+        if self.calculate_sketches:
+            obj.sketches = self.sketches
+            obj.sketches_calculated = True
+
+
+class SharedTargets(object):
+    """Stores the target columns of a carton in multiprocessing.shared_memory blocks.
+
+    This way the processes of a pool can read the targets without copying them, since only
+    the names, shapes, and dtypes of the blocks (the ``spec`` attribute) are sent to them.
+    Numeric columns are stored as they are, object columns (e.g. labels or numbers with NULL
+    values) as the codes from pd.factorize (-1 for NULL values), and the magnitudes of the
+    bands as the ``mags`` and ``null`` arrays from magnitude_arrays. Use it as a context
+    manager, so the blocks are released at exit.
+
+    Parameters
+    ----------
+
+    datafr : Pandas DataFrame
+        Targets of the carton with the columns of build_query_target.
+    set_names : list of str
+        Columns to store.
+    bands : list of str
+        Bands whose magnitudes are stored. If empty the magnitudes are not stored.
+
+    """
+
+    def __init__(self, datafr, set_names, bands):
+        self.blocks, self.spec, self.uniques = [], {}, {}
+        for set_name in set_names:
+            column = datafr[set_name].to_numpy()
+            if column.dtype.kind not in 'biuf':
+                column, self.uniques[set_name] = pd.factorize(column)
+            self.add(set_name, column)
+        if len(bands) > 0:
+            mags, null = magnitude_arrays(datafr, bands)
+            self.add('mags', mags)
+            self.add('null', null)
+
+    def add(self, name, array):
+        """Copies an array to a new shared memory block and adds it to spec."""
+
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.blocks.append(block)
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+        self.spec[name] = (block.name, array.shape, array.dtype.str)
+
+    def decode(self, set_name, values):
+        """Returns the list of values of a column from the distinct values of its array."""
+
+        if set_name not in self.uniques:
+            return values.tolist()
+        return [None if code < 0 else self.uniques[set_name][code] for code in values]
+
+    def close(self):
+        """Releases the shared memory blocks."""
+
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def accumulate_shared_slice(spec, start, stop, systems):
+    """Returns the distinct values and placeholder counts of a slice of SharedTargets rows.
+
+    Parameters
+    ----------
+
+    spec : dict
+        The ``spec`` attribute of a SharedTargets object.
+    start, stop : int
+        First and last (not included) rows of the slice.
+    systems : list of str
+        Photometric system of each band stored in SharedTargets.
+
+    Returns
+    -------
+
+    uniques : dict
+        Array with the distinct values in the slice of each stored column (except the
+        magnitudes), to be decoded with SharedTargets.decode.
+    counts : dict
+        Number of targets of the slice with each magnitude placeholder, as returned by
+        count_mag_outliers. Empty if the magnitudes are not stored.
+
+    """
+
+    blocks, arrays = [], {}
+    try:
+        for name, (block_name, shape, dtype) in spec.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            blocks.append(block)
+            arrays[name] = np.ndarray(shape, dtype, buffer=block.buf)[start:stop]
+        uniques = {name: np.unique(arrays[name]) for name in arrays
+                   if name not in ['mags', 'null']}
+        counts = {}
+        if 'mags' in arrays:
+            counts = count_outliers(arrays['mags'], arrays['null'], systems)
+    finally:
+        # The views have to be released before closing the blocks
+        arrays.clear()
+        for block in blocks:
+            block.close()
+
+    return uniques, counts
+
+
+def sample_condition(sample_fraction):
+    """Returns the condition selecting a sample_fraction of targetdb.carton_to_target.
+
+    The targets are selected by a multiplicative hash of their pk (see SAMPLE_HASH), so the
+    sample is deterministic and spread over the whole carton.
+
+    """
+
+    multiplier, modulus = SAMPLE_HASH
+    # The % operator of peewee is LIKE, and a literal % can not be used with the parameters
+    # of psycopg, so PostgreSQL uses MOD (SQLite only has the % operator for integers)
+    if isinstance(CarTar.model._meta.database, PostgresqlDatabase):
+        def mod(lhs, rhs):
+            return fn.MOD(lhs, rhs)
+    else:
+        def mod(lhs, rhs):
+            return Expression(lhs, OP.MOD, rhs)
+    return mod(mod(CarTar.pk, modulus) * multiplier, modulus) < int(sample_fraction * modulus)
+
+
+def target_columns(set_names):
+    """Returns the columns of TARGET_FIELDS needed to calculate the sets of set_names.
+
+    The parameters in LABEL_FIELDS are replaced by the column with their pk.
+
+    """
+
+    columns = []
+    for set_name in set_names:
+        column = LABEL_FIELDS[set_name][0] if set_name in LABEL_FIELDS else set_name
+        if column not in columns:
+            columns.append(column)
+    return columns
+
+
+def add_label_values(values, set_names, dimensions=None):
+    """Returns the distinct values of set_names from the distinct values of target_columns.
+
+    Parameters
+    ----------
+
+    values : dict
+        Iterable with the distinct values of each of the target_columns of set_names.
+    set_names : list of str
+        Target dependent parameters (e.g. db_fields['sets']).
+    dimensions : DimensionTables or None
+        Tables with the labels of the parameters in LABEL_FIELDS. If None,
+        DimensionTables.get(), which is only loaded if set_names has labels.
+
+    Returns
+    -------
+
+    values : dict
+        Copy of ``values`` with the list of distinct labels of each parameter in both
+        set_names and LABEL_FIELDS.
+
+    """
+
+    values = dict(values)
+    for set_name in set_names:
+        if set_name in LABEL_FIELDS:
+            column, table = LABEL_FIELDS[set_name]
+            dimensions = dimensions or DimensionTables.get()
+            values[set_name] = dimensions.labels(table, values[column])
+    return values
+
+
+def attach_labels(datafr, dimensions=None):
+    """Adds the columns of LABEL_FIELDS in db_fields['sets'] to a DataFrame of targets.
+
+    The labels are taken from ``dimensions`` (by default DimensionTables.get()) using the
+    pk columns of the DataFrame. Labels whose pk column is not in the DataFrame are skipped.
+
+    """
+
+    for set_name in cartons_inventory.config['db_fields']['sets']:
+        if set_name in LABEL_FIELDS and LABEL_FIELDS[set_name][0] in datafr:
+            column, table = LABEL_FIELDS[set_name]
+            dimensions = dimensions or DimensionTables.get()
+            datafr[set_name] = dimensions.label_column(table, datafr[column])
+
+
+def iter_query_chunks(query, chunk_size=100000):
+    """Executes a query and yields its results in Pandas DataFrame chunks of chunk_size rows.
+
+    In PostgreSQL the query is executed with a server-side (named) cursor inside a
+    transaction, so the database only sends chunk_size rows at a time. In other databases a
+    regular cursor is read with fetchmany.
+
+    """
+
+    database = query._database
+    sql, params = query.sql()
+    with database.atomic():
+        if isinstance(database, PostgresqlDatabase):
+            cursor = database.connection().cursor(name='cartons_inventory_' + uuid.uuid4().hex)
+            cursor = profiling.wrap_cursor(cursor)
+        else:
+            cursor = database.cursor()
+        try:
+            with metrics.stage('target_query'):
+                cursor.execute(sql, params)
+            while True:
+                with metrics.stage('target_query'):
+                    rows = cursor.fetchmany(chunk_size)
+                if len(rows) == 0:
+                    break
+                metrics.add_rows(len(rows))
+                columns = [col[0] for col in cursor.description]
+                with metrics.stage('dataframe'):
+                    chunk = records_to_dataframe(rows, columns)
+                yield chunk
+        finally:
+            cursor.close()
+
+
+def records_to_dataframe(rows, columns):
+    """Creates a Pandas DataFrame from the rows returned by a query, keeping NULLs as None.
+
+    Numeric columns without NULL values are stored as numeric arrays. The rest of columns are
+    stored with object dtype, so NULL values stay as None instead of being converted to NaN,
+    which would make check_mag_outliers report empty magnitudes as Invalid.
+
+    """
+
+    if len(rows) == 0:
+        return pd.DataFrame(columns=columns)
+
+    data = {}
+    for name, values in zip(columns, zip(*rows)):
+        array = np.array(values)
+        if array.dtype.kind not in 'biuf':
+            array = pd.Series(np.array(values, dtype=object), dtype=object)
+        data[name] = array
+
+    return pd.DataFrame(data, columns=columns)
+
+
+def iter_assign_target_info(objects, max_workers=1, **kwargs):
+    """Runs CartonInfo.assign_target_info on objects and yields them in the same order.
+
+    With max_workers > 1 the objects are processed concurrently in a pool of max_workers
+    threads. Peewee keeps one database connection per thread, so each worker queries the
+    database with its own connection, which is reused for all the objects it processes and
+    closed once all the objects have been processed (or the generator is closed). Objects are
+    yielded as soon as they and all the previous ones have been processed, so the caller can
+    log and write them in input order while the rest are processed.
+
+    Parameters
+    ----------
+
+    objects : list of CartonInfo
+        Objects to which the target information is assigned.
+    max_workers : int
+        Number of threads to use. With 1 the objects are processed sequentially.
+    kwargs : dict
+        Parameters passed to CartonInfo.assign_target_info.
+
+    """
+
+    def assign(obj):
+        with metrics.carton(obj.carton, obj.plan, obj.category_label):
+            obj.assign_target_info(**kwargs)
+        return obj
+
+    if max_workers <= 1:
+        for obj in objects:
+            yield assign(obj)
+        return
+
+    database = Car.model._meta.database
+    tasks = queue.SimpleQueue()
+
+    def work():
+        # Processes objects until there are none left and then closes the connection of its
+        # thread, which was used for all of them. Tasks cancelled by the caller are skipped
+        try:
+            while True:
+                try:
+                    future, context, obj = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(context.run(assign, obj))
+                    except BaseException as error:
+                        future.set_exception(error)
+        finally:
+            database.close()
+
+    # Each object is processed in a copy of the context of the caller, so the metrics of the
+    # run are also recorded in the threads
+    futures = []
+    for obj in objects:
+        futures.append(Future())
+        tasks.put((futures[-1], contextvars.copy_context(), obj))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for _ in range(max_workers):
+            executor.submit(work)
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            # If the generator is closed or a carton fails the rest are not processed
+            for future in futures:
+                future.cancel()
+
+
+async def run_blocking(func, *args, limiter=None, **kwargs):
+    """Runs a blocking function in the default executor of the running event loop.
+
+    ``func`` is called with ``args`` and ``kwargs`` in a worker thread and its result is
+    returned once it finishes, so the event loop keeps running while ``func`` queries the
+    database. The database connection of the worker thread is closed after the call.
+
+    Parameters
+    ----------
+
+    func : callable
+        Blocking function to run.
+    limiter : asyncio.Semaphore or None
+        If present, it is acquired while func runs, so it limits the number of calls in flight
+        among all the calls sharing it.
+
+    """
+
+    database = Car.model._meta.database
+
+    def call():
+        try:
+            return func(*args, **kwargs)
+        finally:
+            database.close()
+
+    loop = asyncio.get_running_loop()
+    if limiter is None:
+        return await loop.run_in_executor(None, call)
+    async with limiter:
+        return await loop.run_in_executor(None, call)
+
+
+def aggregate_columns():
+    """Returns the aggregate expressions for the target dependent parameters.
+
+    For each of the target_columns of db_fields['sets'] an array with its distinct values
+    (the labels in LABEL_FIELDS are attached by CartonInfo.assign_aggregated_info), and for
+    each parameter in db_fields['set_ranges'] its minimum and maximum, aliased as
+    <<parameter>>_min and <<parameter>>_max.
+
+    """
+
+    pars = cartons_inventory.config['db_fields']
+    columns = [fn.array_agg(fn.DISTINCT(TARGET_FIELDS[par])).alias(par)
+               for par in target_columns(pars['sets'])]
+    for par in pars['set_ranges']:
+        columns += [fn.MIN(TARGET_FIELDS[par]).alias(par + '_min'),
+                    fn.MAX(TARGET_FIELDS[par]).alias(par + '_max')]
+
+    return columns
+
+
+def build_query_aggregate_batch(carton_pks):
+    """Creates a query with the aggregate_columns of each carton in carton_pks.
+
+    The query groups targetdb.carton_to_target by carton_pk, so it returns one row per
+    carton with targets, with the carton_pk and the columns from aggregate_columns.
+
+    """
+
+    query_batch = (
+        CarTar
+        .select(CarTar.carton_pk.alias('carton_pk'), *aggregate_columns())
+        .where(CarTar.carton_pk.in_(carton_pks))
+        .group_by(CarTar.carton_pk)
+    )
+
+    return query_batch
+
+
+def build_query_placeholders(carton_pks):
+    """Creates a query classifying the magnitudes of the cartons in carton_pks in the database.
+
+    For each band in the ``bands`` section of the configuration the query has two columns,
+    <<band>>_kind with 1 for empty magnitudes, 2 for invalid ones (NaN or infinite) and 0
+    otherwise, and <<band>>_placeholder with the magnitude if it is a placeholder (i.e. a
+    valid magnitude brighter than -9, dimmer than 50, or equal to zero) and NULL otherwise,
+    following the criteria of check_mag_outliers. The query is grouped by carton_pk and all
+    these columns, with the number of targets of each group in column n_targets, so it only
+    returns a few rows per carton and the number of targets with each placeholder can be
+    obtained without retrieving the targets.
+
+    """
+
+    bands = cartons_inventory.config['bands']
+    invalid_values = [float('nan'), float('inf'), float('-inf')]
+    columns = []
+    for band in [el for key in bands.keys() for el in bands[key]]:
+        mag = getattr(Mag, band)
+        invalid = mag.in_(invalid_values)
+        placeholder = (mag < -9) | (mag > 50) | (mag == 0)
+        columns.append(Case(None, [(mag.is_null(), 1), (invalid, 2)], 0).alias(band + '_kind'))
+        columns.append(Case(None, [(invalid, None), (placeholder, mag)], None)
+                       .alias(band + '_placeholder'))
+
+    # The grouping uses the position of the columns so the CASE expressions are not repeated
+    query_placeholders = (
+        CarTar
+        .select(CarTar.carton_pk.alias('carton_pk'), *columns,
+                fn.COUNT(SQL('*')).alias('n_targets'))
+        .join(Mag, 'LEFT JOIN', on=(CarTar.pk == Mag.carton_to_target_pk))
+        .where(CarTar.carton_pk.in_(carton_pks))
+        .group_by(*[SQL(str(position)) for position in range(1, len(columns) + 2)])
+    )
+
+    return query_placeholders
+
+
+def build_query_fingerprints(carton_pks):
+    """Creates a query with the number of targets and maximum pk of each carton in carton_pks.
+
+    The query groups targetdb.carton_to_target by carton_pk and returns the columns
+    carton_pk, n_targets, and max_pk, for each carton with targets.
+
+    """
+
+    query_fingerprints = (
+        CarTar
+        .select(CarTar.carton_pk.alias('carton_pk'), fn.COUNT(CarTar.pk).alias('n_targets'),
+                fn.MAX(CarTar.pk).alias('max_pk'))
+        .where(CarTar.carton_pk.in_(carton_pks))
+        .group_by(CarTar.carton_pk)
+    )
+
+    return query_fingerprints
+
+
+def assign_fingerprints(objects, chunk_size=500):
+    """Assigns the fingerprint attribute of a list of CartonInfo objects.
+
+    The fingerprint of each carton is its number of targets, its maximum
+    targetdb.carton_to_target pk, and its tag, separated by ``:``. They are obtained with a
+    single query from build_query_fingerprints per chunk of chunk_size cartons, so they can
+    be used to check cheaply which cartons changed since a previous run. Objects not in
+    targetdb are skipped.
+
+    """
+
+    objects_by_pk = {}
+    for obj in objects:
+        if obj.in_targetdb:
+            objects_by_pk.setdefault(obj.carton_pk, []).append(obj)
+    carton_pks = list(objects_by_pk.keys())
+
+    for start in range(0, len(carton_pks), chunk_size):
+        chunk = carton_pks[start:start + chunk_size]
+        results = {row['carton_pk']: row for row in build_query_fingerprints(chunk).dicts()}
+        for carton_pk in chunk:
+            res = results.get(carton_pk, {'n_targets': 0, 'max_pk': None})
+            for obj in objects_by_pk[carton_pk]:
+                obj.fingerprint = f'{res["n_targets"]}:{res["max_pk"]}:{obj.tag}'
+
+
+def placeholders_from_row(row):
+    """Returns the magnitude placeholders of a row from build_query_placeholders.
+
+    The placeholders are formatted as in check_mag_outliers (e.g. 'TMASS_None').
+
+    """
+
+    bands = cartons_inventory.config['bands']
+    placeholders = set()
+    for system in bands.keys():
+        for band in bands[system]:
+            if row[band + '_kind'] == 1:
+                placeholders.add(system + '_None')
+            elif row[band + '_kind'] == 2:
+                placeholders.add(system + '_Invalid')
+            elif row[band + '_placeholder'] is not None:
+                placeholders.add(system + '_' + str(float(row[band + '_placeholder'])))
+
+    return placeholders
+
+
+def assign_target_info_batch(objects, calculate_sets=True, calculate_mag_placeholders=False,
+                             chunk_size=500):
+    """Assigns target dependent information to a list of CartonInfo objects at once.
+
+    Instead of one query per carton, the cartons in targetdb are processed in chunks of
+    chunk_size carton_pks with a single grouped query per chunk from build_query_aggregate_batch
+    (if calculate_sets) and another from build_query_placeholders (if
+    calculate_mag_placeholders). This sets the same attributes as
+    CartonInfo.assign_target_info, but the running time scales with the total number of
+    targets instead of with the number of cartons.
+
+    Parameters
+    ----------
+
+    objects : list of CartonInfo
+        Objects to which the information is assigned. Objects not in targetdb are skipped.
+    calculate_sets : bool
+        If True assigns the sets and ranges of the target dependent parameters.
+    calculate_mag_placeholders : bool
+        If True assigns the magnitude_placeholders and magnitude_placeholder_counts of each
+        carton.
+    chunk_size : int
+        Maximum number of cartons included in each query.
+
+    """
+
+    objects_by_pk = {}
+    for obj in objects:
+        if obj.in_targetdb:
+            objects_by_pk.setdefault(obj.carton_pk, []).append(obj)
+    carton_pks = list(objects_by_pk.keys())
+
+    for start in range(0, len(carton_pks), chunk_size):
+        chunk = carton_pks[start:start + chunk_size]
+
+        if calculate_sets:
+            results = {row['carton_pk']: row
+                       for row in build_query_aggregate_batch(chunk).dicts()}
+            for carton_pk in chunk:
+                for obj in objects_by_pk[carton_pk]:
+                    if not obj.sets_calculated:
+                        obj.assign_aggregated_info(results.get(carton_pk))
+
+        if calculate_mag_placeholders:
+            counts = {carton_pk: Counter() for carton_pk in chunk}
+            for row in build_query_placeholders(chunk).dicts():
+                for placeholder in placeholders_from_row(row):
+                    counts[row['carton_pk']][placeholder] += row['n_targets']
+            for carton_pk in chunk:
+                for obj in objects_by_pk[carton_pk]:
+                    if not obj.mag_placeholders_calculated:
+                        obj.magnitude_placeholders = main.set_or_none(counts[carton_pk])
+                        obj.magnitude_placeholder_counts = sort_placeholder_counts(
+                            counts[carton_pk])
+                        obj.mag_placeholders_calculated = True
+
+
+def iter_carton_list(carton_list_filename, header_length=1, delimiter='|'):
+    """Yields the records of an input carton list file one line at a time.
+
+    The file has the format of the rsconfig and custom carton lists, with a header of
+    header_length lines followed by one line per carton with the fields carton, plan,
+    category, stage, and active separated (and optionally surrounded) by ``delimiter``.
+    Files ending in .gz are decompressed on the fly. Each line is split and stripped in a
+    single pass, empty lines are skipped, and lines without exactly five non empty fields
+    are skipped with a warning in the log that includes the line number.
+
+    Yields
+    ------
+
+    record : tuple
+        Tuple with the carton, plan, category, stage, and active of a line.
+
+    """
+
+    log = cartons_inventory.log
+    opener = gzip.open if carton_list_filename.endswith('.gz') else open
+    with opener(carton_list_filename, 'rt') as carton_list:
+        for line_number, line in enumerate(carton_list, start=1):
+            if line_number <= header_length:
+                continue
+            line = line.strip()
+            if line == '':
+                continue
+            if line.startswith(delimiter):
+                line = line[len(delimiter):]
+            if line.endswith(delimiter):
+                line = line[:-len(delimiter)]
+            record = tuple(field.strip() for field in line.split(delimiter))
+            if len(record) != 5 or '' in record:
+                log.warning(f'{carton_list_filename}:{line_number}: skipping malformed line '
+                            f'{line!r} (expected carton, plan, category, stage, and active)')
+                continue
+            yield record
 
 
 def gets_carton_info(carton_list_filename, header_length=1, delimiter='|'):
-    """Get the necessary information from the input carton list file."""
+    """Get the necessary information from the input carton list file.
 
-    cat = np.loadtxt(carton_list_filename, dtype='str',
-                     skiprows=header_length, delimiter=delimiter)
-    cartons = [str.strip(cat[ind, 1]) for ind in range(len(cat))]
-    plans = [str.strip(cat[ind, 2]) for ind in range(len(cat))]
-    categories = [str.strip(cat[ind, 3]) for ind in range(len(cat))]
-    stages = [str.strip(cat[ind, 4]) for ind in range(len(cat))]
-    actives = [str.strip(cat[ind, 5]) for ind in range(len(cat))]
-    return cartons, plans, categories, stages, actives
+    Returns lists with the cartons, plans, categories, stages, and actives of the records
+    from iter_carton_list.
+
+    """
+
+    records = list(iter_carton_list(carton_list_filename, header_length=header_length,
+                                    delimiter=delimiter))
+    return tuple([record[index] for record in records] for index in range(5))
 
 
 def check_mag_outliers(datafr, bands, systems):
@@ -427,33 +1431,118 @@ def check_mag_outliers(datafr, bands, systems):
 
 
     """
-    out_bands, out_systems = [], []
+    return main.set_or_none(count_mag_outliers(datafr, bands, systems))
+
+
+def count_mag_outliers(datafr, bands, systems):
+    """Returns the number of targets with each type of outlier for each photometric system.
+
+    Takes the same parameters of check_mag_outliers and returns a dictionary whose keys are
+    the strings of the set returned by check_mag_outliers (e.g. 'TMASS_None') and values are
+    the number of rows (targets) of datafr where at least one band of the photometric system
+    has that type of outlier. If no outliers are found the dictionary is empty.
+
+    """
+    mags, null = magnitude_arrays(datafr, bands)
+    return count_outliers(mags, null, systems)
+
+
+def count_outliers(mags, null, systems):
+    """Returns the number of targets with each type of outlier from the magnitude arrays.
+
+    Same as count_mag_outliers but taking the ``mags`` and ``null`` arrays returned by
+    magnitude_arrays instead of a DataFrame.
+
+    """
+    finite = np.isfinite(mags)
+    invalid = ~null & ~finite
+    outlier = finite & ((mags < -9) | (mags > 50) | (mags == 0))
+
+    counts = {}
+    systems = np.asarray(systems)
+    for system in dict.fromkeys(systems):
+        ind_system = systems == system
+        for name, mask in [('None', null), ('Invalid', invalid)]:
+            n_targets = int(np.count_nonzero(mask[:, ind_system].any(axis=1)))
+            if n_targets > 0:
+                counts[system + '_' + name] = n_targets
+
+        # Unique (target, outlier value) pairs, so we only format each outlier value once
+        # and targets with the same outlier in several bands are only counted once
+        ind_rows, ind_bands = np.nonzero(outlier[:, ind_system])
+        values = mags[:, ind_system][ind_rows, ind_bands]
+        pairs = np.unique(np.column_stack((ind_rows, values)), axis=0)
+        values, n_targets = np.unique(pairs[:, 1], return_counts=True)
+        for value, n_value in zip(values, n_targets):
+            counts[system + '_' + str(value)] = int(n_value)
+
+    return counts
+
+
+def sort_placeholder_counts(counts):
+    """Returns a copy of the placeholder counts in the order used by count_outliers.
+
+    The placeholders are sorted by photometric system (in the order of the ``bands`` section
+    of the configuration), with None and Invalid first followed by the numeric placeholders
+    in increasing order, so the counts accumulated over several chunks or query rows are
+    written in the same order for any mode.
+
+    """
+
+    systems = list(cartons_inventory.config['bands'].keys())
+
+    def key(placeholder):
+        system, _, name = placeholder.partition('_')
+        if name in ['None', 'Invalid']:
+            return systems.index(system), ['None', 'Invalid'].index(name), 0.0
+        return systems.index(system), 2, float(name)
+
+    return {placeholder: counts[placeholder] for placeholder in sorted(counts, key=key)}
+
+
+def magnitude_arrays(datafr, bands):
+    """Returns the magnitudes of a DataFrame as a float 2D array and a mask of empty values.
+
+    Parameters
+    ----------
+    datafr : Pandas DataFrame
+        Containing the magnitudes for the stars in a given carton.
+    bands : strings list
+        Containing the bands (columns of datafr) to use.
+
+    Returns
+    -------
+    mags : numpy array
+        Float array with shape (len(datafr), len(bands)) with the magnitudes, where
+        empty values (None) are NaN.
+    null : numpy array
+        Boolean array with the same shape of mags that is True for the empty values.
+
+    """
+    mags = np.empty((len(datafr), len(bands)))
+    null = np.zeros(mags.shape, dtype=bool)
     for ind_band in range(len(bands)):
-        maglist = datafr[bands[ind_band]]
-        nonempty_maglist = [el for el in maglist if el is not None]
-        magarr_filled = np.array(nonempty_maglist)
-        ind_valid = np.where(np.isfinite(magarr_filled))[0]
-        magarr_valid = magarr_filled[ind_valid]
-        ind_out = np.where((magarr_valid < -9) | (magarr_valid > 50) | (magarr_valid == 0))[0]
-        out_band = list(set([str(magarr_valid[indice]) for indice in ind_out]))
-        if len(maglist) > len(nonempty_maglist):
-            out_band.append('None')
-        if len(magarr_filled) > len(magarr_valid):
-            out_band.append('Invalid')
-        n_out = len(out_band)
-        out_bands = out_bands + out_band
-        out_systems = out_systems + [systems[ind_band]] * n_out
-    out = main.set_or_none([out_systems[idx] + '_' + out_bands[idx]
-                           for idx in range(len(out_bands))])
-    return out
+        column = datafr[bands[ind_band]].to_numpy()
+        if column.dtype == object:
+            # Only the (few) missing values need to be checked to tell None from NaN
+            ind_missing = np.flatnonzero(pd.isna(column))
+            null[ind_missing, ind_band] = [column[ind] is None for ind in ind_missing]
+            column = column.astype(float)
+        mags[:, ind_band] = column
+    return mags, null
 
 
+@metrics.isolated
 def process_cartons(origin='rsconfig', files_folder='./files/', inputname=None,
                     delim='|', check_exists=False, verb=False, return_objects=False,
                     write_input=False, write_output=False, assign_sets=False,
                     assign_placeholders=False, visualize=False, overwrite=False,
                     all_cartons=False, cartons_name_pattern=None, versions='latest',
-                    forced_versions=None, unique_version=None):
+                    forced_versions=None, unique_version=None, mode='dataframe',
+                    catalog=None, batch=False, max_workers=1, cache=None,
+                    output_format='csv', resume=False, refresh=False, sample_fraction=None,
+                    assign_sketches=False, collect_metrics=False, query_profile=False,
+                    explain_queries=0, log_format='text', log_mode='sync'):
     """Get targetdb information for list of cartons or selection criteria and outputs .csv file.
 
     Takes as input a file with a list of cartons from rsconfig (origin=``rsconfig``)
@@ -531,6 +1620,82 @@ def process_cartons(origin='rsconfig', files_folder='./files/', inputname=None,
     unique_version : Int or None
         If present, origin=targetdb, and versions=single then only this version_pk will be
         considered for each carton
+    mode : str
+        Passed to assign_target_info. ``dataframe`` calculates the sets and ranges in python
+        from a DataFrame with all the targets of each carton, ``sql`` calculates them in
+        the database (recommended for cartons with many targets), and ``stream`` retrieves
+        the targets in chunks to keep the memory usage bounded, and ``shared`` uses all the CPUs
+        to calculate the results of each carton.
+    catalog : CartonCatalog or None
+        Snapshot of the targetdb carton catalog used to select the cartons and to get their
+        carton dependent information and alternatives. If None it is loaded from targetdb with
+        CartonCatalog.load, so the cartons are resolved without one query per carton. The
+        DimensionTables used for the labels are loaded again at the start of each run.
+    batch : bool
+        If True the target information of all the cartons is assigned with
+        assign_target_info_batch, which uses a few grouped queries for all the cartons
+        instead of one query per carton. In this case ``mode`` is not used.
+    max_workers : int
+        Number of threads used to run assign_target_info on different cartons concurrently
+        (each with its own database connection) when batch=False. The results are still
+        logged, visualized and written in the order of the input cartons.
+    cache : ResultCache or None
+        If present, the target information of the cartons found in this cache is taken from
+        it instead of the database, and the information calculated for the rest of cartons is
+        saved in it.
+    output_format : str
+        Format of the output file when write_output=True. ``csv`` (default) writes a row per
+        carton with delimiter ``delim``, ``parquet`` and ``arrow`` (Arrow IPC file, requires
+        pyarrow) write a table with list columns for the sets that can be loaded without
+        parsing with output.read_output.
+    resume : bool
+        When write_output=True the target information of each carton is saved as soon as it
+        is processed in a checkpoint file (a ResultCache next to the output file, with
+        extension .checkpoint) that is removed when the output file is complete. If resume is
+        True and a checkpoint file of a previous unfinished run with the same output file is
+        found, the cartons in it are not processed again, the output file is overwritten even
+        if overwrite=False, and the log of the run is appended to the log of the previous run
+        instead of starting a new one.
+    refresh : bool
+        If True and write_output=True a ``fingerprint`` column is added to the output file (see
+        assign_fingerprints), and if the output file exists (from a previous run with
+        refresh=True) the cartons whose fingerprint did not change are not processed again,
+        and their target dependent columns are copied from the previous output file (which is
+        overwritten), while the input and carton dependent columns are updated. The objects
+        of these cartons don't have their target information assigned.
+    sample_fraction : float or None
+        If present it is passed to assign_target_info to get a quick approximate inventory
+        from a sample of the targets of each carton. The output file has the columns
+        approximate and n_targets (estimated), and the checkpoint and cache are not used.
+    assign_sketches : bool
+        If True assign_target_info also assigns the sketches of the target columns and
+        magnitudes of each carton (see sketches.new_sketches), written as JSON (with
+        sketches.dumps) in the column ``sketches`` of the output file. Not available with
+        batch=True.
+    collect_metrics : bool
+        If True the time spent in each stage of the run (carton_lookup, target_query,
+        dataframe, sets, mag_placeholders, visualize, write, etc.) for each carton, with the
+        number of rows fetched, rows/s and peak memory, is written as JSON lines (see
+        metrics.RunMetrics) to a file next to the log with extension ``_metrics.jsonl``, and
+        a summary is logged at the end of the run.
+    query_profile : bool
+        If True each SQL statement executed in targetdb is recorded with its parameters,
+        carton, latency, and number of rows (see profiling.QueryProfile), and the report of
+        the run is written to a JSON file next to the log with extension ``_queries.json``.
+    explain_queries : int
+        Number of slowest statements whose plans are added to the report when
+        query_profile=True, with ``EXPLAIN (ANALYZE, BUFFERS)`` in PostgreSQL (which runs
+        them again) or ``EXPLAIN QUERY PLAN`` in SQLite, along with the lines of the plans
+        that are sequential scans.
+    log_format : str
+        Format of the log of the run, ``text`` (extension .log) or ``json`` (the JSON log of
+        the SDSSLogger, one object per message, with the carton being processed, extension
+        .json).
+    log_mode : str
+        With ``queue`` the messages are put in a queue without formatting them, and a
+        background thread formats and writes them (to the log and the shell), so the
+        processing of the cartons does not wait for the log I/O. The queue is emptied at the
+        end of the run. With ``sync`` (default) the messages are written as they are logged.
 
 
     Returns
@@ -538,9 +1703,14 @@ def process_cartons(origin='rsconfig', files_folder='./files/', inputname=None,
 
     """
     cfg = cartons_inventory.config
+    log = cartons_inventory.log
     # Check that we have a valid origin parameter
     assert origin in ['targetdb', 'rsconfig', 'custom'], f'{origin!r} is not a valid'\
         ' option for origin parameter'
+    assert batch is False or assign_sketches is False, 'assign_sketches=True is not available'\
+        ' for batch=True'
+    assert query_profile is True or explain_queries == 0, 'explain_queries is only used with'\
+        ' query_profile=True'
 
     fullfolder = files_folder + origin + '/'
 
@@ -592,156 +1762,391 @@ def process_cartons(origin='rsconfig', files_folder='./files/', inputname=None,
                 f'{os.path.realpath(inputwrite_filename)}\n already exists and overwrite=False'
 
     # If write_output set the final output_filename and check overwritting
+    checkpoint = None
     if write_output is True:
         assert assign_sets is True or assign_placeholders is True, 'to create an output .csv'\
             'at least one of assign_sets or assign_placeholders has to be True'
+        assert output_format in OUTPUT_FORMATS, f'{output_format!r} is not a valid option for'\
+            ' output_format parameter'
+        extension = OUTPUT_FORMATS[output_format]
         if assign_sets is True and assign_placeholders is False:
-            output_filename = outputbase_filename + '_sets.csv'
+            output_filename = outputbase_filename + '_sets' + extension
         if assign_sets is False and assign_placeholders is True:
-            output_filename = outputbase_filename + '_magplaceholers.csv'
+            output_filename = outputbase_filename + '_magplaceholers' + extension
         if assign_sets is True and assign_placeholders is True:
-            output_filename = outputbase_filename + '_all.csv'
+            output_filename = outputbase_filename + '_all' + extension
 
-        if overwrite is False:
+        # The checkpoint of a previous run is only used with resume=True
+        checkpoint_filename = os.path.splitext(output_filename)[0] + '.checkpoint'
+        if resume is False and os.path.isfile(checkpoint_filename):
+            os.remove(checkpoint_filename)
+        resume = resume is True and os.path.isfile(checkpoint_filename)
+
+        if overwrite is False and resume is False and refresh is False:
             assert not os.path.isfile(output_filename), 'output file '\
                 f'{os.path.realpath(output_filename)}\n already exists and overwrite=False'
 
-    if origin in ['rsconfig', 'custom']:
-        cartons, plans, categories, stages, actives = gets_carton_info(inputread_filename)
-    if origin == 'targetdb':
-        if all_cartons is True:
-            pattern = '%%'
-        if all_cartons is False:
-            pattern = cartons_name_pattern.replace('*', '%')
+    # The queries are profiled from here, so those selecting the cartons are included
+    log_path = f'./logs/origin_{origin}_sets_{assign_sets}_mags_{assign_placeholders}.log'
+    profile = run_metrics = writer = None
+    if query_profile is True:
+        profile = profiling.QueryProfile(Car.model._meta.database,
+                                         log_path.replace('.log', '_queries.json'),
+                                         explain=explain_queries)
+        profile.start()
+
+    # The output, checkpoint, metrics, query profile, and queued log of the run are closed
+    # even if it fails
+    try:
+        # The dimension tables are loaded again in each run, since targetdb may have changed
+        dimensions = DimensionTables.refresh()
+        if catalog is None:
+            catalog = CartonCatalog.load(dimensions)
+
+        # The records of input files are read lazily while the objects are created
+        if origin in ['rsconfig', 'custom']:
+            records = iter_carton_list(inputread_filename)
+        if origin == 'targetdb':
+            if all_cartons is True:
+                pattern = '%%'
+            if all_cartons is False:
+                pattern = cartons_name_pattern.replace('*', '%')
+
+            cartons_list = [{'carton': row['carton'], 'version_pk': row['version_pk'],
+                             'plan': row['plan'], 'category_label': row['category_label']}
+                            for row in catalog.match(pattern)]
+            assert len(cartons_list) > 0, f'There are no cartons matching {cartons_name_pattern!r}'
+            # Here we look for the basic information of each carton/plan/category_label
+            # available in targetdb to then instantiate the objects with that information
+            carts_sel = select_versions(pd.DataFrame(cartons_list), versions=versions,
+                                        forced_versions=forced_versions,
+                                        unique_version=unique_version)
+            assert len(carts_sel) > 0, 'There are no carton/version_pk pairs matching the'\
+                ' selection criteria used'
+            cartons = carts_sel['carton'].values.tolist()
+            plans = carts_sel['plan'].values.tolist()
+            categories = carts_sel['category_label'].values.tolist()
+            stages, actives = ['N/A'] * len(carts_sel), ['N/A'] * len(carts_sel)
+            records = zip(cartons, plans, categories, stages, actives)
+
+        # Here we start the corresponding log based on the origin, assign_sets,
+        # and assign_placeholders value
+        start_run_log(log_path, log_format=log_format, log_mode=log_mode)
+        if collect_metrics is True:
+            run_metrics = metrics.RunMetrics(log_path.replace('.log', '_metrics.jsonl'),
+                                             append=resume)
+            run_metrics.start()
+        log.info('#' * 60)
+        print_centered_msg('RESUMING CODE EXECUTION' if resume else 'STARTING CODE EXECUTION', 60,
+                           log)
+        log.info('#' * 60)
+        log.info('Ran process_cartons using the following arguments')
+        signature = inspect.signature(process_cartons)
+        # First thing we log is the parameters used in process_cartons function
+        for param in signature.parameters.keys():
+            arg = locals()[param]
+            log.info(f'{param}={arg}')
+        log.info(' ')
 
-        cartons_list = (
-            Car
-            .select(Car.carton, Version.pk.alias('version_pk'), Version.plan,
-                    Categ.label.alias('category_label'))
-            .join(Version, on=(Version.pk == Car.version_pk))
-            .join(Categ, 'LEFT JOIN', Car.category_pk == Categ.pk)
-            .where(Car.carton ** pattern)
-            .dicts()
-        )
-        # Here we look for the basic information of each carton/plan/category_label
-        # available in targetdb to then instantiate the objects with that information
-        # For each carton name we calculate the version_pk(s) that match the selection criteria
-        # according to the value of ``versions`` parameter (single, all, latest) and override
-        # the value if carton is present in forced_versions dictionary.
-        cart_results = pd.DataFrame(cartons_list)
-        cartons_unique = np.sort(list(set(cart_results['carton'])))
-        all_indices = []
-        for name in cartons_unique:
-            indcart = np.where(cart_results['carton'] == name)[0]
-            if forced_versions and name in forced_versions.keys():
-                inds = np.where((cart_results['carton'] == name) &
-                                (cart_results['version_pk'] == forced_versions[name]))[0]
-            elif versions == 'single':
-                inds = np.where((cart_results['carton'] == name) &
-                                (cart_results['version_pk'] == unique_version))[0]
-            elif versions == 'all':
-                inds = indcart
-            elif versions == 'latest':
-                max_version = np.max(cart_results['version_pk'][indcart])
-                inds = np.where((cart_results['carton'] == name) &
-                                (cart_results['version_pk'] == max_version))[0]
-            all_indices += list(inds)
-        assert len(all_indices) > 0, 'There are no carton/version_pk pairs matching the selection'\
-            ' criteria used'
-        carts_sel = cart_results.iloc[all_indices]
-        cartons = carts_sel['carton'].values.tolist()
-        plans = carts_sel['plan'].values.tolist()
-        categories = carts_sel['category_label'].values.tolist()
-        stages, actives = ['N/A'] * len(carts_sel), ['N/A'] * len(carts_sel)
-
-    # Here we start the corresponding log based on the origin, assign_sets,
-    # and assign_placeholders value
-    log.start_file_logger(f'./logs/origin_{origin}_sets_{assign_sets}'
-                          f'_mags_{assign_placeholders}.log')
-    log.info('#' * 60)
-    print_centered_msg('STARTING CODE EXECUTION', 60, log)
-    log.info('#' * 60)
-    log.info('Ran process_cartons using the following arguments')
-    signature = inspect.signature(process_cartons)
-    # First thing we log is the parameters used in process_cartons function
-    for param in signature.parameters.keys():
-        arg = locals()[param]
-        log.info(f'{param}={arg}')
-    log.info(' ')
-
-    # Here we write an input-like file if requested
-    if origin == 'targetdb' and write_input is True:
-        data = np.transpose([cartons, plans, categories, stages, actives])
-        ascii.write(data, inputwrite_filename, format='fixed_width',
-                    names=['carton', 'plan', 'category', 'stage', 'active'],
-                    overwrite=overwrite)
-        log.info(f'Wrote file {inputwrite_filename}')
-
-    # If write_output then we prepare the .csv writer
-    if write_output is True:
-        fields = cfg['db_fields']
-        f = open(output_filename, 'w')
-        writer = csv.writer(f, delimiter=delim)
-        columns = ['carton'] + fields['input_dependent'] + fields['carton_dependent']
-        if assign_sets is True:
-            new_cols = [x for x in fields['sets'] if x not in fields['set_ranges']]
-            columns += new_cols
-            for col in fields['set_ranges']:
-                columns += [col + '_min', col + '_max']
-        if assign_placeholders is True:
-            columns += ['magnitude_placeholders']
-        writer.writerow(columns)
-
-    # Here we start the actual processing of the cartons
-    objects, diffs = [], []
-    for index in range(len(cartons)):
-
-        # First we instantiate the CartonInfo objects with the information we have
-        obj = CartonInfo(cartons[index], plans[index], categories[index],
-                         stages[index], actives[index])
-        # If check_exists we run check_existence on the cartons and return the diff dataframe
+        # Here we write an input-like file if requested
+        if origin == 'targetdb' and write_input is True:
+            data = np.transpose([cartons, plans, categories, stages, actives])
+            ascii.write(data, inputwrite_filename, format='fixed_width',
+                        names=['carton', 'plan', 'category', 'stage', 'active'],
+                        overwrite=overwrite)
+            log.info(f'Wrote file {inputwrite_filename}')
+
+        # If write_output then we prepare the output writer
+        if write_output is True:
+            fields = cfg['db_fields']
+            columns = ['carton'] + fields['input_dependent'] + fields['carton_dependent']
+            if assign_sets is True:
+                new_cols = [x for x in fields['sets'] if x not in fields['set_ranges']]
+                columns += new_cols
+                for col in fields['set_ranges']:
+                    columns += [col + '_min', col + '_max']
+            if assign_placeholders is True:
+                columns += ['magnitude_placeholders', 'magnitude_placeholder_counts']
+            if assign_sketches is True:
+                columns += ['sketches']
+            # The rows of the previous output have to be read before it is overwritten
+            previous_rows = {}
+            if sample_fraction is not None:
+                columns += ['approximate', 'n_targets']
+            if refresh is True:
+                columns += ['fingerprint']
+                if os.path.isfile(output_filename):
+                    previous_rows = read_previous_rows(output_filename, columns, delim)
+            writer = OutputWriter(output_filename, columns, sets=fields['sets'],
+                                  output_format=output_format, delimiter=delim)
+
+        # Here we start the actual processing of the cartons
+        objects, diffs = [], []
+        for carton, plan, category, stage, active in records:
+
+            # First we instantiate the CartonInfo objects with the information we have
+            with metrics.carton(carton, plan, category), metrics.stage('carton_lookup'):
+                obj = CartonInfo(carton, plan, category, stage, active, catalog=catalog)
+            # If check_exists we run check_existence on the cartons
+            if check_exists is True:
+                diff = obj.check_existence(log, verbose=verb)
+                if len(diff) > 0:
+                    diffs.append(diff)
+                continue
+
+            if obj.in_targetdb is False:
+                log.debug('carton=%s plan=%s version_pk=%scategory=%s not found in targetdb',
+                          obj.carton, obj.plan, obj.version_pk, obj.category_label)
+                continue
+            objects.append(obj)
+
+        # If check_exists we return the diff dataframe
         if check_exists is True:
+            log.info(f'Ran check_existence to compare input file {inputname} with targetdb '
+                     'content')
             output = None
-            diff = obj.check_existence(log, verbose=verb)
-            if len(diff) > 0:
-                diffs.append(diff)
-            if index == len(cartons) - 1:
-                log.info('Ran check_existence to compare input file '
-                         f'{inputname} with targetdb content')
-                if len(diffs) > 0:
-                    output = pd.concat(diffs)
-                return output
-            continue
-
-        if obj.in_targetdb is False:
-            log.debug(f'carton={obj.carton} plan={obj.plan} version_pk={obj.version_pk}'
-                      f'category={obj.category_label} not found in targetdb')
-        # Here we assign sets and or mag placeholders info based on input arguments
-        # And we visualize and write in output .csv if it corresponds
-        if obj.in_targetdb is True:
-            if assign_sets is True or assign_placeholders is True:
-                obj.assign_target_info(calculate_sets=assign_sets,
-                                       calculate_mag_placeholders=assign_placeholders)
-                objects.append(obj)
-                log.info(f'Ran assign_target_info on carton {obj.carton}')
+            if len(diffs) > 0:
+                output = pd.concat(diffs)
+            return output
+
+        # Rows of cartons with the same fingerprint as in the previous output are copied from it
+        copied = {}
+        if write_output is True and refresh is True:
+            with metrics.stage('fingerprints'):
+                assign_fingerprints(objects)
+            # Only the target dependent columns are copied, the rest are those of the current
+            # input file and carton catalog
+            current_columns = ['carton', 'fingerprint'] + cfg['db_fields']['input_dependent']
+            current_columns += cfg['db_fields']['carton_dependent']
+            for obj in objects:
+                row = previous_rows.get((obj.carton, obj.plan, obj.category_label))
+                if row is not None and str(row['fingerprint']) == obj.fingerprint:
+                    copied[id(obj)] = [getattr(obj, col) if col in current_columns else row[col]
+                                       for col in columns]
+            log.info(f'The fingerprint of {len(copied)} cartons did not change since the previous'
+                     ' output')
+
+        # Cartons whose target information is in the checkpoint of the run or in the cache
+        # don't need to be processed
+        assign = assign_sets is True or assign_placeholders is True or assign_sketches is True
+        if write_output is True:
+            checkpoint = ResultCache(checkpoint_filename, max_entries=max(len(objects), 1))
+        stores = [store for store in [checkpoint, cache] if store is not None]
+        if sample_fraction is not None:
+            stores = []
+        pending = [obj for obj in objects if id(obj) not in copied]
+        if len(stores) > 0 and assign:
+            with metrics.stage('cache'):
+                pending = [obj for obj in pending
+                           if not any(store.get(obj, calculate_sets=assign_sets,
+                                                calculate_mag_placeholders=assign_placeholders,
+                                                calculate_sketches=assign_sketches)
+                                      for store in stores)]
+            log.info(f'Took target information of {len(objects) - len(copied) - len(pending)} '
+                     'cartons from checkpoint or cache')
+        pending_ids = set(id(obj) for obj in pending)
+
+        # In batch mode the target information of all the cartons is assigned at once
+        if batch is True and assign:
+            with metrics.stage('batch_query'):
+                assign_target_info_batch(pending, calculate_sets=assign_sets,
+                                         calculate_mag_placeholders=assign_placeholders)
+            log.info(f'Ran assign_target_info_batch on {len(pending)} cartons')
+
+        # Otherwise assign_target_info runs on max_workers threads while the objects are
+        # logged, visualized and written below in input order
+        processed = iter(pending)
+        if batch is False and assign:
+            processed = iter_assign_target_info(pending, max_workers=max_workers,
+                                                calculate_sets=assign_sets,
+                                                calculate_mag_placeholders=assign_placeholders,
+                                                mode=mode, sample_fraction=sample_fraction,
+                                                calculate_sketches=assign_sketches)
+
+        for index, obj in enumerate(objects):
+            if id(obj) in copied:
+                with metrics.carton(obj.carton, obj.plan, obj.category_label):
+                    with metrics.stage('write'):
+                        writer.writerow(copied[id(obj)])
+                log.info('Copied row of carton=%s from previous output (%d/%d)', obj.carton,
+                         index + 1, len(objects))
+                if run_metrics is not None:
+                    run_metrics.finish_carton(obj.carton, obj.plan, obj.category_label)
+                continue
+
+            # Here we assign sets and or mag placeholders info based on input arguments
+            # And we visualize and write in output .csv if it corresponds
+            if id(obj) in pending_ids:
+                obj = next(processed)
+                if assign:
+                    with metrics.carton(obj.carton, obj.plan, obj.category_label):
+                        with metrics.stage('cache'):
+                            for store in stores:
+                                store.put(obj)
+            if assign:
+                if id(obj) not in pending_ids:
+                    log.info('Took target information of carton %s from checkpoint or cache',
+                             obj.carton)
+                elif batch is False:
+                    log.info('Ran assign_target_info on carton %s', obj.carton)
 
             else:
-                objects.append(obj)
-                log.info(f'Appending object for carton {obj.carton}'
-                         'but without running assign_target_info')
+                log.info('Appending object for carton %sbut without running assign_target_info',
+                         obj.carton)
+
+            with metrics.carton(obj.carton, obj.plan, obj.category_label):
+                if visualize is True:
+                    with metrics.stage('visualize'):
+                        obj.visualize_content(log)
+
+                if write_output is True:
+                    with metrics.stage('write'):
+                        curr_info = [getattr(obj, attr) for attr in columns]
+                        writer.writerow(curr_info)
+                    log.info('wrote row to output %s for carton=%s (%d/%d)', output_format,
+                             obj.carton, index + 1, len(objects))
+            if run_metrics is not None:
+                run_metrics.finish_carton(obj.carton, obj.plan, obj.category_label)
+
+        if write_output is True:
+            with metrics.stage('write'):
+                writer.close()
+            writer = None
+            log.info(f'Saved output file={output_filename}')
+            # The run is complete so the checkpoint is not needed anymore
+            checkpoint.close()
+            checkpoint = None
+            os.remove(checkpoint_filename)
+    finally:
+        if writer is not None:
+            writer.close()
+        if checkpoint is not None:
+            checkpoint.close()
+        if run_metrics is not None:
+            run_metrics.close(log)
+        if profile is not None:
+            profile.close(log)
+        runlog.stop_queue()
 
-            if visualize is True:
-                obj.visualize_content(log)
+    if return_objects is True:
+        return objects
 
-            if write_output is True:
-                curr_info = [getattr(obj, attr) for attr in columns]
-                writer.writerow(curr_info)
-                log.info(f'wrote row to output csv for carton={obj.carton}'
-                         f' ({index + 1}/{len(cartons)})')
 
-    if write_output is True:
-        f.close()
-        log.info(f'Saved output file={output_filename}')
+def select_versions(cart_results, versions='latest', forced_versions=None, unique_version=None):
+    """Selects the versions of each carton used by process_cartons with origin=``targetdb``.
 
-    if return_objects is True:
-        return objects
+    For each carton name the rows with the version_pk(s) matching the selection criteria are
+    selected according to the value of ``versions`` (single, all, latest), overriding it for
+    the cartons in forced_versions. The selection is vectorized, using a groupby for the
+    latest version of each carton, so it takes a single pass over the cartons.
+
+    Parameters
+    ----------
+
+    cart_results : Pandas DataFrame
+        One row per carton with at least the columns carton and version_pk.
+    versions : str
+        ``latest`` to select the maximum version_pk of each carton, ``single`` to select
+        unique_version, or ``all`` to select all of them.
+    forced_versions : dict or None
+        version_pk selected for each carton in the dictionary, independent of ``versions``.
+    unique_version : int or None
+        version_pk selected when versions=``single``.
+
+    Returns
+    -------
+
+    carts_sel : Pandas DataFrame
+        Selected rows, sorted by carton name (keeping the original order of the rows of each
+        carton).
+
+    """
+
+    version_pk = cart_results['version_pk']
+    if versions == 'latest':
+        selected = version_pk == version_pk.groupby(cart_results['carton']).transform('max')
+    elif versions == 'single':
+        selected = version_pk == unique_version
+    else:
+        selected = pd.Series(True, index=cart_results.index)
+
+    if forced_versions:
+        forced = cart_results['carton'].map(forced_versions)
+        selected = selected.where(forced.isna(), version_pk == forced)
+
+    return cart_results[selected].sort_values('carton', kind='stable')
+
+
+def read_previous_rows(output_filename, columns, delimiter='|'):
+    """Returns the rows of a previous output file by carton, plan, and category_label.
+
+    Each row is a dictionary with the value of each column. If the columns of the file are
+    not ``columns`` (e.g. it was created with a different configuration) a warning is logged
+    and an empty dictionary is returned.
+
+    """
+
+    log = cartons_inventory.log
+    previous_columns, rows = read_rows(output_filename, delimiter=delimiter)
+    if previous_columns != columns:
+        log.warning(f'columns of previous output {output_filename} do not match, all the '
+                    'cartons will be processed')
+        return {}
+    rows = [dict(zip(previous_columns, row)) for row in rows]
+    return {(row['carton'], row['plan'], row['category_label']): row for row in rows}
+
+
+def start_run_log(path, log_format='text', log_mode='sync'):
+    """Starts the file log of a process_cartons run.
+
+    The file handler of a previous run in the same session is removed (and its background
+    thread stopped), so the messages are only written to the log of the current run. If a
+    log with the same path exists the new messages are appended to it (e.g. those of a run
+    with resume=True after those of the interrupted run).
+
+    Parameters
+    ----------
+
+    path : str
+        Path of the log. With log_format=``json`` its extension is replaced by ``.json``.
+    log_format : str
+        ``text`` for the format of the SDSSLogger, or ``json`` for a JSON line per message
+        with the carton being processed (see runlog.CartonFilter).
+    log_mode : str
+        ``sync`` to emit the messages in the thread that logs them, or ``queue`` to emit them
+        (formatting included) from a background thread (see runlog.QueuedLog).
+
+    """
+
+    assert log_format in runlog.LOG_FORMATS, f'{log_format!r} is not a valid option for'\
+        ' log_format parameter'
+    assert log_mode in runlog.LOG_MODES, f'{log_mode!r} is not a valid option for log_mode'\
+        ' parameter'
+
+    log = cartons_inventory.log
+    runlog.stop_queue()
+    if getattr(log, 'fh', None) is not None:
+        log.removeHandler(log.fh)
+        log.fh.close()
+        log.fh = None
+    path = os.path.splitext(path)[0] + runlog.LOG_FORMATS[log_format]
+    log.start_file_logger(path, as_json=log_format == 'json')
+    if log_format == 'json' and log.fh is not None:
+        log.fh.addFilter(runlog.CartonFilter())
+    if log_mode == 'queue':
+        runlog.start_queue(log)
+
+
+async def async_process_cartons(*args, max_in_flight=4, **kwargs):
+    """Asynchronous version of process_cartons.
+
+    Runs process_cartons with the same ``args`` and ``kwargs`` using run_blocking, so the event
+    loop is not blocked, and returns its output (the check_existence DataFrame or the CartonInfo
+    objects when return_objects=True). The target information of the cartons is assigned
+    concurrently with at most ``max_in_flight`` queries in flight (the ``max_workers``
+    parameter of process_cartons).
+
+    """
+
+    assert 'max_workers' not in kwargs, 'use max_in_flight instead of max_workers'
+    return await run_blocking(process_cartons, *args, max_workers=max_in_flight, **kwargs)
@@ -0,0 +1,203 @@
+import re
+import weakref
+from collections import defaultdict
+
+import numpy as np
+
+import cartons_inventory
+from cartons_inventory.imports import import_targetdb, lazy_import
+
+
+pd = lazy_import('pandas')
+targetdb = import_targetdb()
+Cadence, Carton, Category = targetdb.Cadence, targetdb.Carton, targetdb.Category
+Instrument, Mapper, Version = targetdb.Instrument, targetdb.Mapper, targetdb.Version
+
+
+class DimensionTables(object):
+    """In-memory lookup tables of the small dimension tables of targetdb.
+
+    The cadence, instrument, category, mapper, and version tables of targetdb have at most a
+    few hundred rows, so instead of joining them in every query they are loaded once (with
+    get, or again with refresh, which process_cartons calls at the start of each run) and
+    their labels are attached to the distinct pks found by the
+    queries on targetdb.carton_to_target and targetdb.carton.
+
+    Parameters
+    ----------
+
+    cadence, instrument, category, mapper: dict
+        Label of each pk in the corresponding table.
+    version: dict or None
+        Dictionary with keys pk, plan, and tag of each pk in targetdb.version.
+
+    """
+
+    _loaded = weakref.WeakKeyDictionary()
+
+    def __init__(self, cadence, instrument, category=None, mapper=None, version=None):
+        self.cadence = dict(cadence)
+        self.instrument = dict(instrument)
+        self.category = dict(category or {})
+        self.mapper = dict(mapper or {})
+        self.version = dict(version or {})
+
+    @classmethod
+    def load(cls):
+        """Loads the dimension tables from targetdb."""
+
+        labels = {}
+        for name, model in [('cadence', Cadence), ('instrument', Instrument),
+                            ('category', Category), ('mapper', Mapper)]:
+            labels[name] = dict(model.select(model.pk, model.label).tuples())
+        versions = (
+            Version
+            .select(Version.pk, Version.plan, Version.tag)
+            .order_by(Version.pk)
+            .dicts()
+        )
+
+        return cls(version={row['pk']: row for row in versions}, **labels)
+
+    @classmethod
+    def get(cls):
+        """Returns the dimension tables of the database of the targetdb models.
+
+        The tables are only loaded the first time this is called for each database.
+
+        """
+
+        database = Cadence._meta.database
+        if database not in cls._loaded:
+            cls._loaded[database] = cls.load()
+        return cls._loaded[database]
+
+    @classmethod
+    def refresh(cls):
+        """Loads again the dimension tables returned by get and returns them.
+
+        Use it when targetdb may have changed since they were loaded (e.g. new versions).
+
+        """
+
+        cls._loaded[Cadence._meta.database] = cls.load()
+        return cls._loaded[Cadence._meta.database]
+
+    def labels(self, table, pks):
+        """Returns the list of labels of the pks of a table (None if the pk is not found)."""
+        lookup = getattr(self, table)
+        return [lookup.get(pk) for pk in pks]
+
+    def label_column(self, table, column):
+        """Returns an object array with the labels of an array of pks of a table."""
+
+        codes, uniques = pd.factorize(np.asarray(column, dtype=object))
+        labels = np.array(self.labels(table, uniques) + [None], dtype=object)
+        return labels[codes]
+
+
+class CartonCatalog(object):
+    """In-memory snapshot of the carton catalog in targetdb.
+
+    The carton/version/category/mapper information of targetdb has only a few thousand rows, so
+    instead of querying the database for each carton, CartonCatalog loads it once (with
+    load) and indexes it by carton/plan/category_label combination and by carton name. This
+    way CartonInfo.assign_carton_info, CartonInfo.check_existence, and the selection of cartons
+    by name pattern in process_cartons don't need to query the database.
+
+    Parameters
+    ----------
+
+    cartons: list of dict
+        One dictionary per carton in targetdb.carton with keys carton_pk, carton, program,
+        version_pk, category_pk, mapper_pk, plan, tag, category_label, and mapper_label.
+    versions: list of dict
+        One dictionary per version in targetdb.version with keys pk, plan, and tag.
+
+    """
+
+    def __init__(self, cartons, versions):
+        self.cartons = list(cartons)
+        self.versions = list(versions)
+
+        self._by_key = {}
+        self._by_name = defaultdict(list)
+        for row in self.cartons:
+            key = (row['carton'], row['plan'], row['category_label'])
+            self._by_key.setdefault(key, row)
+            self._by_name[row['carton']].append(row)
+
+        self._by_plan = {}
+        for row in self.versions:
+            self._by_plan.setdefault(row['plan'], row)
+
+    @classmethod
+    def load(cls, dimensions=None):
+        """Loads the carton catalog from targetdb.
+
+        Only targetdb.carton is queried, the labels of the version, category, and mapper of
+        each carton are taken from ``dimensions`` (by default DimensionTables.get()). Cartons
+        whose version_pk is not in ``dimensions`` are left out of the catalog with a warning.
+
+        """
+
+        log = cartons_inventory.log
+        dimensions = dimensions or DimensionTables.get()
+        cartons = (
+            Carton
+            .select(Carton.pk.alias('carton_pk'), Carton.carton, Carton.program,
+                    Carton.version_pk.alias('version_pk'),
+                    Carton.category_pk.alias('category_pk'),
+                    Carton.mapper_pk.alias('mapper_pk'))
+            .order_by(Carton.pk)
+            .dicts()
+        )
+
+        rows = []
+        for row in cartons:
+            version = dimensions.version.get(row['version_pk'])
+            if version is None:
+                log.warning('carton=%s carton_pk=%s left out of the catalog because its '
+                            'version_pk=%s is not in the dimension tables', row['carton'],
+                            row['carton_pk'], row['version_pk'])
+                continue
+            row.update(plan=version['plan'], tag=version['tag'],
+                       category_label=dimensions.category.get(row['category_pk']),
+                       mapper_label=dimensions.mapper.get(row['mapper_pk']))
+            rows.append(row)
+
+        return cls(rows, dimensions.version.values())
+
+    def __len__(self):
+        return len(self.cartons)
+
+    def lookup(self, carton, plan, category_label):
+        """Returns the catalog row of a carton/plan/category_label combination or None."""
+        return self._by_key.get((carton, plan, category_label))
+
+    def alternatives(self, carton):
+        """Returns the catalog rows of all the cartons named ``carton``."""
+        return list(self._by_name.get(carton, []))
+
+    def version(self, plan):
+        """Returns the targetdb.version row of a plan or None."""
+        return self._by_plan.get(plan)
+
+    def match(self, pattern):
+        """Returns the catalog rows with carton name matching ``pattern``.
+
+        The pattern follows the case insensitive SQL LIKE syntax used in targetdb queries,
+        where ``%`` and ``*`` match any string and ``_`` matches any single character.
+
+        """
+        regex = ''
+        for char in pattern:
+            if char in '%*':
+                regex += '.*'
+            elif char == '_':
+                regex += '.'
+            else:
+                regex += re.escape(char)
+        regex = re.compile(regex, re.IGNORECASE | re.DOTALL)
+
+        return [row for row in self.cartons if regex.fullmatch(row['carton'])]
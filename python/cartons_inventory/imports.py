@@ -0,0 +1,61 @@
+import importlib
+import importlib.util
+import os
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Placeholder of a module that imports it the first time one of its attributes is used.
+
+    After the import the attributes of the module are copied to the placeholder, so the
+    following uses are plain attribute lookups.
+
+    Parameters
+    ----------
+
+    name : str
+        Full name of the module (e.g. ``pyarrow.parquet``).
+
+    """
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def lazy_import(name):
+    """Returns a LazyModule for module name, or None if its package is not installed.
+
+    The module is returned directly if it was already imported. Only the top level package
+    is looked for, so this does not import any module.
+
+    """
+
+    if name in sys.modules:
+        return sys.modules[name]
+    if importlib.util.find_spec(name.partition('.')[0]) is None:
+        return None
+    return LazyModule(name)
+
+
+def import_targetdb():
+    """Imports the sdssdb targetdb models without connecting to the database.
+
+    When sdssdb.peewee.sdss5db is imported its database connection connects to the database
+    of the sdssdb profile, unless autoconnect is disabled. If it was not imported yet (and
+    autoconnect is not set with $SDSSDB_AUTOCONNECT) it is imported with autoconnect
+    disabled, so the connection is only opened (with the same profile) when the first
+    query is executed.
+
+    """
+
+    if 'sdssdb.peewee.sdss5db' not in sys.modules and 'SDSSDB_AUTOCONNECT' not in os.environ:
+        import sdssdb
+        autoconnect, sdssdb.autoconnect = sdssdb.autoconnect, False
+        try:
+            importlib.import_module('sdssdb.peewee.sdss5db')
+        finally:
+            sdssdb.autoconnect = autoconnect
+    return importlib.import_module('sdssdb.peewee.sdss5db.targetdb')
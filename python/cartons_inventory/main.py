@@ -13,11 +13,12 @@ __all__ = ('get_range', 'set_or_none', 'math', 'MyClass')
 
 
 def get_range(set_p):
-    """Gets the total range of a given set."""
-    if set_p is None:
+    """Gets the total range of a given set, ignoring None values (i.e. NULL in the database)."""
+    values = [] if set_p is None else [value for value in set_p if value is not None]
+    if len(values) == 0:
         minp, maxp = None, None
     else:
-        minp, maxp = min(list(set_p)), max(list(set_p))
+        minp, maxp = min(values), max(values)
     return minp, maxp
 
 
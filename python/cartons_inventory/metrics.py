@@ -0,0 +1,227 @@
+import contextlib
+import contextvars
+import functools
+import json
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+
+
+# RunMetrics of the current run and key of the carton being processed. When there is no
+# active RunMetrics the instrumentation functions do nothing
+_metrics = contextvars.ContextVar('cartons_inventory_metrics', default=None)
+_carton = contextvars.ContextVar('cartons_inventory_metrics_carton', default=None)
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class RunMetrics(object):
+    """Per-carton and per-stage timing metrics of a process_cartons run.
+
+    While the RunMetrics is active (see start and activate) the time spent in each stage (the
+    blocks instrumented with the ``stage`` function, e.g. target_query or write) and the number
+    of rows fetched (``add_rows``) are added to the record of the carton being processed (set
+    with ``carton``), or to the record of the run if there is none. The record of each
+    carton is written as a JSON line to ``path`` with finish_carton, and close writes a last
+    line with the totals of the run, which is also returned by summary.
+
+    Parameters
+    ----------
+
+    path : str
+        Path of the JSON lines file.
+    append : bool
+        If True the records are appended to the file instead of overwriting it.
+
+    """
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self._file = open(path, 'a' if append else 'w')
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self.records = {}
+        self.stages = defaultdict(float)
+        self.n_rows = 0
+        self.n_cartons = 0
+
+    def start(self):
+        """Makes this the RunMetrics of the current context.
+
+        Use it in functions decorated with ``isolated``, so it is only active until the
+        function returns.
+
+        """
+
+        _metrics.set(self)
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Makes this the RunMetrics of the current context while the context manager is open."""
+
+        token = _metrics.set(self)
+        try:
+            yield self
+        finally:
+            _metrics.reset(token)
+
+    def record(self, key):
+        """Returns the record of a carton key (None for the run), creating it if needed."""
+
+        with self._lock:
+            if key not in self.records:
+                self.records[key] = {'stages': defaultdict(float), 'rows': 0}
+            return self.records[key]
+
+    def add_time(self, key, name, seconds):
+        """Adds the time of a stage to the record of key and to the totals."""
+
+        record = self.record(key)
+        with self._lock:
+            record['stages'][name] += seconds
+            self.stages[name] += seconds
+
+    def add_rows(self, key, n_rows):
+        """Adds a number of rows fetched to the record of key and to the totals."""
+
+        record = self.record(key)
+        with self._lock:
+            record['rows'] += n_rows
+            self.n_rows += n_rows
+
+    def finish_carton(self, carton, plan, category_label):
+        """Writes the record of a carton as a JSON line and removes it from memory."""
+
+        key = (carton, plan, category_label)
+        with self._lock:
+            record = self.records.pop(key, None)
+            self.n_cartons += 1
+        if record is None:
+            return
+        seconds = sum(record['stages'].values())
+        self.write({'type': 'carton', 'carton': carton, 'plan': plan,
+                    'category_label': category_label, 'seconds': seconds,
+                    'stages': dict(record['stages']), 'rows': record['rows'],
+                    'rows_per_second': rate(record['rows'], seconds),
+                    'peak_memory_mb': peak_memory_mb()})
+
+    def summary(self):
+        """Returns the totals of the run as a dictionary."""
+
+        seconds = time.perf_counter() - self._start
+        return {'type': 'summary', 'seconds': seconds, 'n_cartons': self.n_cartons,
+                'stages': dict(sorted(self.stages.items(), key=lambda item: -item[1])),
+                'rows': self.n_rows, 'rows_per_second': rate(self.n_rows, seconds),
+                'peak_memory_mb': peak_memory_mb()}
+
+    def write(self, data):
+        """Writes a dictionary as a JSON line."""
+
+        with self._lock:
+            self._file.write(json.dumps(data) + '\n')
+            self._file.flush()
+
+    def close(self, log=None):
+        """Writes the summary of the run, logs it if ``log`` is given, and closes the file."""
+
+        summary = self.summary()
+        self.write(summary)
+        self._file.close()
+        if log is not None:
+            log.info(f'Processed {summary["n_cartons"]} cartons and {summary["rows"]} rows in '
+                     f'{summary["seconds"]:.2f} s ({summary["rows_per_second"] or 0:.0f} '
+                     f'rows/s), peak memory {summary["peak_memory_mb"]:.1f} MB')
+            for name, seconds in summary['stages'].items():
+                log.info(f'  {name}: {seconds:.2f} s '
+                         f'({100 * seconds / max(summary["seconds"], 1e-9):.1f}%)')
+        return summary
+
+
+class _Stage(object):
+    """Context manager that adds its duration to a stage of the active RunMetrics."""
+
+    __slots__ = ('metrics', 'name', 'key', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.key = _carton.get()
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.add_time(self.key, self.name, time.perf_counter() - self.start)
+
+
+def stage(name):
+    """Returns a context manager that times a stage in the active RunMetrics.
+
+    If there is no active RunMetrics a shared no-op context manager is returned.
+
+    """
+
+    metrics = _metrics.get()
+    if metrics is None:
+        return _NULL_CONTEXT
+    return _Stage(metrics, name)
+
+
+def add_rows(n_rows):
+    """Adds a number of rows fetched to the current carton of the active RunMetrics."""
+
+    metrics = _metrics.get()
+    if metrics is not None:
+        metrics.add_rows(_carton.get(), n_rows)
+
+
+@contextlib.contextmanager
+def carton(carton, plan, category_label):
+    """Attributes the stages and queries inside the context manager to a carton."""
+
+    token = _carton.set((carton, plan, category_label))
+    try:
+        yield
+    finally:
+        _carton.reset(token)
+
+
+def isolated(func):
+    """Decorator that runs a function in a copy of the current context.
+
+    The RunMetrics started in the function (and the carton being processed) are discarded
+    when the function returns or raises, without affecting the caller.
+
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return contextvars.copy_context().run(func, *args, **kwargs)
+
+    return wrapper
+
+
+def current_carton():
+    """Returns the (carton, plan, category_label) being processed, or None."""
+    return _carton.get()
+
+
+def is_active():
+    """Returns True if there is an active RunMetrics in the current context."""
+    return _metrics.get() is not None
+
+
+def rate(n_rows, seconds):
+    """Returns rows per second, or None if no time was spent."""
+    return n_rows / seconds if seconds > 0 else None
+
+
+def peak_memory_mb():
+    """Returns the peak resident memory of the process in MB."""
+
+    # ru_maxrss is in kilobytes in Linux and in bytes in macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1024 ** 2
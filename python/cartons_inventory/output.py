@@ -0,0 +1,186 @@
+import csv
+
+from cartons_inventory import sketches
+from cartons_inventory.exceptions import Cartons_inventoryMissingDependency
+from cartons_inventory.imports import lazy_import
+
+
+# pyarrow is optional, and it is only imported when it is first used
+pa = lazy_import('pyarrow')
+pq = lazy_import('pyarrow.parquet')
+
+
+OUTPUT_FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow'}
+
+# Columns whose values are repeated among cartons, stored with dictionary encoding
+LABEL_COLUMNS = ['plan', 'category_label', 'stage', 'active', 'program', 'tag', 'mapper_label']
+
+# Type of the values of each column, or of the elements of the sets. Columns not listed here
+# (e.g. new parameters in db_fields) get the type inferred by pyarrow
+VALUE_TYPES = {'carton': 'string', 'version_pk': 'int64', 'mapper_pk': 'int64',
+               'category_pk': 'int64', 'value': 'float64', 'priority': 'int64',
+               'cadence_pk': 'int64', 'cadence_label': 'string', 'lambda_eff': 'float64',
+               'instrument_pk': 'int64', 'instrument_label': 'string',
+               'magnitude_placeholders': 'string', 'approximate': 'bool', 'n_targets': 'int64',
+               'sketches': 'string'}
+
+
+def check_pyarrow():
+    """Raises Cartons_inventoryMissingDependency if pyarrow is not installed."""
+
+    if pa is None:
+        raise Cartons_inventoryMissingDependency('pyarrow is needed for parquet and arrow '
+                                                 'outputs. Install it with pip install '
+                                                 'sdss-cartons_inventory[arrow]')
+
+
+class OutputWriter(object):
+    """Writes the information of the cartons to an output file.
+
+    With output_format=``csv`` each row is written as it is received with csv.writer (sets
+    are written as their python representation). With ``parquet`` or ``arrow`` (Arrow IPC
+    file) the rows are written as a table when the writer is closed, with a list column for
+    each set, numeric columns for the ranges, dictionary encoded columns for the labels in
+    LABEL_COLUMNS, and a map column for magnitude_placeholder_counts. These files can be
+    loaded without parsing with read_output. In all formats the ``sketches`` column is
+    written as JSON with sketches.dumps.
+
+    Parameters
+    ----------
+
+    filename : str
+        Path of the output file.
+    columns : list of str
+        Names of the columns, i.e. the CartonInfo attributes of each row.
+    sets : list of str
+        Columns that are python sets (or None).
+    output_format : str
+        ``csv``, ``parquet``, or ``arrow``.
+    delimiter : str
+        Delimiter of the csv output.
+
+    """
+
+    def __init__(self, filename, columns, sets=(), output_format='csv', delimiter='|'):
+        assert output_format in OUTPUT_FORMATS, f'{output_format!r} is not a valid option for'\
+            ' output_format parameter'
+        if output_format != 'csv':
+            check_pyarrow()
+
+        self.filename = filename
+        self.columns = list(columns)
+        self.sets = list(sets)
+        self.output_format = output_format
+        self.rows = []
+
+        if output_format == 'csv':
+            self._file = open(filename, 'w')
+            self._writer = csv.writer(self._file, delimiter=delimiter)
+            self._writer.writerow(self.columns)
+
+    def writerow(self, row):
+        """Writes (or stores until close for parquet and arrow) a row of values."""
+
+        row = [sketches.dumps(value) if name == 'sketches' and isinstance(value, dict)
+               else value for name, value in zip(self.columns, row)]
+        if self.output_format == 'csv':
+            self._writer.writerow(row)
+        else:
+            self.rows.append(row)
+
+    def close(self):
+        """Closes the file, writing the table for parquet and arrow outputs."""
+
+        if self.output_format == 'csv':
+            self._file.close()
+            return
+
+        table = self.to_table()
+        if self.output_format == 'parquet':
+            pq.write_table(table, self.filename)
+        else:
+            with pa.OSFile(self.filename, 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+
+    def to_table(self):
+        """Returns the rows written as a pyarrow Table."""
+
+        arrays = []
+        for index, name in enumerate(self.columns):
+            values = [row[index] for row in self.rows]
+            value_type = VALUE_TYPES.get(name.replace('_min', '').replace('_max', ''))
+            value_type = value_type and pa.type_for_alias(value_type)
+            if name == 'magnitude_placeholder_counts':
+                array = pa.array([None if counts is None else sorted(counts.items())
+                                  for counts in values], type=pa.map_(pa.string(), pa.int64()))
+            elif name in self.sets or name == 'magnitude_placeholders':
+                list_type = pa.list_(value_type) if value_type else None
+                array = pa.array([sorted_values(value) for value in values], type=list_type)
+            else:
+                array = pa.array([None if value == [] else value for value in values],
+                                 type=value_type)
+                if name in LABEL_COLUMNS:
+                    array = array.dictionary_encode()
+            arrays.append(array)
+
+        return pa.Table.from_arrays(arrays, names=self.columns)
+
+
+def read_rows(filename, delimiter='|'):
+    """Reads the rows of an output file of process_cartons to write them again.
+
+    Rows of csv files are returned as the strings in the file, so writing them again with a
+    csv OutputWriter reproduces the original lines. Rows of parquet and arrow files are
+    returned with the values expected by OutputWriter (python sets for the list columns and
+    dictionaries for magnitude_placeholder_counts).
+
+    Returns
+    -------
+
+    columns : list of str
+        Names of the columns of the file.
+    rows : list of list
+        Values of each row.
+
+    """
+
+    if filename.endswith(OUTPUT_FORMATS['csv']):
+        with open(filename, newline='') as output:
+            lines = list(csv.reader(output, delimiter=delimiter))
+        return lines[0], lines[1:]
+
+    table = read_output(filename)
+    data = []
+    for name, column in zip(table.column_names, table.columns):
+        values = column.to_pylist()
+        if name == 'magnitude_placeholder_counts':
+            values = [None if counts is None else dict(counts) for counts in values]
+        elif pa.types.is_list(column.type):
+            values = [None if value is None else set(value) for value in values]
+        data.append(values)
+    return table.column_names, [list(row) for row in zip(*data)]
+
+
+def sorted_values(values):
+    """Returns the values of a set as a sorted list (with None last), or None."""
+
+    if values is None:
+        return None
+    return sorted(values, key=lambda value: (value is None, value))
+
+
+def read_output(filename):
+    """Reads a parquet or arrow output file of process_cartons into a pyarrow Table.
+
+    The file is memory mapped, so the columns are not parsed nor copied until they are used.
+    Use Table.to_pandas to get a Pandas DataFrame.
+
+    """
+
+    check_pyarrow()
+    if filename.endswith(OUTPUT_FORMATS['arrow']):
+        return pa.ipc.open_file(pa.memory_map(filename)).read_all()
+    assert filename.endswith(OUTPUT_FORMATS['parquet']), f'{filename!r} is not a parquet or'\
+        ' arrow file'
+    return pq.read_table(filename, memory_map=True)
@@ -0,0 +1,238 @@
+import contextlib
+import contextvars
+import json
+import threading
+import time
+
+from peewee import PostgresqlDatabase
+
+from cartons_inventory import metrics
+
+
+# QueryProfile of the current run. When there is none the cursors are not wrapped
+_profile = contextvars.ContextVar('cartons_inventory_query_profile', default=None)
+
+# Statement used to get the plan of a query in each database
+EXPLAIN = {'postgresql': 'EXPLAIN (ANALYZE, BUFFERS) ', 'sqlite': 'EXPLAIN QUERY PLAN '}
+
+
+class QueryProfile(object):
+    """Records the SQL statements executed while it is active.
+
+    While the QueryProfile is active (see start and activate) each statement executed with a
+    cursor of a database where ``install`` was called is recorded with its parameters, the
+    carton being processed (see metrics.carton), the latency (time spent executing the
+    statement and fetching its rows), and the number of rows fetched. With close the plans of
+    the ``explain`` slowest statements are obtained with ``EXPLAIN (ANALYZE, BUFFERS)`` in
+    PostgreSQL (which runs the statement again) or ``EXPLAIN QUERY PLAN`` in SQLite, the
+    report of the run is written to ``path`` as JSON, and the database is uninstalled.
+
+    Parameters
+    ----------
+
+    database : peewee.Database
+        Database whose queries are profiled.
+    path : str
+        Path of the JSON report.
+    explain : int
+        Number of slowest statements whose plans are obtained.
+
+    """
+
+    def __init__(self, database, path, explain=0):
+        assert explain >= 0, f'{explain!r} is not a valid option for explain parameter'
+        self.database = database
+        self.path = path
+        self.explain = explain
+        self.queries = []
+        self._lock = threading.Lock()
+        install(database)
+
+    def start(self):
+        """Makes this the QueryProfile of the current context.
+
+        Use it in functions decorated with ``metrics.isolated``, so it is only active until
+        the function returns.
+
+        """
+
+        _profile.set(self)
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Makes this the QueryProfile of the current context inside the context manager."""
+
+        token = _profile.set(self)
+        try:
+            yield self
+        finally:
+            _profile.reset(token)
+
+    def add(self, sql, params, seconds):
+        """Adds the record of an executed statement and returns it."""
+
+        carton = metrics.current_carton()
+        record = {'sql': sql, 'params': list(params or ()),
+                  'carton': carton and {'carton': carton[0], 'plan': carton[1],
+                                        'category_label': carton[2]},
+                  'seconds': seconds, 'rows': 0}
+        with self._lock:
+            self.queries.append(record)
+        return record
+
+    def slowest(self, n_queries):
+        """Returns the records of the n_queries slowest statements."""
+        return sorted(self.queries, key=lambda record: -record['seconds'])[:n_queries]
+
+    def explain_queries(self):
+        """Adds the plan and the sequential scans to the records of the slowest statements."""
+
+        dialect = 'postgresql' if isinstance(self.database, PostgresqlDatabase) else 'sqlite'
+        for record in self.slowest(self.explain):
+            # The cursor of the connection is used so the EXPLAIN statements are not recorded
+            cursor = self.database.connection().cursor()
+            try:
+                cursor.execute(EXPLAIN[dialect] + record['sql'], tuple(record['params']))
+                # The text of the plan is the only column in PostgreSQL and the last in SQLite
+                record['plan'] = [str(row[-1]) for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+            record['sequential_scans'] = sequential_scans(record['plan'], dialect)
+
+    def report(self):
+        """Returns the report of the run as a dictionary."""
+
+        seconds = sum(record['seconds'] for record in self.queries)
+        return {'n_queries': len(self.queries), 'seconds': seconds,
+                'rows': sum(record['rows'] for record in self.queries),
+                'slowest': [record for record in self.slowest(self.explain)
+                            if 'plan' in record],
+                'queries': self.queries}
+
+    def close(self, log=None):
+        """Explains the slowest statements, writes the report, and logs it if ``log`` is given."""
+
+        try:
+            if self.explain > 0:
+                self.explain_queries()
+        finally:
+            uninstall(self.database)
+        report = self.report()
+        with open(self.path, 'w') as output:
+            json.dump(report, output, indent=2, default=str)
+        if log is not None:
+            log.info(f'Profiled {report["n_queries"]} queries that took '
+                     f'{report["seconds"]:.2f} s and returned {report["rows"]} rows '
+                     f'(report in {self.path})')
+            for record in report['slowest']:
+                carton = record['carton'] and record['carton']['carton']
+                log.info(f'  {record["seconds"]:.3f} s, {record["rows"]} rows, carton={carton},'
+                         f' sequential scans: {record["sequential_scans"] or "none"}')
+        return report
+
+
+class ProfiledCursor(object):
+    """Cursor wrapper that records the statements it executes in a QueryProfile.
+
+    The time spent in execute and in the fetch methods, and the number of rows fetched, are
+    added to the record of the last statement executed. Other attributes are those of the
+    wrapped cursor.
+
+    """
+
+    def __init__(self, cursor, profile):
+        self._cursor = cursor
+        self._profile = profile
+        self._record = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def execute(self, sql, params=None, *args):
+        start = time.perf_counter()
+        if params is None:
+            self._cursor.execute(sql, *args)
+        else:
+            self._cursor.execute(sql, params, *args)
+        self._record = self._profile.add(sql, params, time.perf_counter() - start)
+        return self
+
+    def _add_fetch(self, start, n_rows):
+        if self._record is not None:
+            self._record['seconds'] += time.perf_counter() - start
+            self._record['rows'] += n_rows
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._add_fetch(start, int(row is not None))
+        return row
+
+    def fetchmany(self, *args):
+        start = time.perf_counter()
+        rows = self._cursor.fetchmany(*args)
+        self._add_fetch(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self._cursor.fetchall()
+        self._add_fetch(start, len(rows))
+        return rows
+
+
+def install(database):
+    """Makes the cursors of database record their statements in the active QueryProfile.
+
+    The cursor method of the database instance is replaced by one that wraps the cursors with
+    wrap_cursor, so all the queries run by peewee are recorded. If it was already installed
+    only the number of installations is increased, so it is restored by the last uninstall.
+
+    """
+
+    database._profiled = getattr(database, '_profiled', 0) + 1
+    if database._profiled > 1:
+        return
+    cursor = database.cursor
+
+    def profiled_cursor(*args, **kwargs):
+        return wrap_cursor(cursor(*args, **kwargs))
+
+    database.cursor = profiled_cursor
+
+
+def uninstall(database):
+    """Undoes an install, restoring the cursor method of database after the last one."""
+
+    installed = getattr(database, '_profiled', 0)
+    if installed == 0:
+        return
+    database._profiled = installed - 1
+    if database._profiled == 0:
+        del database.cursor
+        del database._profiled
+
+
+def wrap_cursor(cursor):
+    """Returns cursor wrapped in a ProfiledCursor if there is an active QueryProfile."""
+
+    profile = _profile.get()
+    if profile is None:
+        return cursor
+    return ProfiledCursor(cursor, profile)
+
+
+def sequential_scans(plan, dialect):
+    """Returns the lines of a plan that scan a whole table (``Seq Scan`` or ``SCAN``)."""
+
+    if dialect == 'postgresql':
+        return [line.strip() for line in plan if 'Seq Scan' in line]
+    return [line.strip() for line in plan if line.strip().startswith('SCAN ')]
+
+
+def is_active():
+    """Returns True if there is an active QueryProfile in the current context."""
+    return _profile.get() is not None
@@ -0,0 +1,115 @@
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+from cartons_inventory import metrics
+
+
+LOG_FORMATS = {'text': '.log', 'json': '.json'}
+
+LOG_MODES = ['sync', 'queue']
+
+
+def add_carton(record):
+    """Adds the carton, plan, and category_label of metrics.current_carton to a record.
+
+    They are None if no carton is being processed. Records that already have them are not
+    changed.
+
+    """
+
+    if not hasattr(record, 'carton'):
+        record.carton, record.plan, record.category_label = \
+            metrics.current_carton() or (None, None, None)
+    return record
+
+
+class CartonFilter(logging.Filter):
+    """Filter that adds the carton being processed to the records (see add_carton).
+
+    Add it to the JSON file handler of the SDSSLogger (``start_file_logger(as_json=True)``),
+    which writes all the attributes of the records.
+
+    """
+
+    def filter(self, record):
+        add_carton(record)
+        return True
+
+
+class LazyQueueHandler(QueueHandler):
+    """QueueHandler that puts the records in the queue without formatting them.
+
+    The message (msg % args) is only formatted by the handlers of the QueueListener in its
+    thread. The record keeps the carton being processed when it was logged (see add_carton).
+
+    """
+
+    def prepare(self, record):
+        return add_carton(record)
+
+
+class QueuedLog(object):
+    """Moves the handlers of a logger to a background thread.
+
+    While it is started the handlers of the logger (e.g. the shell and file handlers of the
+    SDSSLogger) are replaced by a LazyQueueHandler, and a QueueListener emits the records
+    with them from its own thread, so logging a message only puts the record in a queue.
+    stop waits until all the records are emitted and restores the handlers of the logger.
+
+    Parameters
+    ----------
+
+    logger : logging.Logger
+        Logger whose handlers are moved to the background thread.
+
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.handlers = list(logger.handlers)
+        self.queue = queue.SimpleQueue()
+        self.queue_handler = LazyQueueHandler(self.queue)
+        self.listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+
+    def start(self):
+        """Starts the background thread and replaces the handlers of the logger."""
+
+        self.listener.start()
+        for handler in self.handlers:
+            self.logger.removeHandler(handler)
+        self.logger.addHandler(self.queue_handler)
+
+    def stop(self):
+        """Emits the records in the queue and restores the handlers of the logger."""
+
+        self.logger.removeHandler(self.queue_handler)
+        for handler in self.handlers:
+            self.logger.addHandler(handler)
+        self.listener.stop()
+
+
+# QueuedLog of the current run, stopped when the next run starts or at exit
+_queued_log = None
+
+
+def start_queue(logger):
+    """Starts a QueuedLog for logger, stopping the one of the previous run."""
+
+    global _queued_log
+    stop_queue()
+    _queued_log = QueuedLog(logger)
+    _queued_log.start()
+
+
+def stop_queue():
+    """Stops the QueuedLog of the current run, if any."""
+
+    global _queued_log
+    if _queued_log is not None:
+        _queued_log.stop()
+        _queued_log = None
+
+
+atexit.register(stop_queue)
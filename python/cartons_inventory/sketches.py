@@ -0,0 +1,299 @@
+import hashlib
+import json
+import math
+
+import numpy as np
+
+import cartons_inventory
+
+
+class QuantileSketch(object):
+    """Mergeable quantile sketch of a stream of numbers (KLL sketch).
+
+    The values are kept in a hierarchy of compactors, where each value in level h stands for
+    2**h values of the stream. When a level has more values than its capacity (k for the top
+    level, decreasing by a factor 2/3 per level below it, with a minimum of 2) it is sorted
+    and every other value is promoted to the next level, starting at the even or odd positions
+    at random, so the errors of the compactions cancel out instead of adding up. The total
+    weight of the values is always the number of values added, the memory used is of order
+    k + log(n), and the rank error of the quantiles is of order 1/k, independently of how the
+    values are split into updates and merges.
+
+    Parameters
+    ----------
+
+    k : int
+        Capacity of the top level, which sets the accuracy of the sketch.
+    seed : int or None
+        Seed of the random generator of the compactions, so the sketch of the same values
+        added in the same way is reproducible. If None the generator is seeded by numpy.
+
+    """
+
+    def __init__(self, k=128, seed=None):
+        self.k = k
+        self.seed = seed
+        self.levels = [np.empty(0)]
+        self.n = 0
+        self.min = None
+        self.max = None
+        self._rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return self.n
+
+    def capacity(self, level):
+        """Returns the maximum number of values of a level."""
+        return max(int(math.ceil(self.k * (2 / 3) ** (len(self.levels) - 1 - level))), 2)
+
+    def update(self, values):
+        """Adds an array of values to the sketch. Non finite values are ignored."""
+
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return
+        self.n += len(values)
+        low, high = float(values.min()), float(values.max())
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.compress()
+
+    def merge(self, other):
+        """Adds the values of other QuantileSketch with the same k to this one."""
+
+        assert self.k == other.k, 'sketches with different k can not be merged'
+        if other.n == 0:
+            return
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, values in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], values])
+        self.n += other.n
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.compress()
+
+    def compress(self):
+        """Compacts the lowest level over its capacity until all the levels are within it."""
+
+        while True:
+            over = [level for level, values in enumerate(self.levels)
+                    if len(values) > self.capacity(level)]
+            if len(over) == 0:
+                return
+            level = over[0]
+            if level + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            values = np.sort(self.levels[level])
+            # With an odd number of values the lowest stays, so the rest can be paired
+            n_kept = len(values) % 2
+            promoted = values[n_kept:][self._rng.integers(2)::2]
+            self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            self.levels[level] = values[:n_kept]
+
+    def quantiles(self, fractions):
+        """Returns the approximate quantiles of a list of fractions (None if empty)."""
+
+        fractions = np.asarray(fractions, dtype=float)
+        if self.n == 0:
+            return [None] * len(fractions)
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(values_level), 2 ** level)
+                                  for level, values_level in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        values, ranks = values[order], np.cumsum(weights[order])
+        ind = np.searchsorted(ranks, fractions * self.n, side='left')
+        result = values[np.clip(ind, 0, len(values) - 1)]
+        # The extremes are known exactly
+        result = np.where(fractions <= 0, self.min, np.where(fractions >= 1, self.max, result))
+        return result.tolist()
+
+    def to_dict(self):
+        """Returns the state of the sketch as a dictionary that can be serialized to JSON."""
+        return {'k': self.k, 'n': self.n, 'min': self.min, 'max': self.max,
+                'levels': [values.tolist() for values in self.levels]}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Creates a QuantileSketch from the dictionary returned by to_dict."""
+
+        sketch = cls(k=data['k'])
+        sketch.n, sketch.min, sketch.max = data['n'], data['min'], data['max']
+        sketch.levels = [np.asarray(values, dtype=float) for values in data['levels']]
+        return sketch
+
+
+class Histogram(object):
+    """Number of values in the bins defined by a list of edges.
+
+    There are len(edges) + 1 bins: values lower than edges[0], values in each interval
+    [edges[i], edges[i + 1]), and values greater or equal than edges[-1]. Histograms with the
+    same edges are merged adding their counts.
+
+    Parameters
+    ----------
+
+    edges : list of float
+        Increasing edges of the bins.
+    counts : list of int or None
+        Initial counts of the bins. If None, all are zero.
+
+    """
+
+    def __init__(self, edges, counts=None):
+        self.edges = [float(edge) for edge in edges]
+        assert self.edges == sorted(self.edges), 'the edges of a histogram have to be sorted'
+        self.counts = np.zeros(len(self.edges) + 1, dtype=np.int64)
+        if counts is not None:
+            self.counts += np.asarray(counts, dtype=np.int64)
+
+    def update(self, values):
+        """Adds an array of values to the histogram. Non finite values are ignored."""
+
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[np.isfinite(values)]
+        bins = np.searchsorted(self.edges, values, side='right')
+        self.counts += np.bincount(bins, minlength=len(self.counts))
+
+    def merge(self, other):
+        """Adds the counts of other Histogram with the same edges to this one."""
+
+        assert self.edges == other.edges, 'histograms with different edges can not be merged'
+        self.counts += other.counts
+
+    def to_dict(self):
+        """Returns the edges and counts as a dictionary that can be serialized to JSON."""
+        return {'edges': self.edges, 'counts': self.counts.tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Creates a Histogram from the dictionary returned by to_dict."""
+        return cls(data['edges'], counts=data['counts'])
+
+
+class DistributionSketch(object):
+    """QuantileSketch and Histogram of the same values.
+
+    Parameters
+    ----------
+
+    edges : list of float
+        Edges of the Histogram.
+    k : int
+        Accuracy parameter of the QuantileSketch.
+    seed : int or None
+        Seed of the QuantileSketch.
+
+    """
+
+    def __init__(self, edges, k=128, seed=None):
+        self.quantile_sketch = QuantileSketch(k=k, seed=seed)
+        self.histogram = Histogram(edges)
+
+    def __len__(self):
+        return len(self.quantile_sketch)
+
+    def update(self, values):
+        """Adds an array of values to the sketch. Non finite values are ignored."""
+        self.quantile_sketch.update(values)
+        self.histogram.update(values)
+
+    def merge(self, other):
+        """Adds the values of other DistributionSketch to this one."""
+        self.quantile_sketch.merge(other.quantile_sketch)
+        self.histogram.merge(other.histogram)
+
+    def percentiles(self, fractions=None):
+        """Returns a dictionary with the approximate quantile of each fraction.
+
+        If ``fractions`` is None, ``sketches['quantiles']`` from the configuration is used.
+
+        """
+
+        if fractions is None:
+            fractions = cartons_inventory.config['sketches']['quantiles']
+        return dict(zip([str(fraction) for fraction in fractions],
+                        self.quantile_sketch.quantiles(fractions)))
+
+    def to_dict(self):
+        """Returns the sketch as a dictionary that can be serialized to JSON.
+
+        Besides the state of the QuantileSketch and the Histogram, the dictionary includes the
+        percentiles from the configuration, so they can be read without loading the sketch.
+
+        """
+
+        return {'percentiles': self.percentiles(),
+                'quantile_sketch': self.quantile_sketch.to_dict(),
+                'histogram': self.histogram.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Creates a DistributionSketch from the dictionary returned by to_dict."""
+
+        sketch = cls(data['histogram']['edges'], k=data['quantile_sketch']['k'])
+        sketch.quantile_sketch = QuantileSketch.from_dict(data['quantile_sketch'])
+        sketch.histogram = Histogram.from_dict(data['histogram'])
+        return sketch
+
+
+def sketch_columns():
+    """Returns the names of the sketches: the target columns and the bands in the configuration.
+
+    The target columns are ``sketches['columns']`` (which have to be target columns of
+    db_fields['sets']) and the bands are those in the ``bands`` section.
+
+    """
+
+    cfg = cartons_inventory.config
+    bands = [band for system in cfg['bands'] for band in cfg['bands'][system]]
+    return cfg['sketches']['columns'] + bands
+
+
+def new_sketches():
+    """Returns a dictionary with an empty DistributionSketch for each of sketch_columns.
+
+    The edges of each histogram are ``sketches['edges'][name]``, or
+    ``sketches['edges']['magnitudes']`` for the bands.
+
+    """
+
+    cfg = cartons_inventory.config['sketches']
+    edges = cfg['edges']
+    return {name: DistributionSketch(edges.get(name, edges['magnitudes']), k=cfg['k'])
+            for name in sketch_columns()}
+
+
+def merge_sketches(sketches, other):
+    """Adds the sketches of dictionary other to those with the same name in sketches."""
+
+    for name, sketch in other.items():
+        if name in sketches:
+            sketches[name].merge(sketch)
+        else:
+            sketches[name] = sketch
+
+
+def hash_sketches_config():
+    """Returns a hash of the ``sketches`` section of the configuration."""
+
+    data = cartons_inventory.config['sketches']
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def dumps(sketches):
+    """Serializes a dictionary of DistributionSketch objects to JSON (None stays None)."""
+
+    if sketches is None:
+        return None
+    return json.dumps({name: sketch.to_dict() for name, sketch in sketches.items()})
+
+
+def loads(text):
+    """Returns the dictionary of DistributionSketch objects serialized with dumps."""
+
+    if text is None:
+        return None
+    return {name: DistributionSketch.from_dict(data) for name, data in json.loads(text).items()}
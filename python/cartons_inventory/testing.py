@@ -0,0 +1,103 @@
+import json
+
+from cartons_inventory.imports import import_targetdb
+
+
+targetdb = import_targetdb()
+
+# Models of the tables of the SQLite stand-in of targetdb used by the tests and benchmarks
+TARGETDB_MODELS = [targetdb.Version, targetdb.Category, targetdb.Mapper, targetdb.Cadence,
+                   targetdb.Instrument, targetdb.Carton, targetdb.CartonToTarget,
+                   targetdb.Magnitude]
+
+# Columns filled by insert_rows in each table, in the order of the values of the rows
+TARGETDB_COLUMNS = {
+    'version': ['pk', 'plan', 'tag'],
+    'category': ['pk', 'label'],
+    'mapper': ['pk', 'label'],
+    'cadence': ['pk', 'label'],
+    'instrument': ['pk', 'label'],
+    'carton': ['pk', 'carton', 'program', 'version_pk', 'category_pk', 'mapper_pk'],
+    'carton_to_target': ['pk', 'carton_pk', 'target_pk', 'cadence_pk', 'instrument_pk',
+                         'lambda_eff', 'priority', 'value'],
+    'magnitude': ['pk', 'carton_to_target_pk', 'g', 'r', 'i', 'z', 'h', 'j', 'k', 'bp', 'rp',
+                  'gaia_g']}
+
+# SQLite type of the peewee field types, the rest (text, dates, and arrays) are TEXT
+SQLITE_TYPES = {'AUTO': 'INT', 'BIGAUTO': 'INT', 'INT': 'INT', 'BIGINT': 'INT',
+                'SMALLINT': 'INT', 'BOOL': 'INT', 'FLOAT': 'REAL', 'DOUBLE': 'REAL'}
+
+
+def table_definition(model):
+    """Returns the definition of the table of a targetdb model with SQLite types.
+
+    The columns are those of the fields of the sdssdb model, so the stand-in follows the
+    schema of targetdb. The primary key is an INTEGER PRIMARY KEY and there are no foreign key
+    constraints, so only the tables in TARGETDB_MODELS are needed.
+
+    """
+
+    columns = []
+    for field in model._meta.sorted_fields:
+        if field.primary_key:
+            column_type = 'INTEGER PRIMARY KEY'
+        else:
+            column_type = SQLITE_TYPES.get(field.field_type, 'TEXT')
+        columns.append(f'{field.column_name} {column_type}')
+    return f'{model._meta.table_name} ({", ".join(columns)})'
+
+
+def create_targetdb(database):
+    """Creates the tables of TARGETDB_MODELS in the database attached as targetdb."""
+
+    for model in TARGETDB_MODELS:
+        database.execute_sql('CREATE TABLE targetdb.' + table_definition(model))
+
+
+def insert_rows(database, table, rows):
+    """Inserts rows in a table of the stand-in.
+
+    Each row is a tuple with the values of the TARGETDB_COLUMNS of the table (rows can be any
+    iterable, e.g. a generator). The columns not in TARGETDB_COLUMNS are NULL.
+
+    """
+
+    columns = TARGETDB_COLUMNS[table]
+    values = ', '.join(['?'] * len(columns))
+    database.connection().executemany(
+        f'INSERT INTO targetdb.{table} ({", ".join(columns)}) VALUES ({values})', rows)
+
+
+class ArrayAgg(object):
+    """SQLite stand-in of array_agg, which returns the array as JSON (NULL without rows)."""
+
+    def __init__(self):
+        self.values = []
+
+    def step(self, value):
+        self.values.append(value)
+
+    def finalize(self):
+        return json.dumps(self.values) if self.values else None
+
+
+def register_array_agg(database):
+    """Adds ArrayAgg as the array_agg aggregate of the connections of database."""
+    database.register_aggregate(ArrayAgg, 'array_agg', 1)
+
+
+def decode_arrays(assign_aggregated_info):
+    """Wraps CartonInfo.assign_aggregated_info so it decodes the JSON arrays of ArrayAgg.
+
+    With ArrayAgg registered and the wrapped method set in CartonInfo, the queries of
+    mode='sql' and of the batch functions run in the stand-in.
+
+    """
+
+    def decoding(obj, res):
+        if res is not None:
+            res = {column: json.loads(value) if isinstance(value, str) else value
+                   for column, value in res.items()}
+        assign_aggregated_info(obj, res)
+
+    return decoding
@@ -9,3 +9,63 @@ Those conftest.py will only be applies to the tests in that subdirectory and
 underlying directories. See https://docs.pytest.org/en/2.7.3/plugins.html for
 more information.
 """
+
+import pytest
+from peewee import SqliteDatabase
+
+from cartons_inventory.testing import (TARGETDB_MODELS,
+                                       create_targetdb, insert_rows)
+
+
+TARGETDB_ROWS = {
+    'version': [(1, '0.5.0', '0.3.5'), (2, '0.5.4', '0.3.5')],
+    'category': [(0, 'science')],
+    'mapper': [(0, 'MWM')],
+    'cadence': [(1, 'bright_1x1'), (2, 'dark_1x4')],
+    'instrument': [(0, 'BOSS'), (1, 'APOGEE')],
+    'carton': [(1, 'mwm_a', 'mwm', 1, 0, 0), (2, 'mwm_b', 'mwm', 1, 0, 0),
+               (3, 'mwm_a', 'mwm', 2, 0, 0)],
+    'carton_to_target': [(1, 1, 1, 1, 0, 5400.0, 10, 1.0), (2, 1, 2, 2, 1, 16000.0, 20, 2.0),
+                         (3, 2, 3, 1, 0, 5400.0, 5, 1.0), (4, 1, 4, 1, 0, 5400.0, 10, 1.0)],
+    'magnitude': [(1, 1, 15.0, 999.9, None, 15.0, 12.0, 12.0, 12.0, 12.0, 12.0, 12.0),
+                  (2, 2, 15.0, 15.0, 15.0, 15.0, None, None, None, 0.0, 12.0, 12.0),
+                  (3, 3, -9999.0, 15.0, 15.0, 15.0, 12.0, 12.0, 12.0, 12.0, 12.0, 12.0)]}
+
+
+@pytest.fixture
+def targetdb(tmp_path):
+    """Binds the targetdb models to a small SQLite stand-in of targetdb (see testing).
+
+    The tables live in an attached database named targetdb, so the schema-qualified queries
+    of cartons_inventory run unchanged. Files are used instead of an in-memory database so
+    that the connections opened by different threads see the same data.
+
+    """
+
+    database = SqliteDatabase(str(tmp_path / 'main.db'))
+    database.attach(str(tmp_path / 'targetdb.db'), 'targetdb')
+    with database.bind_ctx(TARGETDB_MODELS):
+        create_targetdb(database)
+        for table, rows in TARGETDB_ROWS.items():
+            insert_rows(database, table, rows)
+        database.close()
+        yield database
+    database.close()
+
+
+@pytest.fixture
+def carton_list(tmp_path, monkeypatch):
+    """Creates a custom carton list with cartons of the targetdb stand-in in tmp_path.
+
+    The working directory is changed to tmp_path, so process_cartons(origin='custom',
+    inputname='list.txt') writes its outputs and logs there. Returns the folder of the list.
+
+    """
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'files' / 'custom').mkdir(parents=True)
+    (tmp_path / 'files' / 'custom' / 'list.txt').write_text(
+        '|  carton |  plan | category | stage | active |\n'
+        '|   mwm_a | 0.5.0 |  science |   srd |      y |\n'
+        '|   mwm_b | 0.5.0 |  science |   srd |      y |\n')
+    return tmp_path / 'files' / 'custom'
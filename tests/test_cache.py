@@ -0,0 +1,79 @@
+# encoding: utf-8
+#
+# test_cache.py
+
+from pytest import fixture
+
+from cartons_inventory.cache import ResultCache
+from cartons_inventory.cartons import CartonInfo
+
+
+@fixture
+def cache(tmp_path):
+    cache = ResultCache(path=str(tmp_path / 'cache.sqlite'), max_entries=2)
+    yield cache
+    cache.close()
+
+
+def fetch(carton, plan, **kwargs):
+    obj = CartonInfo(carton, plan, 'science')
+    obj.assign_target_info(**kwargs)
+    return obj
+
+
+class TestResultCache(object):
+    """Tests for the persistent cache of target information."""
+
+    def test_put_get(self, targetdb, cache):
+        obj = fetch('mwm_a', '0.5.0', calculate_mag_placeholders=True)
+        cache.put(obj)
+
+        cached = CartonInfo('mwm_a', '0.5.0', 'science')
+        assert cache.get(cached, calculate_mag_placeholders=True) is True
+        assert cached.sets_calculated and cached.mag_placeholders_calculated
+        for attr in ['value', 'cadence_label', 'priority_min', 'priority_max',
+                     'magnitude_placeholders', 'magnitude_placeholder_counts']:
+            assert getattr(cached, attr) == getattr(obj, attr)
+
+    def test_partial_entry(self, targetdb, cache):
+        cache.put(fetch('mwm_a', '0.5.0'))
+        obj = CartonInfo('mwm_a', '0.5.0', 'science')
+        assert cache.get(obj, calculate_mag_placeholders=True) is False
+        assert obj.sets_calculated is False
+
+        # The placeholders are added to the entry without removing the sets
+        cache.put(fetch('mwm_a', '0.5.0', calculate_sets=False, calculate_mag_placeholders=True))
+        assert cache.get(obj, calculate_mag_placeholders=True) is True
+
+    def test_lru_eviction(self, targetdb, cache):
+        for carton, plan in [('mwm_a', '0.5.0'), ('mwm_b', '0.5.0')]:
+            cache.put(fetch(carton, plan))
+        assert cache.get(CartonInfo('mwm_a', '0.5.0', 'science')) is True
+        cache.put(fetch('mwm_a', '0.5.4'))
+
+        assert len(cache) == 2
+        assert cache.get(CartonInfo('mwm_b', '0.5.0', 'science')) is False
+        assert cache.get(CartonInfo('mwm_a', '0.5.0', 'science')) is True
+
+    def test_invalidate(self, targetdb, cache):
+        for carton, plan in [('mwm_a', '0.5.0'), ('mwm_a', '0.5.4')]:
+            cache.put(fetch(carton, plan))
+        assert cache.invalidate(carton='mwm_a', plan='0.5.4') == 1
+        assert cache.get(CartonInfo('mwm_a', '0.5.4', 'science')) is False
+        assert cache.invalidate() == 1
+        assert len(cache) == 0
+
+    def test_config_hash(self, targetdb, cache):
+        cache.put(fetch('mwm_a', '0.5.0'))
+        cache.config_hash = 'other'
+        assert cache.get(CartonInfo('mwm_a', '0.5.0', 'science')) is False
+
+    def test_sketches(self, targetdb, cache):
+        cache.put(fetch('mwm_a', '0.5.0'))
+        obj = CartonInfo('mwm_a', '0.5.0', 'science')
+        assert cache.get(obj, calculate_sketches=True) is False
+
+        cache.put(fetch('mwm_a', '0.5.0', calculate_sets=False, calculate_sketches=True))
+        assert cache.get(obj, calculate_sketches=True) is True
+        assert obj.sets_calculated and obj.sketches_calculated
+        assert len(obj.sketches['priority']) > 0
@@ -0,0 +1,657 @@
+# encoding: utf-8
+#
+# test_cartons.py
+
+import asyncio
+import gzip
+import sqlite3
+
+import numpy as np
+import pandas as pd
+from peewee import PostgresqlDatabase
+from pytest import fixture, mark, raises
+
+from cartons_inventory import log
+from cartons_inventory.cartons import (CarTar, CartonInfo, TargetAccumulator,
+                                       assign_target_info_batch,
+                                       build_query_aggregate_batch,
+                                       check_mag_outliers, count_mag_outliers,
+                                       gets_carton_info,
+                                       iter_assign_target_info,
+                                       iter_carton_list, magnitude_arrays,
+                                       placeholders_from_row, process_cartons,
+                                       records_to_dataframe, select_versions)
+from cartons_inventory.catalog import CartonCatalog, DimensionTables
+from cartons_inventory.main import set_or_none
+from cartons_inventory.testing import (decode_arrays, insert_rows,
+                                       register_array_agg)
+
+
+BANDS = ['g', 'r', 'i', 'z', 'j', 'h', 'k', 'bp', 'rp', 'gaia_g']
+SYSTEMS = ['SDSS'] * 4 + ['TMASS'] * 3 + ['GAIA'] * 3
+
+
+@fixture
+def targets():
+    rows = [('BOSS', 1, 5400.0, 0, 10, 1.0, 'bright_1x1') + (15.0,) * 10,
+            ('APOGEE', 2, 16000.0, 1, 20, 2.0, 'dark_1x4') + (999.9,) + (15.0,) * 9,
+            ('BOSS', 1, 5400.0, 0, 10, 1.0, 'bright_1x1') + (None,) * 10]
+    columns = ['instrument_label', 'cadence_pk', 'lambda_eff', 'instrument_pk', 'priority',
+               'value', 'cadence_label'] + BANDS
+    return records_to_dataframe(rows, columns)
+
+
+@fixture
+def dimensions():
+    return DimensionTables(cadence={1: 'bright_1x1', 2: 'dark_1x4'},
+                           instrument={0: 'BOSS', 1: 'APOGEE'})
+
+
+@fixture
+def magnitudes():
+    data = {band: [15.0, 16.0, 17.0] for band in BANDS}
+    data['r'] = [15.0, 999.9, None]
+    data['z'] = [np.inf, 16.0, 17.0]
+    data['h'] = [None, None, None]
+    data['bp'] = [0.0, -9999.0, 0.0]
+    return pd.DataFrame(data)
+
+
+def placeholders_loop(magnitude, system):
+    """Returns the placeholder of a magnitude as classified by the original loop (or None)."""
+
+    if magnitude is None:
+        return system + '_None'
+    if not np.isfinite(magnitude):
+        return system + '_Invalid'
+    if magnitude < -9 or magnitude > 50 or magnitude == 0:
+        return system + '_' + str(np.float64(magnitude))
+
+
+def check_mag_outliers_loop(datafr, bands, systems):
+    """Original implementation of check_mag_outliers, looping over the bands."""
+
+    out_bands, out_systems = [], []
+    for ind_band in range(len(bands)):
+        maglist = datafr[bands[ind_band]]
+        nonempty_maglist = [el for el in maglist if el is not None]
+        magarr_filled = np.array(nonempty_maglist)
+        magarr_valid = magarr_filled[np.isfinite(magarr_filled)]
+        ind_out = np.where((magarr_valid < -9) | (magarr_valid > 50) | (magarr_valid == 0))[0]
+        out_band = list(set([str(magarr_valid[indice]) for indice in ind_out]))
+        if len(maglist) > len(nonempty_maglist):
+            out_band.append('None')
+        if len(magarr_filled) > len(magarr_valid):
+            out_band.append('Invalid')
+        out_bands = out_bands + out_band
+        out_systems = out_systems + [systems[ind_band]] * len(out_band)
+    return set_or_none([out_systems[idx] + '_' + out_bands[idx] for idx in range(len(out_bands))])
+
+
+def count_mag_outliers_loop(datafr, bands, systems):
+    """Reference implementation of count_mag_outliers, looping over the targets."""
+
+    counts = {}
+    for index in range(len(datafr)):
+        placeholders = set(placeholders_loop(datafr[band].iloc[index], system)
+                           for band, system in zip(bands, systems))
+        for placeholder in placeholders - {None}:
+            counts[placeholder] = counts.get(placeholder, 0) + 1
+    return counts
+
+
+@fixture(params=['mixed', 'all_none', 'empty', 'random', 'numeric'])
+def magnitude_frame(request):
+    if request.param == 'mixed':
+        values = [None, np.nan, np.inf, -np.inf, 15.0, 999.9, -9999.0, 0.0, None]
+        data = {band: values[ind:] + values[:ind] for ind, band in enumerate(BANDS)}
+        return records_to_dataframe(list(zip(*data.values())), BANDS)
+    if request.param == 'all_none':
+        return records_to_dataframe([(None,) * len(BANDS)] * 3, BANDS)
+    if request.param == 'empty':
+        return records_to_dataframe([], BANDS)
+    rng = np.random.default_rng(0)
+    choices = [None, np.nan, np.inf, 0.0, 99.9, -9999.0, 12.5, 17.25]
+    if request.param == 'numeric':
+        choices = choices[1:]
+    rows = [tuple(choices[ind] for ind in rng.integers(len(choices), size=len(BANDS)))
+            for _ in range(500)]
+    return records_to_dataframe(rows, BANDS)
+
+
+class TestMagnitudePlaceholders(object):
+    """Tests for the classification of magnitude placeholders."""
+
+    def test_check_mag_outliers(self, magnitudes):
+        out = check_mag_outliers(magnitudes, BANDS, SYSTEMS)
+        assert out == {'SDSS_999.9', 'SDSS_Invalid', 'TMASS_None', 'GAIA_0.0', 'GAIA_-9999.0'}
+
+    def test_count_mag_outliers(self, magnitudes):
+        counts = count_mag_outliers(magnitudes, BANDS, SYSTEMS)
+        assert counts == {'SDSS_999.9': 1, 'SDSS_Invalid': 2, 'TMASS_None': 3, 'GAIA_0.0': 2,
+                          'GAIA_-9999.0': 1}
+
+    def test_same_as_loop(self, magnitude_frame):
+        assert check_mag_outliers(magnitude_frame, BANDS, SYSTEMS) == \
+            check_mag_outliers_loop(magnitude_frame, BANDS, SYSTEMS)
+        assert count_mag_outliers(magnitude_frame, BANDS, SYSTEMS) == \
+            count_mag_outliers_loop(magnitude_frame, BANDS, SYSTEMS)
+
+        mags, null = magnitude_arrays(magnitude_frame, BANDS)
+        assert mags.shape == null.shape == (len(magnitude_frame), len(BANDS))
+        for ind_band, band in enumerate(BANDS):
+            for index, magnitude in enumerate(magnitude_frame[band]):
+                assert null[index, ind_band] == (magnitude is None)
+                if magnitude is None or np.isnan(magnitude):
+                    assert np.isnan(mags[index, ind_band])
+                else:
+                    assert mags[index, ind_band] == magnitude
+
+    def test_check_mag_outliers_clean(self):
+        clean = pd.DataFrame({band: [15.0, 16.0] for band in BANDS})
+        assert check_mag_outliers(clean, BANDS, SYSTEMS) is None
+
+    def test_placeholders_from_row(self):
+        row = {band + '_kind': 0 for band in BANDS}
+        row.update({band + '_placeholder': None for band in BANDS})
+        row['r_kind'], row['z_kind'] = 1, 2
+        row['k_placeholder'] = 99.9
+        assert placeholders_from_row(row) == {'SDSS_None', 'SDSS_Invalid', 'TMASS_99.9'}
+
+
+class TestTargetAccumulator(object):
+    """Tests for the accumulation of target information in chunks."""
+
+    def test_records_to_dataframe(self, targets):
+        assert targets['priority'].dtype == np.int64
+        assert targets['g'].tolist() == [15.0, 999.9, None]
+
+    def test_chunks(self, targets, dimensions):
+        whole = TargetAccumulator(calculate_mag_placeholders=True, dimensions=dimensions)
+        whole.update(targets)
+        chunked = TargetAccumulator(calculate_mag_placeholders=True, dimensions=dimensions)
+        for start in range(len(targets)):
+            partial = TargetAccumulator(calculate_mag_placeholders=True)
+            partial.update(targets.iloc[start:start + 1])
+            chunked.merge(partial)
+
+        for accumulator in [whole, chunked]:
+            obj = CartonInfo.__new__(CartonInfo)
+            accumulator.assign(obj)
+            assert accumulator.n_rows == 3
+            assert obj.cadence_label == {'bright_1x1', 'dark_1x4'}
+            assert obj.instrument_label == {'BOSS', 'APOGEE'}
+            assert (obj.priority_min, obj.priority_max) == (10, 20)
+            assert obj.magnitude_placeholders == {'SDSS_999.9', 'SDSS_None', 'TMASS_None',
+                                                  'GAIA_None'}
+            assert obj.magnitude_placeholder_counts['SDSS_None'] == 1
+
+    def test_sketches(self, targets, dimensions):
+        whole = TargetAccumulator(calculate_sets=False, calculate_sketches=True,
+                                  dimensions=dimensions)
+        whole.update(targets)
+        chunked = TargetAccumulator(calculate_sets=False, calculate_sketches=True,
+                                    dimensions=dimensions)
+        for start in range(len(targets)):
+            partial = TargetAccumulator(calculate_sets=False, calculate_sketches=True)
+            partial.update(targets.iloc[start:start + 1])
+            chunked.merge(partial)
+
+        for accumulator in [whole, chunked]:
+            obj = CartonInfo.__new__(CartonInfo)
+            accumulator.assign(obj)
+            assert obj.sketches_calculated is True
+            assert obj.sketches['priority'].quantile_sketch.quantiles([0, 1]) == [10, 20]
+            # The placeholders are not included in the sketches of the magnitudes
+            assert len(obj.sketches['g']) == 1 and len(obj.sketches['r']) == 2
+
+    def test_update_shared(self, targets):
+        expected = TargetAccumulator(calculate_mag_placeholders=True)
+        expected.update(targets)
+        shared = TargetAccumulator(calculate_mag_placeholders=True)
+        shared.update_shared(targets, n_processes=2)
+        assert shared.n_rows == 3
+        assert shared.values == expected.values
+        assert shared.placeholder_counts == expected.placeholder_counts
+
+    def test_empty(self, dimensions):
+        accumulator = TargetAccumulator(calculate_mag_placeholders=True, dimensions=dimensions)
+        accumulator.update(records_to_dataframe([], ['value']))
+        obj = CartonInfo.__new__(CartonInfo)
+        accumulator.assign(obj)
+        assert obj.value is None and obj.value_min is None
+        assert obj.magnitude_placeholders is None
+
+
+CARTON_LIST = """|  carton |  plan | category | stage | active |
+|   mwm_a | 0.5.0 |  science |   srd |      y |
+
+|   mwm_b | 0.5.0 |  science |   srd |
+|   mwm_c | 0.5.4 |  science |       |      n |
+|   mwm_d | 0.5.4 |  science |  open |      n |
+"""
+
+
+class TestCartonList(object):
+    """Tests for the parsing of input carton list files."""
+
+    def test_iter_carton_list(self, tmp_path, monkeypatch):
+        warnings = []
+        monkeypatch.setattr(log, 'warning', warnings.append)
+        filename = tmp_path / 'list.txt.gz'
+        with gzip.open(filename, 'wt') as carton_list:
+            carton_list.write(CARTON_LIST)
+
+        records = list(iter_carton_list(str(filename)))
+        assert records == [('mwm_a', '0.5.0', 'science', 'srd', 'y'),
+                           ('mwm_d', '0.5.4', 'science', 'open', 'n')]
+        assert [warning.split(': ')[0] for warning in warnings] == \
+            [f'{filename}:4', f'{filename}:5']
+
+    def test_gets_carton_info(self, tmp_path):
+        filename = tmp_path / 'list.txt'
+        filename.write_text(CARTON_LIST.splitlines()[0] + '\n')
+        assert gets_carton_info(str(filename)) == ([], [], [], [], [])
+        filename.write_text(CARTON_LIST)
+        cartons, plans, categories, stages, actives = gets_carton_info(str(filename))
+        assert cartons == ['mwm_a', 'mwm_d'] and actives == ['y', 'n']
+
+
+class TestSelectVersions(object):
+    """Tests for the selection of carton versions with origin='targetdb'."""
+
+    @fixture
+    def cart_results(self):
+        return pd.DataFrame({'carton': ['b', 'a', 'b', 'a', 'c'],
+                             'version_pk': [83, 83, 96, 97, 96]})
+
+    @mark.parametrize(('versions', 'forced_versions', 'index'),
+                      [('latest', None, [3, 2, 4]), ('all', None, [1, 3, 0, 2, 4]),
+                       ('single', None, [2, 4]), ('latest', {'a': 83, 'c': 1}, [1, 2])])
+    def test_select_versions(self, cart_results, versions, forced_versions, index):
+        unique_version = 96 if versions == 'single' else None
+        carts_sel = select_versions(cart_results, versions=versions,
+                                    forced_versions=forced_versions,
+                                    unique_version=unique_version)
+        assert carts_sel.index.tolist() == index
+
+
+class TestTargetQuery(object):
+    """Tests for the columns retrieved by the target query."""
+
+    def test_sets_only(self, targetdb):
+        obj = CartonInfo('mwm_a', '0.5.0', 'science')
+        assert 'magnitude' not in obj.build_query_target(magnitudes=False).sql()[0]
+        df = obj.return_target_dataframe(magnitudes=False)
+        assert df.columns.tolist() == ['value', 'priority', 'cadence_pk', 'lambda_eff',
+                                       'instrument_pk', 'cadence_label', 'instrument_label']
+
+    def test_magnitudes_only(self, targetdb):
+        obj = CartonInfo('mwm_a', '0.5.0', 'science')
+        df = obj.return_target_dataframe(sets=False)
+        assert df.columns.tolist() == BANDS
+
+    def test_assign_target_info(self, targetdb):
+        full = CartonInfo('mwm_a', '0.5.0', 'science')
+        full.assign_target_info(calculate_mag_placeholders=True)
+        for mode in ['dataframe', 'stream']:
+            sets = CartonInfo('mwm_a', '0.5.0', 'science')
+            sets.assign_target_info(mode=mode)
+            mags = CartonInfo('mwm_a', '0.5.0', 'science')
+            mags.assign_target_info(calculate_sets=False, calculate_mag_placeholders=True,
+                                    mode=mode)
+            assert sets.instrument_label == full.instrument_label
+            assert (sets.value_min, sets.value_max) == (full.value_min, full.value_max)
+            assert mags.magnitude_placeholder_counts == full.magnitude_placeholder_counts
+
+    def test_null_values(self, targetdb):
+        # With NULL values the ranges are those of the rest, as in mode='sql'
+        targetdb.execute_sql('UPDATE targetdb.carton_to_target SET value = NULL, '
+                             'priority = NULL WHERE pk = 2')
+        for mode in ['dataframe', 'stream', 'shared']:
+            obj = CartonInfo('mwm_a', '0.5.0', 'science')
+            obj.assign_target_info(mode=mode, chunk_size=1, n_processes=1)
+            assert obj.value == {None, 1.0} and obj.priority == {None, 10}
+            assert (obj.value_min, obj.value_max) == (1.0, 1.0)
+            assert (obj.priority_min, obj.priority_max) == (10, 10)
+
+        targetdb.execute_sql('UPDATE targetdb.carton_to_target SET value = NULL')
+        obj = CartonInfo('mwm_a', '0.5.0', 'science')
+        obj.assign_target_info(mode='stream', chunk_size=2)
+        assert (obj.value, obj.value_min, obj.value_max) == (None, None, None)
+
+    def test_sample_fraction(self, targetdb):
+        full = CartonInfo('mwm_a', '0.5.0', 'science')
+        full.assign_target_info(calculate_mag_placeholders=True)
+        sample = CartonInfo('mwm_a', '0.5.0', 'science')
+        sample.assign_target_info(calculate_mag_placeholders=True, sample_fraction=1)
+        assert full.approximate is False and sample.approximate is True
+        assert sample.n_targets == full.n_targets
+        assert sample.instrument_label == full.instrument_label
+        assert sample.magnitude_placeholder_counts == full.magnitude_placeholder_counts
+
+        # The hash of the pks of mwm_a (1, 2, 4) selects 1 and 2 with a fraction 0.5
+        half = CartonInfo('mwm_a', '0.5.0', 'science')
+        half.assign_target_info(sample_fraction=0.5)
+        query = half.select_targets(CarTar.pk, magnitudes=False, sample_fraction=0.5)
+        assert sorted(pk for pk, in query.tuples()) == [1, 2]
+        assert half.approximate is True and half.n_targets == 2 / 0.5
+        assert half.priority == {10, 20} and half.value_max == 2.0
+
+        # In PostgreSQL the hash uses MOD, since a literal % breaks the psycopg parameters
+        with CarTar.model.bind_ctx(PostgresqlDatabase('targetdb'), bind_refs=False,
+                                   bind_backrefs=False):
+            sql, params = half.select_targets(CarTar.pk, magnitudes=False,
+                                              sample_fraction=0.5).sql()
+        assert sql.count('MOD(') == 2 and '%s' in sql and ' % ' not in sql
+
+        empty = CartonInfo('mwm_a', '0.5.0', 'science')
+        empty.assign_target_info(sample_fraction=1e-12)
+        assert (empty.n_targets, empty.value_min) == (0, None)
+        with raises(AssertionError):
+            empty.assign_target_info(mode='sql', sample_fraction=0.5)
+
+    def test_calculate_sketches(self, targetdb):
+        obj = CartonInfo('mwm_a', '0.5.0', 'science')
+        obj.assign_target_info(calculate_sets=False, calculate_sketches=True)
+        assert obj.sets_calculated is False and obj.sketches_calculated is True
+        assert len(obj.sketches['value']) == obj.n_targets
+        with raises(AssertionError):
+            obj.assign_target_info(mode='sql', calculate_sketches=True)
+
+
+@fixture
+def array_agg(targetdb, monkeypatch):
+    """Adds ArrayAgg to the targetdb stand-in and decodes its arrays in assign_aggregated_info.
+
+    This way the queries of mode='sql' and of the batch functions run in SQLite.
+
+    """
+
+    register_array_agg(targetdb)
+    monkeypatch.setattr(CartonInfo, 'assign_aggregated_info',
+                        decode_arrays(CartonInfo.assign_aggregated_info))
+    return targetdb
+
+
+class TestAggregateQuery(object):
+    """Tests for the sets and ranges calculated in the database (mode='sql')."""
+
+    def test_build_query_aggregate(self, targetdb):
+        obj = CartonInfo('mwm_a', '0.5.0', 'science')
+        with CarTar.model.bind_ctx(PostgresqlDatabase('targetdb'), bind_refs=False,
+                                   bind_backrefs=False):
+            sql, params = obj.build_query_aggregate().sql()
+        for column in ['value', 'priority', 'cadence_pk', 'lambda_eff', 'instrument_pk']:
+            assert f'array_agg(DISTINCT("t1"."{column}")) AS "{column}"' in sql
+        for column in ['value', 'priority']:
+            assert f'MIN("t1"."{column}") AS "{column}_min"' in sql
+            assert f'MAX("t1"."{column}") AS "{column}_max"' in sql
+        assert 'magnitude' not in sql and 'GROUP BY' not in sql
+        assert sql.endswith('WHERE ("t1"."carton_pk" = %s)') and params == [1]
+
+    @mark.parametrize('carton, plan', [('mwm_a', '0.5.0'), ('mwm_b', '0.5.0'),
+                                       ('mwm_a', '0.5.4')])
+    def test_same_as_dataframe(self, array_agg, carton, plan):
+        array_agg.execute_sql('UPDATE targetdb.carton_to_target SET cadence_pk = NULL, '
+                              'value = NULL WHERE pk = 2')
+        full = CartonInfo(carton, plan, 'science')
+        full.assign_target_info()
+        sql = CartonInfo(carton, plan, 'science')
+        sql.assign_target_info(mode='sql')
+        assert sql.sets_calculated is True
+        for attribute in ['value', 'priority', 'cadence_pk', 'cadence_label', 'lambda_eff',
+                          'instrument_pk', 'instrument_label', 'value_min', 'value_max',
+                          'priority_min', 'priority_max']:
+            assert getattr(sql, attribute) == getattr(full, attribute)
+
+    def test_assign_aggregated_info_nulls(self, targetdb):
+        obj = CartonInfo('mwm_a', '0.5.0', 'science')
+        obj.assign_aggregated_info({'value': None, 'priority': [None], 'cadence_pk': [None, 1],
+                                    'lambda_eff': [], 'instrument_pk': [None],
+                                    'value_min': None, 'value_max': None,
+                                    'priority_min': None, 'priority_max': None})
+        assert (obj.value, obj.priority, obj.lambda_eff) == (None, None, None)
+        assert (obj.instrument_pk, obj.instrument_label) == (None, None)
+        assert obj.cadence_pk == {None, 1} and obj.cadence_label == {None, 'bright_1x1'}
+        assert (obj.value_min, obj.value_max, obj.priority_min, obj.priority_max) == \
+            (None, None, None, None)
+
+        # A carton without targets returns a single row of NULLs (or no row at all)
+        for res in [None, {}]:
+            empty = CartonInfo('mwm_a', '0.5.0', 'science')
+            empty.assign_aggregated_info(res)
+            assert empty.sets_calculated is True
+            assert (empty.value, empty.cadence_label, empty.value_min) == (None, None, None)
+
+
+class TestBatch(object):
+    """Tests for the target information of several cartons assigned at once (batch=True)."""
+
+    def test_build_query_aggregate_batch(self, targetdb):
+        with CarTar.model.bind_ctx(PostgresqlDatabase('targetdb'), bind_refs=False,
+                                   bind_backrefs=False):
+            sql, params = build_query_aggregate_batch([1, 3]).sql()
+        assert sql.startswith('SELECT "t1"."carton_pk" AS "carton_pk", array_agg(DISTINCT(')
+        assert sql.endswith('WHERE ("t1"."carton_pk" IN (%s, %s)) GROUP BY "t1"."carton_pk"')
+        assert params == [1, 3]
+
+    @mark.parametrize('chunk_size', [1, 2, 500])
+    def test_assign_target_info_batch(self, array_agg, chunk_size):
+        # mwm_a is repeated, mwm_a 0.5.4 has no targets, and mwm_c is not in targetdb
+        cartons = [('mwm_a', '0.5.0'), ('mwm_b', '0.5.0'), ('mwm_a', '0.5.4'),
+                   ('mwm_a', '0.5.0'), ('mwm_c', '0.5.0')]
+        objects = [CartonInfo(carton, plan, 'science') for carton, plan in cartons]
+        assign_target_info_batch(objects, calculate_mag_placeholders=True,
+                                 chunk_size=chunk_size)
+
+        for (carton, plan), obj in zip(cartons[:4], objects):
+            single = CartonInfo(carton, plan, 'science')
+            single.assign_target_info(calculate_mag_placeholders=True)
+            assert obj.sets_calculated is True and obj.mag_placeholders_calculated is True
+            for attribute in ['value', 'priority', 'cadence_label', 'instrument_label',
+                              'lambda_eff', 'value_min', 'value_max', 'priority_min',
+                              'priority_max', 'magnitude_placeholders',
+                              'magnitude_placeholder_counts']:
+                assert getattr(obj, attribute) == getattr(single, attribute)
+        assert (objects[2].value, objects[2].magnitude_placeholder_counts) == (None, {})
+        assert objects[4].in_targetdb is False and objects[4].sets_calculated is False
+
+    def test_process_cartons(self, array_agg, carton_list):
+        (carton_list / 'list.txt').write_text(
+            '|  carton |  plan | category | stage | active |\n'
+            '|   mwm_a | 0.5.0 |  science |   srd |      y |\n'
+            '|   mwm_b | 0.5.0 |  science |   srd |      y |\n'
+            '|   mwm_a | 0.5.4 |  science |   srd |      y |\n'
+            '|   mwm_a | 0.5.0 |  science |   srd |      y |\n'
+            '|   mwm_c | 0.5.0 |  science |   srd |      y |\n')
+        kwargs = dict(origin='custom', inputname='list.txt', write_output=True, assign_sets=True,
+                      assign_placeholders=True, overwrite=True)
+        output = carton_list / 'Info_list_all.csv'
+
+        process_cartons(**kwargs)
+        expected = output.read_text()
+        objects = process_cartons(batch=True, return_objects=True, **kwargs)
+        assert output.read_text() == expected
+        assert [(obj.carton, obj.plan) for obj in objects] == \
+            [('mwm_a', '0.5.0'), ('mwm_b', '0.5.0'), ('mwm_a', '0.5.4'), ('mwm_a', '0.5.0')]
+        assert len(expected.splitlines()) == 5
+
+
+class TestThreads(object):
+    """Tests for the cartons processed in a pool of threads."""
+
+    def test_iter_assign_target_info(self, targetdb, monkeypatch):
+        cartons = [('mwm_a', '0.5.0'), ('mwm_b', '0.5.0'), ('mwm_a', '0.5.4')] * 3
+        connections = []
+        connect = targetdb._connect
+        monkeypatch.setattr(targetdb, '_connect',
+                            lambda: connections.append(connect()) or connections[-1])
+
+        rows = {}
+        for max_workers in [1, 3]:
+            objects = [CartonInfo(carton, plan, 'science') for carton, plan in cartons]
+            del connections[:]
+            processed = list(iter_assign_target_info(objects, max_workers=max_workers,
+                                                     calculate_mag_placeholders=True))
+            assert [id(obj) for obj in processed] == [id(obj) for obj in objects]
+            rows[max_workers] = [(obj.carton, obj.plan, obj.value, obj.priority_max,
+                                  obj.cadence_label, obj.magnitude_placeholder_counts)
+                                 for obj in processed]
+        assert rows[3] == rows[1]
+
+        # Each worker opens a single connection, which is closed at the end
+        assert 1 <= len(connections) <= 3
+        for connection in connections:
+            with raises(sqlite3.ProgrammingError):
+                connection.execute('SELECT 1')
+
+    def test_failing_carton(self, targetdb, monkeypatch):
+        assign_target_info = CartonInfo.assign_target_info
+        processed = []
+
+        def failing(obj, **kwargs):
+            if obj.carton == 'mwm_b':
+                raise RuntimeError('connection lost')
+            processed.append(obj.carton)
+            assign_target_info(obj, **kwargs)
+
+        monkeypatch.setattr(CartonInfo, 'assign_target_info', failing)
+        objects = [CartonInfo(carton, '0.5.0', 'science') for carton in ['mwm_a', 'mwm_b'] * 20]
+        connections = []
+        connect = targetdb._connect
+        monkeypatch.setattr(targetdb, '_connect',
+                            lambda: connections.append(connect()) or connections[-1])
+        processing = iter_assign_target_info(objects, max_workers=2)
+        assert next(processing) is objects[0]
+        with raises(RuntimeError):
+            list(processing)
+
+        # The cartons that were not started when it failed are skipped, and the connections of
+        # the workers are closed
+        assert len(processed) < 20
+        assert 1 <= len(connections) <= 2
+        for connection in connections:
+            with raises(sqlite3.ProgrammingError):
+                connection.execute('SELECT 1')
+
+
+class TestAsync(object):
+    """Tests for the asyncio front end against the SQLite stand-in of targetdb."""
+
+    def test_afetch(self, targetdb):
+        async def fetch_all():
+            limiter = asyncio.Semaphore(2)
+            return await asyncio.gather(
+                *[CartonInfo.afetch(carton, plan, 'science', limiter=limiter,
+                                    calculate_mag_placeholders=True)
+                  for carton, plan in [('mwm_a', '0.5.0'), ('mwm_b', '0.5.0'),
+                                       ('mwm_a', '0.5.4'), ('mwm_c', '0.5.0')]])
+
+        objects = asyncio.run(fetch_all())
+        assert [obj.carton_pk for obj in objects] == [1, 2, 3, None]
+
+        sync = CartonInfo('mwm_a', '0.5.0', 'science')
+        sync.assign_target_info(calculate_mag_placeholders=True)
+        assert objects[0].cadence_label == sync.cadence_label == {'bright_1x1', 'dark_1x4'}
+        assert objects[0].magnitude_placeholder_counts == sync.magnitude_placeholder_counts
+        assert objects[1].magnitude_placeholders == {'SDSS_-9999.0'}
+        assert objects[2].value is None
+
+    def test_areturn_target_dataframe(self, targetdb):
+        obj = CartonInfo('mwm_a', '0.5.0', 'science', catalog=CartonCatalog.load())
+        df = asyncio.run(obj.areturn_target_dataframe())
+        pd.testing.assert_frame_equal(df, obj.return_target_dataframe())
+        assert len(df) == 3
+        assert df['instrument_label'].tolist() == ['BOSS', 'APOGEE', 'BOSS']
+
+    def test_acheck_existence(self, targetdb):
+        obj = CartonInfo('mwm_b', '0.5.4', 'science')
+        diff = asyncio.run(obj.acheck_existence(log, verbose=False))
+        assert diff['plan'].tolist() == ['0.5.4', '0.5.0']
+
+
+class TestResume(object):
+    """Tests for the checkpoints of process_cartons."""
+
+    def test_resume(self, targetdb, carton_list, monkeypatch):
+        assign_target_info = CartonInfo.assign_target_info
+        processed = []
+
+        def failing(obj, **kwargs):
+            if obj.carton == 'mwm_b':
+                raise RuntimeError('connection lost')
+            processed.append(obj.carton)
+            assign_target_info(obj, **kwargs)
+
+        kwargs = dict(origin='custom', inputname='list.txt', write_output=True, assign_sets=True)
+        monkeypatch.setattr(CartonInfo, 'assign_target_info', failing)
+        with raises(RuntimeError):
+            process_cartons(**kwargs)
+        assert (carton_list / 'Info_list_sets.checkpoint').exists()
+
+        def counting(obj, **kwargs):
+            processed.append(obj.carton)
+            assign_target_info(obj, **kwargs)
+
+        monkeypatch.setattr(CartonInfo, 'assign_target_info', counting)
+        objects = process_cartons(resume=True, return_objects=True, **kwargs)
+        assert processed == ['mwm_a', 'mwm_b']
+        assert [obj.priority_max for obj in objects] == [20, 5]
+        assert len((carton_list / 'Info_list_sets.csv').read_text().splitlines()) == 3
+        assert not (carton_list / 'Info_list_sets.checkpoint').exists()
+        assert 'RESUMING' in (carton_list.parent.parent / 'logs' /
+                              'origin_custom_sets_True_mags_False.log').read_text()
+
+    def test_log_appended(self, targetdb, carton_list):
+        kwargs = dict(origin='custom', inputname='list.txt', write_output=True, assign_sets=True,
+                      overwrite=True)
+        logs = carton_list.parent.parent / 'logs'
+        process_cartons(**kwargs)
+        size = (logs / 'origin_custom_sets_True_mags_False.log').stat().st_size
+        process_cartons(**kwargs)
+        assert [path.name for path in logs.iterdir()] == ['origin_custom_sets_True_mags_False.log']
+        assert (logs / 'origin_custom_sets_True_mags_False.log').stat().st_size > size
+
+
+class TestRefresh(object):
+    """Tests for the fingerprint based refresh of process_cartons outputs."""
+
+    def test_refresh(self, targetdb, carton_list, monkeypatch):
+        assign_target_info = CartonInfo.assign_target_info
+        processed = []
+
+        def counting(obj, **kwargs):
+            processed.append(obj.carton)
+            assign_target_info(obj, **kwargs)
+
+        monkeypatch.setattr(CartonInfo, 'assign_target_info', counting)
+        kwargs = dict(origin='custom', inputname='list.txt', write_output=True, assign_sets=True,
+                      refresh=True)
+        output = carton_list / 'Info_list_sets.csv'
+
+        process_cartons(**kwargs)
+        first = output.read_text()
+        assert first.splitlines()[1].endswith('|3:4:0.3.5')
+
+        process_cartons(**kwargs)
+        assert output.read_text() == first
+        assert processed == ['mwm_a', 'mwm_b']
+
+        insert_rows(targetdb, 'carton_to_target', [(5, 2, 5, 2, 1, 16000.0, 1, 1.0)])
+        process_cartons(**kwargs)
+        assert processed == ['mwm_a', 'mwm_b', 'mwm_b']
+        lines = output.read_text().splitlines()
+        assert lines[1] == first.splitlines()[1]
+        assert lines[2].endswith('|2:5:0.3.5')
+
+        # The input and carton dependent columns of the copied rows are updated
+        targetdb.execute_sql("UPDATE targetdb.carton SET program = 'mwm_galactic' WHERE pk = 1")
+        (carton_list / 'list.txt').write_text(
+            (carton_list / 'list.txt').read_text().replace('srd |      y', 'drd |      n', 1))
+        process_cartons(**kwargs)
+        assert processed == ['mwm_a', 'mwm_b', 'mwm_b']
+        header, row = [line.split('|') for line in output.read_text().splitlines()[:2]]
+        row = dict(zip(header, row))
+        assert (row['stage'], row['active'], row['program']) == ('drd', 'n', 'mwm_galactic')
+        assert row['priority_max'] == '20' and row['fingerprint'] == '3:4:0.3.5'
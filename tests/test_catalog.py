@@ -0,0 +1,109 @@
+# encoding: utf-8
+#
+# test_catalog.py
+
+from pytest import fixture, mark
+
+from cartons_inventory import log
+from cartons_inventory.cartons import CartonInfo, process_cartons
+from cartons_inventory.catalog import CartonCatalog, DimensionTables
+from cartons_inventory.testing import insert_rows
+
+
+def carton_row(carton_pk, carton, plan, category_label, version_pk):
+    return {'carton_pk': carton_pk, 'carton': carton, 'program': carton.split('_')[1],
+            'version_pk': version_pk, 'category_pk': 0, 'mapper_pk': 1, 'plan': plan,
+            'tag': '0.3.5', 'category_label': category_label, 'mapper_label': 'BHM'}
+
+
+@fixture
+def catalog():
+    cartons = [carton_row(1, 'bhm_rm_core', '0.5.0', 'science', 83),
+               carton_row(2, 'bhm_rm_core', '0.5.4', 'science', 96),
+               carton_row(3, 'bhm_rm_var', '0.5.0', 'science', 83),
+               carton_row(4, 'bhm_aqmes_med', '0.5.0', 'science', 83)]
+    versions = [{'pk': 83, 'plan': '0.5.0', 'tag': '0.3.5'},
+                {'pk': 96, 'plan': '0.5.4', 'tag': '0.3.5'},
+                {'pk': 97, 'plan': '0.5.5', 'tag': '0.3.6'}]
+    return CartonCatalog(cartons, versions)
+
+
+class TestCartonCatalog(object):
+    """Tests for the in-memory carton catalog."""
+
+    def test_lookup(self, catalog):
+        assert catalog.lookup('bhm_rm_core', '0.5.4', 'science')['carton_pk'] == 2
+        assert catalog.lookup('bhm_rm_core', '0.5.4', 'standard_boss') is None
+
+    def test_alternatives(self, catalog):
+        assert [row['plan'] for row in catalog.alternatives('bhm_rm_core')] == ['0.5.0', '0.5.4']
+        assert catalog.alternatives('mwm_uvex') == []
+
+    @mark.parametrize(('pattern', 'pks'), [('bhm_rm_%', [1, 2, 3]), ('%%', [1, 2, 3, 4]),
+                                           ('BHM_RM_CORE', [1, 2]), ('bhm_rm_va_', [3]),
+                                           ('bhm_rm', [])])
+    def test_match(self, catalog, pattern, pks):
+        assert [row['carton_pk'] for row in catalog.match(pattern)] == pks
+
+    def test_carton_info(self, catalog):
+        obj = CartonInfo('bhm_rm_core', '0.5.4', 'science', catalog=catalog)
+        assert obj.in_targetdb is True
+        assert obj.carton_pk == 2
+        assert obj.version_pk == 96
+        assert obj.mapper_label == 'BHM'
+
+    def test_carton_info_not_in_targetdb(self, catalog):
+        obj = CartonInfo('bhm_rm_core', '0.5.5', 'science', catalog=catalog)
+        assert obj.in_targetdb is False
+        assert obj.version_pk == 97
+        assert obj.tag == '0.3.6'
+
+        diff = obj.check_existence(log, verbose=False)
+        assert diff['plan'].tolist() == ['0.5.5', '0.5.0', '0.5.4']
+        assert diff['in_targetdb'].tolist() == [False, True, True]
+
+
+class TestDimensionTables(object):
+    """Tests for the in-memory dimension tables."""
+
+    def test_label_column(self):
+        dimensions = DimensionTables(cadence={1: 'bright_1x1'}, instrument={})
+        labels = dimensions.label_column('cadence', [1, None, 3, 1])
+        assert labels.tolist() == ['bright_1x1', None, None, 'bright_1x1']
+
+    def test_get(self, targetdb):
+        dimensions = DimensionTables.get()
+        assert DimensionTables.get() is dimensions
+        assert dimensions.instrument == {0: 'BOSS', 1: 'APOGEE'}
+        assert dimensions.version[2]['plan'] == '0.5.4'
+
+    def test_refresh(self, targetdb, carton_list):
+        dimensions = DimensionTables.get()
+        insert_rows(targetdb, 'version', [(3, '0.5.5', '0.3.6')])
+        insert_rows(targetdb, 'carton', [(4, 'mwm_c', 'mwm', 3, 0, 0)])
+        assert 3 not in DimensionTables.get().version
+
+        refreshed = DimensionTables.refresh()
+        assert refreshed is not dimensions and DimensionTables.get() is refreshed
+        assert refreshed.version[3]['plan'] == '0.5.5'
+
+        # process_cartons loads them again in each run, so new versions are found
+        insert_rows(targetdb, 'version', [(4, '0.5.6', '0.3.6')])
+        insert_rows(targetdb, 'carton', [(5, 'mwm_c', 'mwm', 4, 0, 0)])
+        objects = process_cartons(origin='targetdb', all_cartons=False,
+                                  cartons_name_pattern='mwm_c', versions='all',
+                                  return_objects=True)
+        assert [obj.plan for obj in objects] == ['0.5.5', '0.5.6']
+
+    def test_load_catalog(self, targetdb, caplog):
+        catalog = CartonCatalog.load()
+        assert len(catalog) == 3
+        assert catalog.lookup('mwm_a', '0.5.4', 'science')['mapper_label'] == 'MWM'
+        assert not caplog.records
+
+        # Cartons with a version_pk not in the dimension tables are left out with a warning
+        insert_rows(targetdb, 'carton', [(4, 'mwm_c', 'mwm', 9, 0, 0)])
+        catalog = CartonCatalog.load()
+        assert len(catalog) == 3 and catalog.alternatives('mwm_c') == []
+        assert [record.levelname for record in caplog.records] == ['WARNING']
+        assert 'carton=mwm_c carton_pk=4' in caplog.records[0].getMessage()
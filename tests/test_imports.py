@@ -0,0 +1,46 @@
+# encoding: utf-8
+#
+# test_imports.py
+
+import json
+import subprocess
+import sys
+
+from cartons_inventory.imports import LazyModule, lazy_import
+
+
+def imported_after(statement):
+    """Runs statement in a new python and returns the state of the heavy modules after it."""
+
+    code = (f'{statement}\nimport json, sys\n'
+            'print(json.dumps({name: name in sys.modules for name in '
+            '["pandas", "astropy", "pyarrow", "sdsstools", "sdssdb"]}))')
+    output = subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE,
+                            text=True)
+    return json.loads(output.stdout.splitlines()[-1])
+
+
+class TestImports(object):
+    """Tests for the deferred imports."""
+
+    def test_lazy_import(self):
+        assert lazy_import('json') is json
+        assert lazy_import('not_a_package.module') is None
+
+        module = LazyModule('email.mime.text')
+        assert module.MIMEText.__name__ == 'MIMEText'
+        assert 'MIMEText' in module.__dict__
+
+    def test_package(self):
+        modules = imported_after('import cartons_inventory, cartons_inventory.main\n'
+                                 'from cartons_inventory import metrics, profiling, runlog')
+        assert not any(modules.values())
+
+    def test_cartons(self):
+        modules = imported_after(
+            'import cartons_inventory.cartons as cartons\n'
+            'assert cartons.Car.model._meta.database.is_closed()\n'
+            'assert not {"config", "log"} & set(vars(cartons.cartons_inventory))')
+        # sdsstools is imported by sdssdb, but the config and log are not created
+        assert modules == {'pandas': False, 'astropy': False, 'pyarrow': False,
+                           'sdsstools': True, 'sdssdb': True}
@@ -4,7 +4,7 @@
 
 from pytest import mark
 
-from cartons_inventory.main import math
+from cartons_inventory.main import get_range, math
 
 
 class TestMath(object):
@@ -15,3 +15,14 @@ class TestMath(object):
     def test_math(self, arg1, arg2, operator, result):
 
         assert math(arg1, arg2, arith_operator=operator) == result
+
+
+class TestGetRange(object):
+    """Tests for the ``get_range`` function in main.py."""
+
+    @mark.parametrize(('set_p', 'result'),
+                      [({1.0, 3.0, 2.0}, (1.0, 3.0)), ({None, 2.0, 1.0}, (1.0, 2.0)),
+                       ({None}, (None, None)), (None, (None, None))])
+    def test_get_range(self, set_p, result):
+
+        assert get_range(set_p) == result
@@ -0,0 +1,57 @@
+# encoding: utf-8
+#
+# test_metrics.py
+
+import json
+
+from cartons_inventory import metrics
+from cartons_inventory.cartons import process_cartons
+
+
+def read_records(path):
+    return [json.loads(line) for line in open(path)]
+
+
+class TestRunMetrics(object):
+    """Tests for the stage timers and the metrics records."""
+
+    def test_disabled(self):
+        assert metrics.is_active() is False
+        with metrics.carton('mwm_a', '0.5.0', 'science'), metrics.stage('write') as stage:
+            metrics.add_rows(10)
+        assert stage is None
+
+    def test_records(self, tmp_path):
+        run_metrics = metrics.RunMetrics(str(tmp_path / 'metrics.jsonl'))
+        with run_metrics.activate():
+            with metrics.carton('mwm_a', '0.5.0', 'science'):
+                with metrics.stage('target_query'):
+                    metrics.add_rows(10)
+                with metrics.stage('write'):
+                    pass
+            with metrics.stage('carton_lookup'):
+                pass
+        assert metrics.is_active() is False
+        run_metrics.finish_carton('mwm_a', '0.5.0', 'science')
+        summary = run_metrics.close()
+
+        records = read_records(tmp_path / 'metrics.jsonl')
+        assert [record['type'] for record in records] == ['carton', 'summary']
+        assert set(records[0]['stages']) == {'target_query', 'write'}
+        assert records[0]['rows'] == 10 and summary['rows'] == 10
+        assert set(summary['stages']) == {'target_query', 'write', 'carton_lookup'}
+        assert summary['n_cartons'] == 1 and summary['peak_memory_mb'] > 0
+
+    def test_process_cartons(self, targetdb, carton_list):
+        process_cartons(origin='custom', inputname='list.txt', write_output=True,
+                        assign_sets=True, assign_placeholders=True, collect_metrics=True,
+                        max_workers=2)
+        assert metrics.is_active() is False
+
+        name = 'origin_custom_sets_True_mags_True_metrics.jsonl'
+        path = carton_list.parent.parent / 'logs' / name
+        records = read_records(path)
+        assert [record['carton'] for record in records[:-1]] == ['mwm_a', 'mwm_b']
+        assert records[0]['rows'] == 3 and records[-1]['rows'] == 4
+        for name in ['carton_lookup', 'target_query', 'dataframe', 'sets', 'write']:
+            assert name in records[0]['stages']
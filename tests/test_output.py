@@ -0,0 +1,52 @@
+# encoding: utf-8
+#
+# test_output.py
+
+import pytest
+
+from cartons_inventory.cartons import process_cartons
+from cartons_inventory.output import OutputWriter, read_output
+
+
+pa = pytest.importorskip('pyarrow')
+
+
+COLUMNS = ['carton', 'plan', 'cadence_label', 'priority', 'priority_min',
+           'magnitude_placeholders', 'magnitude_placeholder_counts']
+ROWS = [['mwm_a', '0.5.0', {'dark_1x4', 'bright_1x1'}, {20, 10}, 10, {'SDSS_None'},
+         {'SDSS_None': 2}],
+        ['mwm_b', '0.5.0', None, None, None, None, {}]]
+
+
+class TestOutputWriter(object):
+    """Tests for the output files of process_cartons."""
+
+    @pytest.mark.parametrize('output_format', ['parquet', 'arrow'])
+    def test_columnar(self, tmp_path, output_format):
+        filename = str(tmp_path / ('output.' + output_format))
+        writer = OutputWriter(filename, COLUMNS, sets=['cadence_label', 'priority'],
+                              output_format=output_format)
+        for row in ROWS:
+            writer.writerow(row)
+        writer.close()
+
+        table = read_output(filename)
+        assert table.schema.field('plan').type == pa.dictionary(pa.int32(), pa.string())
+        assert table.schema.field('priority').type == pa.list_(pa.int64())
+        assert table.schema.field('priority_min').type == pa.int64()
+        assert table.column('cadence_label').to_pylist() == [['bright_1x1', 'dark_1x4'], None]
+        assert table.column('magnitude_placeholder_counts').to_pylist() == \
+            [[('SDSS_None', 2)], []]
+
+    def test_process_cartons(self, targetdb, carton_list):
+        for output_format in ['csv', 'parquet']:
+            process_cartons(origin='custom', inputname='list.txt', write_output=True,
+                            assign_sets=True, assign_placeholders=True,
+                            output_format=output_format)
+
+        table = read_output(str(carton_list / 'Info_list_all.parquet'))
+        csv_lines = (carton_list / 'Info_list_all.csv').read_text().splitlines()
+        assert table.column_names == csv_lines[0].split('|')
+        assert table.column('carton').to_pylist() == ['mwm_a', 'mwm_b']
+        assert table.column('instrument_label').to_pylist() == [['APOGEE', 'BOSS'], ['BOSS']]
+        assert table.column('value_max').to_pylist() == [2.0, 1.0]
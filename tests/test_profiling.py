@@ -0,0 +1,74 @@
+# encoding: utf-8
+#
+# test_profiling.py
+
+import json
+
+from cartons_inventory import metrics, profiling
+from cartons_inventory.cartons import CarTar, process_cartons
+
+
+class TestQueryProfile(object):
+    """Tests for the recording and explanation of the queries."""
+
+    def test_records(self, targetdb, tmp_path):
+        profile = profiling.QueryProfile(targetdb, str(tmp_path / 'queries.json'), explain=1)
+        query = CarTar.select(CarTar.pk).where(CarTar.carton_pk == 1).tuples()
+        assert len(query) == 3
+        assert profile.queries == []
+
+        with profile.activate(), metrics.carton('mwm_a', '0.5.0', 'science'):
+            assert len(list(query.clone())) == 3
+        assert profiling.is_active() is False
+
+        report = profile.close()
+        assert 'cursor' not in vars(targetdb) and not hasattr(targetdb, '_profiled')
+        assert report['n_queries'] == 1 and report['rows'] == 3
+        record = report['slowest'][0]
+        assert 'carton_to_target' in record['sql'] and record['params'] == [1]
+        assert record['carton'] == {'carton': 'mwm_a', 'plan': '0.5.0',
+                                    'category_label': 'science'}
+        # There are no indexes in the stand-in, so carton_to_target is scanned
+        assert len(record['plan']) > 0
+        assert record['sequential_scans'] == [line for line in record['plan']
+                                              if line.startswith('SCAN ')] != []
+        with open(tmp_path / 'queries.json') as output:
+            assert json.load(output)['n_queries'] == 1
+
+    def test_install(self, targetdb):
+        cursor = targetdb.cursor
+        profiling.install(targetdb)
+        profiling.install(targetdb)
+        assert targetdb.cursor != cursor
+        profiling.uninstall(targetdb)
+        assert targetdb.cursor != cursor
+        profiling.uninstall(targetdb)
+        assert targetdb.cursor == cursor and 'cursor' not in vars(targetdb)
+        profiling.uninstall(targetdb)
+
+    def test_sequential_scans(self):
+        plan = ['Hash Join  (cost=1.0..2.0)', '  ->  Seq Scan on carton_to_target',
+                '  ->  Index Scan using carton_pkey on carton']
+        assert profiling.sequential_scans(plan, 'postgresql') == ['->  Seq Scan on '
+                                                                  'carton_to_target']
+        plan = ['SCAN c', 'SEARCH v USING INTEGER PRIMARY KEY (rowid=?)']
+        assert profiling.sequential_scans(plan, 'sqlite') == ['SCAN c']
+
+    def test_process_cartons(self, targetdb, carton_list):
+        process_cartons(origin='custom', inputname='list.txt', write_output=True,
+                        assign_sets=True, assign_placeholders=True, mode='stream',
+                        query_profile=True, explain_queries=2, max_workers=2)
+        assert profiling.is_active() is False
+
+        name = 'origin_custom_sets_True_mags_True_queries.json'
+        with open(carton_list.parent.parent / 'logs' / name) as output:
+            report = json.load(output)
+        assert report['n_queries'] == len(report['queries']) > 0
+        assert len(report['slowest']) == 2
+        cartons = {record['carton']['carton'] for record in report['queries']
+                   if record['carton'] is not None}
+        assert cartons == {'mwm_a', 'mwm_b'}
+        # The targets of the cartons (3 and 1) are fetched in the stream mode queries
+        target_queries = [record for record in report['queries']
+                          if record['carton'] is not None and 'magnitude' in record['sql']]
+        assert sum(record['rows'] for record in target_queries) == 4
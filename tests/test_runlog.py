@@ -0,0 +1,101 @@
+# encoding: utf-8
+#
+# test_runlog.py
+
+import json
+import logging
+import threading
+
+from pytest import mark, raises
+
+from cartons_inventory import log, metrics, profiling, runlog
+from cartons_inventory.cartons import CartonInfo, process_cartons
+
+
+class RecordingHandler(logging.Handler):
+    """Handler that keeps the records it emits and the thread that emitted them."""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record, self.format(record), threading.current_thread()))
+
+
+class TestRunLog(object):
+    """Tests for the queued and JSON lines logs."""
+
+    def test_queued_log(self):
+        logger = logging.getLogger('cartons_inventory_test_queued_log')
+        handler = RecordingHandler()
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+
+        queued_log = runlog.QueuedLog(logger)
+        queued_log.start()
+        assert logger.handlers == [queued_log.queue_handler]
+        with metrics.carton('mwm_a', '0.5.0', 'science'):
+            logger.info('carton=%s (%d/%d)', 'mwm_a', 1, 2)
+        logger.debug('not emitted')
+        queued_log.stop()
+        assert logger.handlers == [handler]
+
+        assert len(handler.records) == 1
+        record, message, thread = handler.records[0]
+        # The message was formatted by the listener thread
+        assert message == 'carton=mwm_a (1/2)' and record.msg == 'carton=%s (%d/%d)'
+        assert thread is not threading.current_thread()
+        assert (record.carton, record.plan, record.category_label) == ('mwm_a', '0.5.0', 'science')
+
+    def test_carton_filter(self):
+        carton_filter = runlog.CartonFilter()
+        record = logging.LogRecord('test', logging.INFO, __file__, 1, 'rows: %d', (10,), None)
+        assert carton_filter.filter(record) is True
+        assert (record.carton, record.plan, record.category_label) == (None, None, None)
+
+        record = logging.LogRecord('test', logging.INFO, __file__, 1, 'rows: %d', (10,), None)
+        with metrics.carton('mwm_a', '0.5.0', 'science'):
+            carton_filter.filter(record)
+        # The carton of a record (e.g. set by LazyQueueHandler) is kept
+        carton_filter.filter(record)
+        assert (record.carton, record.plan, record.category_label) == ('mwm_a', '0.5.0', 'science')
+
+    @mark.parametrize('log_mode', ['sync', 'queue'])
+    def test_process_cartons(self, targetdb, carton_list, log_mode):
+        process_cartons(origin='custom', inputname='list.txt', write_output=True,
+                        assign_sets=True, assign_placeholders=True, visualize=True,
+                        log_format='json', log_mode=log_mode)
+        assert runlog._queued_log is None
+        assert log.sh in log.handlers and log.fh in log.handlers
+        assert not any(isinstance(handler, runlog.LazyQueueHandler) for handler in log.handlers)
+
+        path = carton_list.parent.parent / 'logs' / 'origin_custom_sets_True_mags_True.json'
+        lines = [json.loads(line) for line in open(path)]
+        assert all('timestamp' in line and 'level' in line for line in lines)
+        messages = [line['message'] for line in lines]
+        assert 'Ran assign_target_info on carton mwm_b' in messages
+        assert any(line.get('carton') == 'mwm_a' and line['message'].startswith('### priority')
+                   for line in lines)
+
+    def test_process_cartons_fails(self, targetdb, carton_list, monkeypatch):
+        def failing(obj, **kwargs):
+            raise RuntimeError('targetdb is gone')
+
+        monkeypatch.setattr(CartonInfo, 'assign_target_info', failing)
+        with raises(RuntimeError):
+            process_cartons(origin='custom', inputname='list.txt', write_output=True,
+                            assign_sets=True, collect_metrics=True, query_profile=True,
+                            log_mode='queue')
+
+        # The queued log, the query profile, and the metrics of the run are closed anyway
+        assert runlog._queued_log is None and profiling.is_active() is False
+        assert 'cursor' not in vars(targetdb) and not hasattr(targetdb, '_profiled')
+        logs = carton_list.parent.parent / 'logs'
+        with open(logs / 'origin_custom_sets_True_mags_False_queries.json') as output:
+            assert json.load(output)['n_queries'] > 0
+        with open(logs / 'origin_custom_sets_True_mags_False_metrics.jsonl') as output:
+            assert json.loads(output.readlines()[-1])['n_cartons'] == 0
+        # The checkpoint is kept to resume the run
+        assert (carton_list / 'Info_list_sets.csv').read_text().startswith('carton|')
+        assert (carton_list / 'Info_list_sets.checkpoint').exists()
@@ -0,0 +1,95 @@
+# encoding: utf-8
+#
+# test_sketches.py
+
+import numpy as np
+from pytest import fixture, raises
+
+from cartons_inventory.sketches import (DistributionSketch, Histogram,
+                                        QuantileSketch, dumps, loads,
+                                        new_sketches, sketch_columns)
+
+
+@fixture
+def values():
+    return np.random.default_rng(0).normal(15, 2, size=200000)
+
+
+class TestQuantileSketch(object):
+    """Tests for the mergeable quantile sketch."""
+
+    def test_quantiles(self, values):
+        sketch = QuantileSketch(k=128)
+        sketch.update(values)
+        fractions = [0, 0.05, 0.5, 0.95, 1]
+        ranks = np.searchsorted(np.sort(values), sketch.quantiles(fractions)) / len(values)
+        assert np.allclose(ranks, fractions, atol=0.02)
+        assert sketch.quantiles([0, 1]) == [values.min(), values.max()]
+        assert sum(len(level) for level in sketch.levels) < 4 * 128
+
+    def test_merge(self, values):
+        merged = QuantileSketch(k=128)
+        for chunk in np.array_split(values, 50):
+            partial = QuantileSketch(k=128)
+            partial.update(chunk)
+            merged.merge(partial)
+        weights = sum(len(level) * 2 ** ind for ind, level in enumerate(merged.levels))
+        assert len(merged) == weights == len(values)
+        assert abs(merged.quantiles([0.5])[0] - np.median(values)) < 0.1
+        with raises(AssertionError):
+            merged.merge(QuantileSketch(k=64))
+
+    def test_many_merges(self, values):
+        # The errors of the compactions of many merges cancel out, instead of adding up
+        merged = QuantileSketch(k=128, seed=0)
+        for index, chunk in enumerate(np.array_split(values, 1000)):
+            partial = QuantileSketch(k=128, seed=index + 1)
+            partial.update(chunk)
+            merged.merge(partial)
+        assert len(merged) == len(values)
+        fractions = np.linspace(0.01, 0.99, 99)
+        ranks = np.searchsorted(np.sort(values), merged.quantiles(fractions)) / len(values)
+        assert np.abs(ranks - fractions).max() < 0.018
+
+    def test_seed(self, values):
+        sketches = [QuantileSketch(k=32, seed=seed) for seed in [1, 1, 2]]
+        for sketch in sketches:
+            for chunk in np.array_split(values[:10000], 20):
+                sketch.update(chunk)
+        levels = [[level.tolist() for level in sketch.levels] for sketch in sketches]
+        assert levels[0] == levels[1] != levels[2]
+
+    def test_empty(self):
+        sketch = QuantileSketch()
+        sketch.update([np.nan, np.inf])
+        assert len(sketch) == 0
+        assert sketch.quantiles([0.5]) == [None]
+
+
+class TestHistogram(object):
+    """Tests for the fixed edges histogram."""
+
+    def test_update_merge(self):
+        histogram = Histogram([10, 15, 20])
+        histogram.update([5, 10, 14.9, 15, 25, np.nan])
+        histogram.merge(Histogram([10, 15, 20], counts=[0, 0, 1, 0]))
+        assert histogram.counts.tolist() == [1, 2, 2, 1]
+        with raises(AssertionError):
+            histogram.merge(Histogram([10, 20]))
+
+
+class TestSerialization(object):
+    """Tests for the serialization of the sketches."""
+
+    def test_dumps_loads(self, values):
+        sketches = new_sketches()
+        assert list(sketches) == sketch_columns()
+        sketches['g'].update(values)
+        loaded = loads(dumps(sketches))
+        assert loaded['g'].percentiles() == sketches['g'].percentiles()
+        assert loaded['g'].histogram.counts.tolist() == sketches['g'].histogram.counts.tolist()
+        assert len(loaded['value']) == 0
+
+        loaded['g'].merge(DistributionSketch(sketches['g'].histogram.edges))
+        assert len(loaded['g']) == len(values)
+        assert loads(None) is None and dumps(None) is None
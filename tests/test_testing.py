@@ -0,0 +1,24 @@
+# encoding: utf-8
+#
+# test_testing.py
+
+from cartons_inventory.testing import (TARGETDB_COLUMNS, TARGETDB_MODELS,
+                                       table_definition)
+
+
+class TestStandIn(object):
+    """Tests for the SQLite stand-in of targetdb."""
+
+    def test_table_definition(self):
+        definition = table_definition(TARGETDB_MODELS[-2])
+        assert definition.startswith('carton_to_target (pk INTEGER PRIMARY KEY, ')
+        assert 'carton_pk INT' in definition and 'lambda_eff REAL' in definition
+
+    def test_tables(self, targetdb):
+        for model in TARGETDB_MODELS:
+            table = model._meta.table_name
+            columns = [row[1] for row in targetdb.execute_sql(
+                f'PRAGMA targetdb.table_info({table})').fetchall()]
+            assert columns == [field.column_name for field in model._meta.sorted_fields]
+            assert set(TARGETDB_COLUMNS[table]) <= set(columns)
+        assert len(list(TARGETDB_MODELS[-2].select())) == 4